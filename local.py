@@ -1,3 +1,4 @@
+import os
 import platform
 
 if platform.system() == 'Linux':
@@ -19,6 +20,8 @@ from twisted.python.logfile import DailyLogFile
 from config import ConfigManager
 from networktunnel.local_server import TransferServerFactory
 from networktunnel.logger import textFileLogObserver
+from networktunnel.prefork import (PreforkService, PreforkSupervisor, is_worker,
+                                  run_worker, worker_args, worker_port)
 from networktunnel.service import PacService
 from settings import BASE_DIR
 
@@ -37,8 +40,14 @@ def get_application():
     pac_service.setServiceParent(top_service)
 
     port = conf.getint('local', 'port', fallback=1080)
-    tcp_service = internet.TCPServer(port, TransferServerFactory(reactor), interface='0.0.0.0')
-    tcp_service.setServiceParent(top_service)
+    workers = conf.getint('local', 'workers', fallback=0)
+    if workers > 0:
+        # 多进程模式, 每个 worker 使用 SO_REUSEPORT 监听同一个端口
+        prefork_service = PreforkService(reactor, worker_args(os.path.join(BASE_DIR, 'local.py'), port), workers)
+        prefork_service.setServiceParent(top_service)
+    else:
+        tcp_service = internet.TCPServer(port, TransferServerFactory(reactor), interface='0.0.0.0')
+        tcp_service.setServiceParent(top_service)
 
     top_service.setServiceParent(application)
 
@@ -52,8 +61,19 @@ def main():
 
         log.startLogging(sys.stdout)
 
-    endpoint = TCP4ServerEndpoint(reactor, conf.getint('local', 'port'))
-    endpoint.listen(TransferServerFactory(reactor))
+    port = conf.getint('local', 'port')
+    workers = conf.getint('local', 'workers', fallback=0)
+
+    if is_worker():
+        run_worker(reactor, TransferServerFactory(reactor), worker_port())
+    elif workers > 0:
+        supervisor = PreforkSupervisor(reactor, worker_args(os.path.join(BASE_DIR, 'local.py'), port), workers)
+        reactor.callWhenRunning(supervisor.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+    else:
+        endpoint = TCP4ServerEndpoint(reactor, port)
+        endpoint.listen(TransferServerFactory(reactor))
+
     reactor.run()
 
 
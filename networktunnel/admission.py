@@ -0,0 +1,125 @@
+from collections import OrderedDict
+
+from twisted.logger import Logger
+
+log = Logger()
+
+
+class AdmissionQueue(object):
+    """
+    限制同时处理的连接数 (connectionslimit)
+    超出的连接暂停读取, 在有界的 FIFO 队列中等待, 超过 timeout 秒仍未轮到就关闭
+    队列满时暂停监听端口, 新连接留在内核的 backlog 中
+    """
+
+    def __init__(self, reactor, limit: int, queue_size: int = None, timeout: float = 10):
+        self.reactor = reactor
+        self.limit = limit
+        self.queue_size = queue_size if queue_size is not None else limit
+        self.timeout = timeout
+
+        self._active = set()
+        self._waiting = OrderedDict()  # protocol -> (入队时间, DelayedCall)
+        self._ports = set()
+        self._accept_paused = False
+
+        self.admitted = 0
+        self.queued = 0
+        self.expired = 0
+        self.dequeued = 0  # 排队后被接纳的连接数
+        self.max_depth = 0
+        self.wait_time = 0.0  # 排队连接的总等待时间
+
+    def request(self, proto, port=None) -> bool:
+        """
+        新连接申请处理
+        :param port: 接受这个连接的监听端口, 队列满时暂停它
+        :return: True 表示立即处理, False 表示已经暂停读取并进入队列
+        """
+        if port is not None:
+            self._ports.add(port)
+
+        if len(self._active) < self.limit and not self._waiting:
+            self._active.add(proto)
+            self.admitted += 1
+            return True
+
+        proto.transport.pauseProducing()
+        call = self.reactor.callLater(self.timeout, self._expire, proto)
+        self._waiting[proto] = (self.reactor.seconds(), call)
+
+        self.queued += 1
+        if len(self._waiting) > self.max_depth:
+            self.max_depth = len(self._waiting)
+
+        if len(self._waiting) >= self.queue_size:
+            self.pause_accepting()
+
+        return False
+
+    def release(self, proto):
+        """ 连接断开 """
+        entry = self._waiting.pop(proto, None)
+        if entry is not None:
+            _, call = entry
+            if call.active():
+                call.cancel()
+        else:
+            self._active.discard(proto)
+
+        self._admit_next()
+
+    def _admit_next(self):
+        now = self.reactor.seconds()
+        while self._waiting and len(self._active) < self.limit:
+            proto, (queued_at, call) = self._waiting.popitem(last=False)
+            if call.active():
+                call.cancel()
+
+            self._active.add(proto)
+            self.admitted += 1
+            self.dequeued += 1
+            self.wait_time += now - queued_at
+            proto.transport.resumeProducing()
+
+        if len(self._waiting) < self.queue_size:
+            self.resume_accepting()
+
+    def _expire(self, proto):
+        if self._waiting.pop(proto, None) is None:
+            return
+
+        self.expired += 1
+        log.info('connection waited {timeout}s for admission, close it', timeout=self.timeout)
+        proto.transport.loseConnection()
+        self._admit_next()
+
+    def pause_accepting(self):
+        if self._accept_paused:
+            return
+
+        self._accept_paused = True
+        log.warn('admission queue is full, stop accepting connections')
+        for port in self._ports:
+            port.stopReading()
+
+    def resume_accepting(self):
+        if not self._accept_paused:
+            return
+
+        self._accept_paused = False
+        for port in self._ports:
+            port.startReading()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'active': len(self._active),
+            'waiting': len(self._waiting),
+            'max_depth': self.max_depth,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'expired': self.expired,
+            'accept_paused': self._accept_paused,
+            'avg_wait': self.wait_time / self.dequeued if self.dequeued else 0.0,
+        }
@@ -1,12 +1,58 @@
-import socket
 import struct
 
 from twisted.internet import defer, protocol
-from twisted.internet.address import HostnameAddress, IPv4Address, IPv6Address
 from twisted.logger import Logger
 
 from networktunnel import constants, errors
-from networktunnel.helpers import socks_domain_host
+from networktunnel.helpers import (create_reply, socks_auth_length,
+                                   socks_request_length)
+from networktunnel.timeouts import TIMEOUT_HANDSHAKE, TIMEOUT_IDLE
+
+# 握手消息的最大长度: VER CMD RSV ATYP LEN 255 字节的域名 PORT
+MAX_MESSAGE_SIZE = 262
+
+
+class MessageBuffer(object):
+    """
+    握手阶段累积的数据, 每次取出一个完整的消息, 剩下的留给下一个状态
+    用读偏移代替切片, 已读部分超过一半时才整理缓冲区
+    """
+
+    def __init__(self):
+        self._data = bytearray()
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._data) - self._pos
+
+    def feed(self, data: bytes):
+        self._data += data
+
+    def peek(self, size: int) -> bytes:
+        return bytes(self._data[self._pos:self._pos + size])
+
+    def skip(self, size: int):
+        self._pos += size
+
+        if self._pos >= len(self._data):
+            self.clear()
+        elif self._pos > len(self._data) // 2:
+            del self._data[:self._pos]
+            self._pos = 0
+
+    def read(self, size: int) -> bytes:
+        data = self.peek(size)
+        self.skip(size)
+        return data
+
+    def read_all(self) -> bytes:
+        data = bytes(self._data[self._pos:]) if self._pos else bytes(self._data)
+        self.clear()
+        return data
+
+    def clear(self):
+        self._data = bytearray()
+        self._pos = 0
 
 
 class BaseSocksServer(protocol.Protocol):
@@ -32,7 +78,8 @@ class BaseSocksServer(protocol.Protocol):
 
         self._version = constants.SOCKS5_VER
         self._state = None
-        # self._buffered = ctypes.c_buffer(1024 * 4)  # ４Ｍ
+        self._buffer = MessageBuffer()  # 握手阶段还没有处理的数据
+        self.last_active = 0.0  # 最后一次转发数据的时间
         self.set_state(self.STATE_CREATED)
 
     def connectionMade(self):
@@ -42,14 +89,19 @@ class BaseSocksServer(protocol.Protocol):
 
         self.factory.num_protocols += 1
 
+        # 到 STATE_ESTABLISHED 之前的所有等待 (认证, 命令, 连接目标, BIND 的传入连接) 共用一个超时
+        self.factory.timeouts.schedule(self, self.factory.handshake_timeout, TIMEOUT_HANDSHAKE)
+
     def connectionLost(self, reason):
         self.set_state(self.STATE_DISCONNECTED)
+        self.factory.timeouts.cancel(self)
         if self.factory.num_protocols > 0:
             self.factory.num_protocols -= 1
 
         if self.client is not None and self.client.transport:
-            self.client.transport.loseConnection()
-            self.client = None
+            client, self.client = self.client, None
+            # 数据管道中还没有写出的数据写完之后再关闭
+            self.drain_client(client).addCallback(lambda ignored: client.transport.loseConnection())
 
         if self.udp_port is not None:
             def stoped(result):
@@ -59,6 +111,67 @@ class BaseSocksServer(protocol.Protocol):
             # 不用调用 stopListening 会自动 stopListening
             # self.udp_port.stopListening().addCallbacks(stoped, self.on_error)
 
+    def drain_client(self, client):
+        """ :return: defer, 发往 client 的数据都写出后触发, 之后关闭 client 的连接 """
+        return defer.succeed(None)
+
+    def handshake_done(self, watch_idle=True):
+        """
+        握手完成, 取消握手超时
+        :param watch_idle: 开始检查空闲, UDP 和多路复用隧道的 TCP 连接本来就可能长时间没有数据
+        """
+        timeouts = self.factory.timeouts
+        self.last_active = timeouts.now
+        timeouts.schedule(self, self.factory.idle_timeout if watch_idle else 0, TIMEOUT_IDLE)
+
+    def track_activity(self, sink):
+        """ 包装转发函数, 记录最后一次转发数据的时间, 没有配置空闲超时时直接返回 sink """
+        if self.factory.idle_timeout <= 0:
+            return sink
+
+        timeouts = self.factory.timeouts
+
+        def relay(data):
+            self.last_active = timeouts.now
+            sink(data)
+
+        return relay
+
+    def on_timeout(self, reason: str):
+        timeouts = self.factory.timeouts
+        if reason == TIMEOUT_IDLE:
+            idle = timeouts.now - self.last_active
+            if idle < self.factory.idle_timeout:
+                timeouts.schedule(self, self.factory.idle_timeout - idle, TIMEOUT_IDLE)
+                return
+
+        self.log.info('{reason} timeout {address}, state: {state}',
+                      reason=reason, address=self.peer_address, state=self._state)
+        timeouts.expire(reason)
+        self.transport.loseConnection()
+
+    def message_length(self, data: bytes):
+        """
+        当前状态期望的消息长度, 数据不完整或者当前状态不接收消息时返回 None
+        """
+        if self.is_state(self.STATE_CONNECTED) or self.is_state(self.STATE_SENT_METHOD):
+            return socks_auth_length(data)
+
+        if self.is_state(self.STATE_SENT_AUTHENTICATION_RESULT):
+            return socks_request_length(data)
+
+        return None
+
+    def next_message(self):
+        """ 从缓冲区取出当前状态的一个完整消息, 没有时返回 None """
+        data = self._buffer.peek(MAX_MESSAGE_SIZE)
+        length = self.message_length(data)
+        if length is None or length > len(data):
+            return None
+
+        self._buffer.skip(length)
+        return data[:length]
+
     def check_version(self, ver: int):
         if ver != self._version:
             self.log.warn(f'Wrong version from {self.peer_address}')
@@ -88,25 +201,7 @@ class BaseSocksServer(protocol.Protocol):
         self.transport.loseConnection()
 
     def make_reply(self, rep, address=None):
-        if isinstance(address, IPv4Address):
-            atyp = constants.ATYP_IPV4
-            addr = socket.inet_aton(address.host)
-        elif isinstance(address, IPv6Address):
-            atyp = constants.ATYP_IPV6
-            addr = socket.inet_pton(socket.AF_INET6, address.host)
-        elif isinstance(address, HostnameAddress):
-            atyp = constants.ATYP_DOMAINNAME
-            addr = socks_domain_host(address.host)
-        else:
-            atyp = constants.ATYP_IPV4
-            addr = socket.inet_aton('0.0.0.0')
-
-        response = b''.join([
-            struct.pack('!4B', self._version, rep, constants.RSV, atyp),
-            b''.join([addr, struct.pack('!H', address.port)])
-        ])
-
-        self.write(response)
+        self.write(create_reply(self._version, rep, address))
 
     def write(self, data):
         self.transport.write(data)
@@ -116,20 +211,3 @@ class BaseSocksServer(protocol.Protocol):
 
     def set_state(self, state):
         self._state = state
-
-    '''
-    def read_bytes(self, bytes_num=None):
-        if bytes_num is None:
-            data = self._buffered.value
-            self._buffered = libc.strcpy(self._buffered, b'')  # 重置
-            return data
-
-        data_buffer = ctypes.c_buffer(bytes_num)
-        libc.memcpy(data_buffer, self._buffered, bytes_num)
-        data = data_buffer.value
-        libc.strcpy(self._buffered, ctypes.cast(ctypes.byref(self._buffered, bytes_num), ctypes.c_char_p))
-        return data
-
-    def load_buffer(self, data):
-        libc.strcat(self._buffered, data)
-    '''
@@ -1,29 +1,40 @@
 import abc
+import functools
 import hashlib
 import json
 import os
 
-from Crypto.Cipher import AES, ARC4, ChaCha20
+from Crypto.Cipher import AES, ARC4, ChaCha20, ChaCha20_Poly1305
 from Crypto.Cipher import PKCS1_v1_5 as Cipher_pkcs1_v1_5
 from Crypto.Cipher import Salsa20
-from Crypto.Hash.SHA1 import SHA1Hash
+from Crypto.Hash import SHA1
 from Crypto.Protocol.KDF import HKDF
 from Crypto.PublicKey import RSA
 
 from settings import BASE_DIR
 
 
+@functools.lru_cache(maxsize=None)
+def bytes_to_key(password: bytes, key_size: int, salt: bytes = b"") -> bytes:
+    """
+    EVP_BytesToKey 风格的 MD5 密钥派生,
+    整个进程按 (password, key size, salt) 缓存, 每个不同的密钥只派生一次
+    密钥都来自配置, 数量有限, 不限制缓存大小 (每个 ShadowProtocol 派生两种长度, 有上限时会被互相挤出)
+    """
+    key = b""
+    digest = b""
+    while len(key) < key_size:
+        digest = hashlib.md5(digest + password + salt).digest()
+        key += digest
+    return key[:key_size]
+
+
 class BaseCipher:
     def __init__(self, password: str):
         self.master_key = self._get_key(password.encode("ascii", "ignore"))
 
     def _get_key(self, password: bytes, salt: bytes = b"") -> bytes:
-        key_buf = []
-        while len(b"".join(key_buf)) < self.KEY_SIZE:
-            key_buf.append(
-                hashlib.md5((key_buf[-1] if key_buf else b"") + password + salt).digest()
-            )
-        return b"".join(key_buf)[: self.KEY_SIZE]
+        return bytes_to_key(password, self.KEY_SIZE, salt)
 
 
 class AEADCipher(BaseCipher, metaclass=abc.ABCMeta):
@@ -50,9 +61,21 @@ class AEADCipher(BaseCipher, metaclass=abc.ABCMeta):
     def TAG_SIZE(self):
         """"""
 
+    def __init__(self, password: str):
+        super().__init__(password)
+        # 配置中固定的 salt 反复使用, 子密钥只派生一次; 连接和数据报的 salt 是随机的, 不缓存
+        self._pinned_subkeys = {}
+
+    def pin_salt(self, salt: bytes):
+        self._pinned_subkeys[salt] = self._derive_subkey(salt)
+
     def _derive_subkey(self, salt: bytes) -> bytes:
+        subkey = self._pinned_subkeys.get(salt)
+        if subkey is not None:
+            return subkey
+
         return HKDF(
-            self.master_key, self.KEY_SIZE, salt, SHA1Hash, 1, context=self.info
+            self.master_key, self.KEY_SIZE, salt, SHA1, 1, context=self.info
         )
 
     def random_salt(self) -> bytes:
@@ -114,15 +137,19 @@ class AES256GCM(AES128GCM):
     TAG_SIZE = 16
 
 
-# pycryptodome doesn't supoort chacha20-ietf-poly-1305 yet
-# class ChaCha20IETFPoly1305(AEADCipher):
-#     KEY_SIZE = 32
-#     SALT_SIZE = 32
-#     NONCE_SIZE = 12
-#     TAG_SIZE = 16
-#
-#     def new_cipher(self, subkey: bytes, nonce: bytes):
-#         return ChaCha20.new(key=subkey, nonce=nonce)
+class ChaCha20IETFPoly1305(AEADCipher):
+    KEY_SIZE = 32
+    SALT_SIZE = 32
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+
+    def new_cipher(self, subkey: bytes, nonce: bytes):
+        return ChaCha20_Poly1305.new(key=subkey, nonce=nonce)
+
+
+class XChaCha20IETFPoly1305(ChaCha20IETFPoly1305):
+    # 24 字节 nonce 时 pycryptodome 自动使用 XChaCha20
+    NONCE_SIZE = 24
 
 
 class StreamCipher(BaseCipher, metaclass=abc.ABCMeta):
@@ -197,15 +224,51 @@ class Salsa20Manager(StreamCipher):
 
 class RC4Cipher(StreamCipher):
     KEY_SIZE = 16
-    IV_SIZE = 0
+    IV_SIZE = 16
 
     def new_cipher(self, key: bytes, iv: bytes):
-        return ARC4.new(key=key)
+        # RC4 没有 IV, 与 rc4-md5 一样用 md5(key + iv) 作为每个 IV 的密钥
+        return ARC4.new(key=hashlib.md5(key + iv).digest())
+
+
+class ChunkedRSACipher(object):
+    """
+    PKCS1 v1.5 单次加密的长度受模长限制, 这里按模长切分明文,
+    每块分别加密后拼接, 解密时按密文块长度切分
+    """
+
+    def __init__(self, key):
+        self._cipher = Cipher_pkcs1_v1_5.new(key)
+        self.block_size = key.size_in_bytes()
+        self.chunk_size = self.block_size - 11  # PKCS1 v1.5 填充至少 11 字节
+
+    def encrypt(self, plaintext: bytes) -> bytes:
+        view = memoryview(plaintext)
+        return b''.join([
+            self._cipher.encrypt(bytes(view[offset:offset + self.chunk_size]))
+            for offset in range(0, len(view), self.chunk_size)
+        ])
+
+    def decrypt(self, ciphertext: bytes, sentinel=None):
+        if len(ciphertext) % self.block_size:
+            return sentinel
+
+        view = memoryview(ciphertext)
+        chunks = []
+        for offset in range(0, len(view), self.block_size):
+            chunk = self._cipher.decrypt(bytes(view[offset:offset + self.block_size]), sentinel)
+            if chunk is sentinel:
+                return sentinel
+            chunks.append(chunk)
+        return b''.join(chunks)
 
 
 class RSAManager(object):
-    # static property, 避免重复读取文件
-    _key = None
+    # 私钥运算较慢, 由 ShadowProtocol 放到线程池中解密
+    offload_decrypt = True
+
+    # static property, 按 key 文件缓存 cipher 对象, 避免重复读取文件
+    _ciphers = {}
 
     def __init__(self, password=None):
         pass
@@ -230,12 +293,14 @@ class RSAManager(object):
     def new_cipher(self, file_path, iv=None):
         # cipher has encrypt and decrypt methods
         # key is public.pem or private.pem file path
-        if not self._key:
+        cipher = self._ciphers.get(file_path)
+        if cipher is None:
             with open(os.path.join(BASE_DIR, file_path), 'r') as f:
-                key = f.read()
-                self._key = RSA.importKey(key)  # 导入读取到的公钥
+                key = RSA.importKey(f.read())  # 导入读取到的公钥
+
+            cipher = ChunkedRSACipher(key)  # 生成对象
+            self._ciphers[file_path] = cipher
 
-        cipher = Cipher_pkcs1_v1_5.new(self._key)  # 生成对象
         return cipher
 
 
@@ -256,19 +321,59 @@ class TableCipher(object):
             return sentinel
 
 
+class TranslateTableCipher(TableCipher):
+    """
+    预先生成 256 字节的映射表, 由 bytes.translate 在 C 层一次完成整个缓冲区的替换,
+    TableCipher 的逐字节实现保留作为参考实现
+    """
+
+    def __init__(self, password: list):
+        super().__init__(password)
+        self.table = bytes(password)
+
+    def encrypt(self, message: bytes):
+        # bytearray 和 memoryview 需要先转换成 bytes, 保证输出类型一致
+        if not isinstance(message, bytes):
+            message = bytes(message)
+        return message.translate(self.table)
+
+
 class TableManager(RSAManager):
+    offload_decrypt = False
+    _key = None
     _cipher = None
 
     def new_cipher(self, file_path, iv=None):
         if not self._key:
             with open(os.path.join(BASE_DIR, file_path), 'r') as fp:
                 self._key = json.load(fp)
-                self._cipher = TableCipher(self._key)
+                self._cipher = TranslateTableCipher(self._key)
 
         return self._cipher
 
 
+class PlainCipher(object):
+    """
+    不加密, 数据原样转发, 用于已经加密的流量 (如 TLS) 或可信的网络
+    remote 端可以用 splice 在内核中转发这样的连接
+    """
+
+    def __init__(self, password=None):
+        pass
+
+    def make_encrypter(self, iv=None):
+        return iv, self.encrypt
+
+    def make_decrypter(self, iv=None):
+        return self.encrypt
+
+    @staticmethod
+    def encrypt(data: bytes) -> bytes:
+        return data
+
+
 ciphers = {
+    "none": PlainCipher,
     "aes-256-cfb": AES256CFB,
     "aes-128-cfb": AES128CFB,
     "aes-192-cfb": AES192CFB,
@@ -278,6 +383,8 @@ ciphers = {
     "aes-256-gcm": AES256GCM,
     "aes-192-gcm": AES192GCM,
     "aes-128-gcm": AES128GCM,
+    "chacha20-ietf-poly1305": ChaCha20IETFPoly1305,
+    "xchacha20-ietf-poly1305": XChaCha20IETFPoly1305,
     "rsa": RSAManager,
     "table": TableManager,
 }
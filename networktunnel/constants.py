@@ -2,6 +2,7 @@ AUTH_ANONYMOUS, AUTH_LOGIN, AUTH_TOKEN = 0x00, 0x01, 0x80  # 0x80 自定义 Logi
 AUTH_ERROR, AUTH_SUCCESS = 0x00, 0x01
 ATYP_IPV4, ATYP_DOMAINNAME, ATYP_IPV6 = 0x01, 0x03, 0x04
 CMD_CONNECT, CMD_BIND, CMD_UDP_ASSOCIATE = 0x01, 0x02, 0x03
+CMD_MUX = 0x80  # 自定义命令, 把连接切换为多路复用隧道
 NO_ACCEPTABLE_METHODS = 0xff
 RSV = 0x00  # 保留字
 
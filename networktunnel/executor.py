@@ -0,0 +1,219 @@
+from collections import deque
+
+from twisted.internet import defer, threads
+from twisted.logger import Logger
+from twisted.python.threadpool import ThreadPool
+
+from networktunnel.flow import read_gate
+
+log = Logger()
+
+
+class CryptoExecutor(object):
+    """
+    大块数据的加解密放到线程池中执行, pycryptodome 处理大缓冲区时会释放 GIL,
+    这样一个进程可以同时利用多个 CPU 核心
+    """
+
+    def __init__(self, reactor, workers: int, threshold: int = 64 * 1024, high_water: int = 4 * 1024 * 1024):
+        self.reactor = reactor
+        self.threshold = threshold  # 不小于这个长度的数据才放到线程池中
+        self.high_water = high_water  # 单个连接排队的数据超过这个长度时暂停读取
+
+        self.workers = workers
+        self.pool = ThreadPool(minthreads=workers, maxthreads=workers, name='crypto')
+        self._shutdown_trigger = None
+        reactor.callWhenRunning(self.start)
+
+    def start(self):
+        """ factory 的 startFactory 中调用, stop 之后可以再次启动 """
+        if self.pool.started:
+            return
+
+        if self.pool.joined:
+            # 停止的线程池不能再启动, 换一个新的
+            self.pool = ThreadPool(minthreads=self.workers, maxthreads=self.workers, name='crypto')
+        self.pool.start()
+        self._shutdown_trigger = self.reactor.addSystemEventTrigger('during', 'shutdown', self._shutdown)
+
+    def stop(self):
+        """ factory 的 stopFactory 中调用 """
+        if self._shutdown_trigger is not None:
+            self.reactor.removeSystemEventTrigger(self._shutdown_trigger)
+        self._shutdown()
+
+    def _shutdown(self):
+        self._shutdown_trigger = None
+        if self.pool.started:
+            self.pool.stop()
+
+    def pipe(self, cipher, sink, producer=None):
+        return OrderedPipe(self, cipher, sink, producer)
+
+    def run(self, cipher, data):
+        return threads.deferToThreadPool(self.reactor, self.pool, cipher, data)
+
+
+class OrderedPipe(object):
+    """
+    一个连接一个方向的数据管道: cipher(data) -> sink
+    同一时间只有一个任务在线程池中, 排队的数据合并后一起处理, 保证顺序
+    """
+
+    def __init__(self, executor: CryptoExecutor, cipher, sink, producer=None):
+        self.executor = executor
+        self.cipher = cipher
+        self.sink = sink
+        self.producer = producer
+
+        self._queue = deque()
+        self._queued_bytes = 0
+        self._busy = False
+        self._paused = False
+        self._drain_waiters = []
+
+    def __call__(self, data):
+        if not self._busy and len(data) < self.executor.threshold:
+            # 小数据直接在 reactor 线程中处理, 避免线程切换的开销
+            self.sink(self.cipher(data))
+            return
+
+        self._queue.append(data)
+        self._queued_bytes += len(data)
+
+        if self.producer is not None and not self._paused and self._queued_bytes > self.executor.high_water:
+            self._paused = True
+            read_gate(self.producer).pause(self)
+
+        self._run()
+
+    def drained(self):
+        """
+        :return: defer, 排队和线程池中的数据都交给 sink 之后触发, 关闭连接之前等待
+        """
+        if not self._busy and not self._queue:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self._drain_waiters.append(d)
+        return d
+
+    def _notify_drained(self):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def _run(self):
+        if self._busy or not self._queue:
+            return
+
+        # 流加密的上下文是连续的, 合并排队的数据不影响结果
+        data = self._queue.popleft() if len(self._queue) == 1 else b''.join(self._queue)
+        self._queue.clear()
+        self._queued_bytes = 0
+        self._busy = True
+
+        d = self.executor.run(self.cipher, data)
+        d.addCallbacks(self._done, self._failed)
+
+    def _done(self, result):
+        self._busy = False
+        self.sink(result)
+
+        if self._paused and self._queued_bytes <= self.executor.high_water:
+            self._paused = False
+            read_gate(self.producer).resume(self)
+
+        self._run()
+        if not self._busy:
+            self._notify_drained()
+
+    def _failed(self, failure):
+        self._busy = False
+        self._queue.clear()
+        log.failure('crypto job failed', failure=failure)
+
+        if self.producer is not None:
+            self.producer.loseConnection()
+        self._notify_drained()
+
+
+class WriteStats(object):
+    """ 一个 factory 所有连接的写入合并统计 """
+
+    def __init__(self):
+        self.writes = 0  # 调用次数
+        self.flushes = 0  # 实际的加密和 transport.write 次数
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            'writes': self.writes,
+            'flushes': self.flushes,
+            'coalesced': self.writes - self.flushes,
+            'bytes_per_write': self.bytes / self.flushes if self.flushes else 0.0,
+        }
+
+
+class WriteCoalescer(object):
+    """
+    同一次 reactor 循环中的多次小写入合并成一次加密和一次 transport.write,
+    减少系统调用和小包, 累积超过 max_size 时立即写出
+    """
+
+    def __init__(self, reactor, write, max_size: int = 64 * 1024, stats: WriteStats = None):
+        self.reactor = reactor
+        self.write = write
+        self.max_size = max_size
+        self.stats = stats if stats is not None else WriteStats()
+
+        self._buffer = []
+        self._size = 0
+        self._call = None
+
+    def __call__(self, data):
+        self._buffer.append(data)
+        self._size += len(data)
+        self.stats.writes += 1
+
+        if self._size >= self.max_size:
+            self.flush()
+        elif self._call is None:
+            self._call = self.reactor.callLater(0, self.flush)
+
+    def flush(self):
+        """ 关闭连接之前也要调用, 把合并中的数据写出 """
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+        if not self._buffer:
+            return
+
+        data = self._buffer[0] if len(self._buffer) == 1 else b''.join(self._buffer)
+        self._buffer = []
+        self._size = 0
+
+        self.stats.flushes += 1
+        self.stats.bytes += len(data)
+        self.write(data)
+
+
+def drain(pipe):
+    """ :return: defer, pipe 中的数据都写出后触发, 直接处理的 pipe 没有排队 """
+    drained = getattr(pipe, 'drained', None)
+    if drained is None:
+        return defer.succeed(None)
+    return drained()
+
+
+def make_pipe(executor, cipher, sink, producer=None):
+    """ 没有配置线程池时直接在 reactor 线程中处理 """
+    if executor is None:
+        def pipe(data):
+            sink(cipher(data))
+
+        return pipe
+
+    return executor.pipe(cipher, sink, producer)
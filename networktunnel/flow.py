@@ -0,0 +1,61 @@
+import weakref
+
+FLOW_CONTROL = 'flow'  # 对端 transport 写缓冲区满 (registerProducer)
+
+
+class ReadGate(object):
+    """
+    一个 transport 的读取可能同时被几个来源暂停: 对端写缓冲区满, 限速, 加密线程池排队, mux 流的发送窗口
+    每个来源分别记录自己的暂停, 全部释放之后才恢复读取, 一个来源恢复时不会覆盖其他来源的暂停
+
+    gate 实现 IPushProducer, 代替 transport 注册给对端, 对端的流控也是其中一个来源
+    """
+
+    def __init__(self, transport):
+        self._transport = weakref.ref(transport)
+        self.holders = set()
+
+    @property
+    def transport(self):
+        return self._transport()
+
+    def pause(self, holder):
+        self.holders.add(holder)
+        transport = self.transport
+        if transport is not None:
+            # 其他代码可能直接恢复过 transport, 每次都重新暂停
+            transport.pauseProducing()
+
+    def resume(self, holder):
+        if holder not in self.holders:
+            return
+
+        self.holders.discard(holder)
+        transport = self.transport
+        if not self.holders and transport is not None and getattr(transport, 'connected', True):
+            transport.resumeProducing()
+
+    def is_paused(self, holder) -> bool:
+        return holder in self.holders
+
+    def pauseProducing(self):
+        self.pause(FLOW_CONTROL)
+
+    def resumeProducing(self):
+        self.resume(FLOW_CONTROL)
+
+    def stopProducing(self):
+        transport = self.transport
+        if transport is not None:
+            transport.stopProducing()
+
+
+_gates = weakref.WeakKeyDictionary()  # transport -> ReadGate
+
+
+def read_gate(transport) -> ReadGate:
+    """ transport 对应的 ReadGate, 同一个 transport 总是得到同一个 """
+    gate = _gates.get(transport)
+    if gate is None:
+        gate = _gates[transport] = ReadGate(transport)
+    return gate
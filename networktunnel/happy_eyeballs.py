@@ -0,0 +1,180 @@
+from twisted.internet import defer, protocol
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP6ClientEndpoint
+from twisted.logger import Logger
+
+from networktunnel import errors
+from networktunnel.helpers import LRUCache
+
+log = Logger()
+
+CONNECT_STAGGER = 0.25  # RFC 8305 推荐的 Connection Attempt Delay
+
+
+class _AddressRecord(object):
+    __slots__ = ('rtt', 'failed_at')
+
+    def __init__(self):
+        self.rtt = None  # 平滑后的连接耗时
+        self.failed_at = None  # 最近一次连接失败的时间
+
+
+class AddressStats(object):
+    """
+    每个目标 IP 最近的连接耗时和失败, 用来给下一次连接的地址排序
+    """
+
+    def __init__(self, reactor, capacity=4096, failure_ttl=60, alpha=0.25):
+        """
+        :param failure_ttl: 失败后多少秒内排在最后
+        :param alpha: 连接耗时的平滑系数, 与 TCP 的 SRTT 相同
+        """
+        self.reactor = reactor
+        self.failure_ttl = failure_ttl
+        self.alpha = alpha
+        self.cache = LRUCache(capacity=capacity)
+
+    def _record(self, ip):
+        try:
+            return self.cache.get(ip)
+        except KeyError:
+            record = _AddressRecord()
+            self.cache.set(ip, record)
+            return record
+
+    def success(self, ip: str, rtt: float):
+        record = self._record(ip)
+        record.rtt = rtt if record.rtt is None else record.rtt + self.alpha * (rtt - record.rtt)
+        record.failed_at = None
+
+    def failure(self, ip: str):
+        self._record(ip).failed_at = self.reactor.seconds()
+
+    def sort(self, addresses: list) -> list:
+        """
+        IPv6 和 IPv4 交替排列 (RFC 8305), 连接过的地址按耗时排在前面, 最近失败过的排在最后
+        """
+        ipv6 = [ip for ip in addresses if ':' in ip]
+        ipv4 = [ip for ip in addresses if ':' not in ip]
+        interleaved = []
+        for i in range(max(len(ipv6), len(ipv4))):
+            interleaved.extend(ipv6[i:i + 1] + ipv4[i:i + 1])
+
+        now = self.reactor.seconds()
+
+        def key(item):
+            index, ip = item
+            record = self.cache.cache.get(ip)
+            if record is None:
+                return 1, 0, index
+            if record.failed_at is not None and now - record.failed_at < self.failure_ttl:
+                return 2, 0, index
+            if record.rtt is None:
+                return 1, 0, index
+            return 0, record.rtt, index
+
+        return [ip for _, ip in sorted(enumerate(interleaved), key=key)]
+
+    def stats(self):
+        return {
+            'size': len(self.cache),
+            'capacity': self.cache.capacity,
+        }
+
+
+class _AttemptFactory(protocol.Factory):
+    """ 只有第一个建立的连接得到真正的协议, 之后建立的连接返回 None, 由 Twisted 关闭 """
+
+    def __init__(self, race, ip):
+        self.race = race
+        self.ip = ip
+
+    def buildProtocol(self, addr):
+        if self.race.winner is not None or self.race.deferred.called:
+            return None
+
+        self.race.winner = self.ip
+        return self.race.proto
+
+
+class ConnectRace(object):
+    """
+    RFC 8305 Happy Eyeballs: 按顺序每隔 stagger 秒向下一个地址发起连接, 前一个失败时立即发起,
+    第一个建立的连接胜出, 取消其余的尝试
+    """
+
+    def __init__(self, reactor, addresses, port, proto, stats: AddressStats = None,
+                 stagger=CONNECT_STAGGER, timeout=30):
+        self.reactor = reactor
+        self.port = port
+        self.proto = proto
+        self.stats = stats
+        self.stagger = stagger
+        self.timeout = timeout
+
+        addresses = list(dict.fromkeys(addresses))
+        self.pending = stats.sort(addresses) if stats is not None else addresses
+        self.attempts = {}  # ip -> (defer, 开始时间)
+        self.winner = None
+        self.deferred = defer.Deferred(lambda d: self.stop())
+
+        self._next_call = None
+
+    def start(self):
+        """
+        :return: defer, 结果是已经连接的 proto
+        """
+        self.attempt()
+        return self.deferred
+
+    def attempt(self):
+        self._next_call = None
+        if self.winner is not None or not self.pending:
+            return
+
+        ip = self.pending.pop(0)
+        endpoint = TCP6ClientEndpoint if ':' in ip else TCP4ClientEndpoint
+        d = endpoint(self.reactor, ip, self.port, timeout=self.timeout).connect(_AttemptFactory(self, ip))
+        self.attempts[ip] = (d, self.reactor.seconds())
+        d.addCallbacks(self.connected, self.failed, callbackArgs=(ip,), errbackArgs=(ip,))
+
+        if self.pending and self.winner is None:
+            # 同步失败时 failed 中已经递归发起了下一个尝试并安排了定时, 不能留下两个定时
+            self.cancel_next()
+            self._next_call = self.reactor.callLater(self.stagger, self.attempt)
+
+    def connected(self, ignored, ip):
+        _, start = self.attempts.pop(ip)
+        if self.stats is not None:
+            self.stats.success(ip, self.reactor.seconds() - start)
+
+        self.stop()
+        self.deferred.callback(self.proto)
+
+    def failed(self, failure, ip):
+        self.attempts.pop(ip, None)
+        if self.winner is not None or self.deferred.called:
+            return  # 取消的或者落后的尝试
+
+        if self.stats is not None:
+            self.stats.failure(ip)
+        log.info('connect {ip} {port} failed: {message}', ip=ip, port=self.port, message=failure.getErrorMessage())
+
+        if self.pending:
+            # 不等待 stagger, 立即尝试下一个地址
+            self.cancel_next()
+            self.attempt()
+        elif not self.attempts:
+            self.deferred.errback(errors.HostUnreachable())
+
+    def cancel_next(self):
+        if self._next_call is not None and self._next_call.active():
+            self._next_call.cancel()
+        self._next_call = None
+
+    def stop(self):
+        self.cancel_next()
+        self.pending = []
+
+        attempts, self.attempts = self.attempts, {}
+        for d, _ in attempts.values():
+            d.cancel()
@@ -2,6 +2,8 @@ import socket
 import struct
 from collections import OrderedDict
 
+from twisted.internet.address import HostnameAddress, IPv4Address, IPv6Address
+
 from networktunnel import constants, errors
 
 # +----+------+----------+
@@ -64,6 +66,37 @@ def parse_address(atyp: int, data: bytes, cur: int = 4) -> tuple:
     return domain, port
 
 
+def socks_auth_length(data: bytes):
+    """
+    VER NMETHODS METHODS 和 VER ULEN UTOKEN 消息的长度, 数据不完整时返回 None
+    """
+    if len(data) < 2:
+        return None
+
+    return 2 + data[1]
+
+
+def socks_request_length(data: bytes):
+    """
+    请求 VER CMD RSV ATYP DST.ADDR DST.PORT 和回复的长度, 数据不完整时返回 None
+    """
+    if len(data) < 5:
+        return None
+
+    atyp = data[3]
+    if atyp == constants.ATYP_DOMAINNAME:
+        addr_len = 1 + data[4]
+    elif atyp == constants.ATYP_IPV4:
+        addr_len = 4
+    elif atyp == constants.ATYP_IPV6:
+        addr_len = 16
+    else:
+        # 交给 parse_address 报告 AddressNotSupported
+        return len(data)
+
+    return 6 + addr_len
+
+
 def udp_frame_header_length(atyp: int, data: bytes):
     if atyp == constants.ATYP_DOMAINNAME:
         domain_len = ord(data[4:5])
@@ -104,6 +137,29 @@ def create_udp_frame(frag: int, atyp: int, host: (str, bytes), port: int, data:
     ])
 
 
+def create_reply(ver: int, rep: int, address=None) -> bytes:
+    if isinstance(address, IPv4Address):
+        atyp = constants.ATYP_IPV4
+        addr = socket.inet_aton(address.host)
+    elif isinstance(address, IPv6Address):
+        atyp = constants.ATYP_IPV6
+        addr = socket.inet_pton(socket.AF_INET6, address.host)
+    elif isinstance(address, HostnameAddress):
+        atyp = constants.ATYP_DOMAINNAME
+        addr = socks_domain_host(address.hostname)
+    else:
+        atyp = constants.ATYP_IPV4
+        addr = socket.inet_aton('0.0.0.0')
+
+    port = address.port if address is not None else 0
+
+    return b''.join([
+        struct.pack('!4B', ver, rep, constants.RSV, atyp),
+        addr,
+        struct.pack('!H', port)
+    ])
+
+
 def to_bytes(s: (str, bytes)) -> bytes:
     if isinstance(s, str):
         return s.encode()
@@ -163,24 +219,39 @@ class LRUCache(object):
     def __init__(self, capacity=1000):
         self.capacity = capacity
         self.used = 0
+        self.hits = 0
+        self.misses = 0
         self.cache = OrderedDict()
 
     def get(self, key):
         # Don't catch KeyError here, for the sake of twisted CachedResolver
         # implementation.
-        value = self.cache.pop(key)
-        self.cache[key] = value
+        try:
+            value = self.cache[key]
+        except KeyError:
+            self.misses += 1
+            raise
+
+        self.cache.move_to_end(key)
+        self.hits += 1
         return value
 
     def set(self, key, value):
-        try:
-            self.cache.pop(key)
-        except KeyError:
-            if len(self.cache) >= self.capacity:
-                self.cache.popitem(last=False)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        elif len(self.cache) >= self.capacity:
+            self.cache.popitem(last=False)
         self.cache[key] = value
         self.used = len(self.cache)
 
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'used': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
     def __getitem__(self, key):
         return self.get(key)
 
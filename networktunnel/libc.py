@@ -4,7 +4,7 @@ import platform
 if platform.system() == 'Windows':
     libc = ctypes.cdll.LoadLibrary('msvcrt.dll')
 else:
-    libc = ctypes.cdll.LoadLibrary('libc.so.6')
+    libc = ctypes.CDLL('libc.so.6', use_errno=True)
 
 
 libc.strcat.argtypes = [ctypes.c_char_p, ctypes.c_char_p]
@@ -18,3 +18,39 @@ libc.strlen.restype = ctypes.c_size_t
 
 libc.memcpy.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
 libc.memcpy.restype = ctypes.c_void_p
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+# Linux 的批量收发, 一次系统调用处理多个数据报
+HAS_MMSG = hasattr(libc, 'recvmmsg') and hasattr(libc, 'sendmmsg')
+if HAS_MMSG:
+    libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    libc.recvmmsg.restype = ctypes.c_int
+
+    libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    libc.sendmmsg.restype = ctypes.c_int
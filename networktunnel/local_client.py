@@ -1,13 +1,20 @@
 import socket
 import struct
 
-from twisted.internet import protocol
+from twisted.internet import defer, error, protocol
 from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.internet.endpoints import clientFromString, connectProtocol
+from twisted.internet.task import LoopingCall
 from twisted.logger import Logger
 
 from config import ConfigManager
-from networktunnel import constants
-from networktunnel.helpers import parse_address, socks_domain_host
+from networktunnel import constants, errors
+from networktunnel.base import MAX_MESSAGE_SIZE, MessageBuffer
+from networktunnel.executor import WriteCoalescer, drain, make_pipe
+from networktunnel.flow import read_gate
+from networktunnel.helpers import (parse_address, socks_domain_host,
+                                   socks_request_length)
+from networktunnel.timeouts import TIMEOUT_HANDSHAKE
 
 log = Logger()
 
@@ -30,54 +37,160 @@ class ProxyClient(protocol.Protocol):
     STATE_Disconnected = 0x0c
     STATE_Error = 0xff
 
-    def __init__(self, server):
+    def __init__(self, server=None, pool=None, pipeline=False):
+        """
+        :param server: 直接为这个 TransferServer 建立的连接
+        :param pool: 预先建立的连接, 认证完成后放入连接池, 取出时再绑定 server
+        :param pipeline: 不等待认证的回复, 认证, 命令和首个数据合并成一次写入
+        """
         self.set_state(self.STATE_Created)
-        self.server = server
-        self.server.client = self
-        self.shadow = self.server.factory.shadow
+        self.server = None
+        self.pool = pool
+        factory = (server or pool).factory
+        self.shadow = factory.shadow
+        self.reactor = factory.reactor
+        self.timeouts = factory.timeouts
+        self.handshake_timeout = factory.handshake_timeout
+        self.pipeline = pipeline
+        self.pipeline_delay = getattr(factory, 'pipeline_delay', 0.05)
         self.peer_address = None
         self.host_address = None
         self.request_cmd = None
+        self.optimistic = False  # 已经回复了 socks client, 命令的回复不再转发
+
+        self._buffer = MessageBuffer()  # 握手阶段收到的密文
+        self._early = [] if pipeline else None  # 暂存的密文, 连接建立并且等到首个数据后一起发送
+        self._early_ready = False
+        self._early_call = None
+
+        # 连接专用的数据加解密上下文
+        self.data_encrypter = self.shadow.make_data_encrypter()
+        self.data_decrypter = self.shadow.make_data_decrypter()
+        self.relay_inbound = None
+        self.relay_outbound = None
+        self.coalescer = None
+        self.outbound_pipe = None  # coalescer 之下的数据管道
+
+        if server is not None:
+            self.server = server
+            self.server.client = self
+
+        if pipeline:
+            # 认证消息先放入缓冲区, 之后的命令跟在后面
+            self.sendAuthentication()
 
     def connectionMade(self):
-        self.set_state(self.STATE_Connected)
         self.peer_address = self.transport.getPeer()
         self.host_address = self.transport.getHost()
         log.info('Connection made {address}', address=self.peer_address)
 
-        self.transport.registerProducer(self.server.transport, True)
-        self.server.transport.registerProducer(self.transport, True)
+        # 认证和命令的回复都要在超时之前到达, 连接池中的空闲连接由连接池检查
+        self.timeouts.schedule(self, self.handshake_timeout, TIMEOUT_HANDSHAKE)
+
+        if self.server is not None:
+            self.start_relay()
+
+        if self.pipeline:
+            self.release_early()
+            return
 
+        self.set_state(self.STATE_Connected)
         # self.sendInitialHandshake()
 
         # next 2 line do 直接从认证开始
         self.set_state(self.STATE_ReceivedInitialHandshakeResponse)
         self.sendAuthentication()
 
+    def attach(self, server):
+        """ 从连接池中取出后绑定 server, 之后直接发送命令 """
+        self.server = server
+        self.server.client = self
+        self.timeouts.schedule(self, self.handshake_timeout, TIMEOUT_HANDSHAKE)
+        self.start_relay()
+
+    def start_relay(self):
+        self.transport.registerProducer(read_gate(self.server.transport), True)
+        self.server.transport.registerProducer(read_gate(self.transport), True)
+
+        executor = self.server.factory.crypto_executor
+        self.relay_inbound = make_pipe(executor, self.data_decrypter, self.server.transport.write, self.transport)
+        self.relay_outbound = self.outbound_pipe = make_pipe(executor, self.data_encrypter, self.transport.write,
+                                                             self.server.transport)
+
+        factory = self.server.factory
+        if factory.coalesce_size > 0:
+            self.coalescer = WriteCoalescer(self.reactor, self.relay_outbound, factory.coalesce_size, factory.write_stats)
+            self.relay_outbound = self.coalescer
+
+    def flush_writes(self):
+        """
+        关闭连接之前写出合并中的数据
+        :return: defer, 线程池中加密的数据也写出之后触发
+        """
+        if self.coalescer is not None:
+            self.coalescer.flush()
+        return drain(self.outbound_pipe)
+
     def connectionLost(self, reason):
         self.set_state(self.STATE_Disconnected)
+        self.timeouts.cancel(self)
 
         log.info('Connection lost {address}, message: {message}',
                  address=self.peer_address,
                  message=reason.getErrorMessage())
 
+        if self._early_call is not None and self._early_call.active():
+            self._early_call.cancel()
+
+        if self.server is None and self.pool is not None:
+            self.pool.client_lost(self)
+
         if self.server is not None and self.server.transport:
-            self.server.transport.loseConnection()
-            self.server = None
+            server, self.server = self.server, None
+            # 线程池中解密的数据写给浏览器之后再关闭
+            drain(self.relay_inbound).addCallback(lambda ignored: server.transport.loseConnection())
 
     def dataReceived(self, data):
         # 这里是接收到远程 socks 服务器的数据
         # 首先解密
-        if self.is_state(self.STATE_Established):
-            data = self.shadow.decrypt_data(data)
-        else:
-            data = self.shadow.decrypt_protocol_data(data)
-
         if self.is_state(self.STATE_Established):
             # 转发， 命令确认后进入此状态
-            self.server.write(data)
+            self.relay_inbound(data)
+            return
+
+        if not self.shadow.pro_length_preserving:
+            self.protocolDataReceived(self.shadow.decrypt_protocol_data(data))
+            return
+
+        # 认证的回复, 命令的回复和之后的数据可能在同一次读取中到达
+        self._buffer.feed(data)
+        while self._buffer and not self.is_state(self.STATE_Established):
+            if self.is_state(self.STATE_Error) or self.is_state(self.STATE_Disconnected):
+                return
+
+            ciphertext = self._buffer.peek(MAX_MESSAGE_SIZE - 1)
+            message, used = self.shadow.read_protocol_message(ciphertext, self.message_length)
+            if message is None:
+                return
+
+            self._buffer.skip(used)
+            self.protocolDataReceived(message)
+
+        if self._buffer:
+            self.relay_inbound(self._buffer.read_all())
 
-        elif self.is_state(self.STATE_SentInitialHandshake):
+    def message_length(self, data: bytes):
+        """ 当前状态下期望的协议消息长度 """
+        if self.is_state(self.STATE_SentInitialHandshake) or self.is_state(self.STATE_SentAuthentication):
+            return 2
+
+        if self.is_state(self.STATE_SentCommand) or self.is_state(self.STATE_WaitingConnection):
+            return socks_request_length(data)
+
+        return len(data)
+
+    def protocolDataReceived(self, data):
+        if self.is_state(self.STATE_SentInitialHandshake):
             self.receiveInitialHandshakeResponse(data)
 
         elif self.is_state(self.STATE_SentAuthentication):
@@ -90,6 +203,20 @@ class ProxyClient(protocol.Protocol):
             # bind cmd state
             self.receiveRemoteConnection(data)
 
+    def set_established(self):
+        self.set_state(self.STATE_Established)
+        self.timeouts.cancel(self)  # 之后的空闲由 server 检查
+
+        # 快速路径: 实例属性覆盖方法, 之后每个数据块直接进入数据管道, 不再经过状态判断
+        self.dataReceived = self.server.track_activity(self.relay_inbound)
+        self.write = self.relay_outbound
+
+    def on_timeout(self, reason):
+        log.info('{reason} timeout {address}, state: {state}',
+                 reason=reason, address=self.peer_address, state=self._state)
+        self.timeouts.expire(reason)
+        self.transport.loseConnection()
+
     def sendInitialHandshake(self):
         request = struct.pack('!BBB', constants.SOCKS5_VER, 1, constants.AUTH_TOKEN)
         log.debug('sendInitialHandshake {data!r}', data=request)
@@ -130,10 +257,22 @@ class ProxyClient(protocol.Protocol):
         if status == 1:
             # 等待 self.server 封装命令
             self.set_state(self.STATE_WaitingCommand)
-            self.server.on_client_auth_ok()
+            if self.request_cmd is not None:
+                # 流水线模式下命令已经发出
+                self.set_state(self.STATE_SentCommand)
+            elif self.server is None:
+                self.timeouts.cancel(self)
+                self.pool.client_ready(self)
+            elif not self.pipeline:
+                self.server.on_client_auth_ok()
         else:
             self.set_state(self.STATE_Error)
-            self.server.on_client_auth_error()
+            if self.pipeline:
+                self.server.transport.loseConnection()
+            elif self.server is not None:
+                self.server.on_client_auth_error()
+            elif self.pool is not None:
+                self.pool.auth_failed(self)
             self.transport.loseConnection()
 
     # +----+-----+-------+------+----------+----------+
@@ -141,11 +280,49 @@ class ProxyClient(protocol.Protocol):
     # +----+-----+-------+------+----------+----------+
     # | 1  |  1  | X'00' |  1   | Variable |    2     |
     # +----+-----+-------+------+----------+----------+
-    def sendCommand(self, data):
+    def sendCommand(self, data, optimistic=False):
+        """
+        :param optimistic: server 已经回复了 socks client, 命令等待首个数据一起发送
+        """
         log.debug('sendCommand {data!r}', data=data)
-        self.request_cmd = ord(data[1:2])
+        if optimistic and self._early is None:
+            self._early = []
+
         self.write(data)
-        self.set_state(self.STATE_SentCommand)
+        self.request_cmd = ord(data[1:2])
+        self.optimistic = optimistic
+
+        if not self.is_state(self.STATE_SentAuthentication):
+            # 流水线模式下收到认证的回复后再进入这个状态
+            self.set_state(self.STATE_SentCommand)
+
+        if optimistic:
+            # server-speaks-first 的协议不会有首个数据, 等待一小段时间后直接发送
+            self._early_call = self.reactor.callLater(self.pipeline_delay, self.early_ready)
+        else:
+            self.early_ready()
+
+    def early_ready(self):
+        self._early_ready = True
+        self.release_early()
+
+    def release_early(self):
+        """ 暂存的密文合并成一次写入 """
+        if self._early is None or not self._early_ready or not self.connected:
+            return
+
+        data, self._early = b''.join(self._early), None
+        if self._early_call is not None and self._early_call.active():
+            self._early_call.cancel()
+
+        if data:
+            self.transport.write(data)
+
+    def send(self, ciphertext):
+        if self._early is not None:
+            self._early.append(ciphertext)
+        else:
+            self.transport.write(ciphertext)
 
     # +----+-----+-------+------+----------+----------+
     # | VER | REP | RSV | ATYP | BND.ADDR | BND.PORT |
@@ -165,11 +342,14 @@ class ProxyClient(protocol.Protocol):
             if self.request_cmd == constants.CMD_UDP_ASSOCIATE:
                 atyp = ord(data[3:4])
                 host, port = parse_address(atyp, data)
+                if host in ('0.0.0.0', '::'):
+                    # remote 的 UDP 端口绑定在所有地址上, 使用隧道连接的地址
+                    host = self.transport.getPeer().host
                 self.server.udp_client.set_peer((host, port), atyp)  # 保存地址信息
 
                 data = self.modify_udp_cmd_response(constants.SOCKS5_VER, rep)
                 self.server.write(data)
-                self.set_state(self.STATE_Established)
+                self.set_established()
                 self.server.on_client_established()
 
             elif self.request_cmd == constants.CMD_BIND:
@@ -177,19 +357,28 @@ class ProxyClient(protocol.Protocol):
                 self.set_state(self.STATE_WaitingConnection)
                 self.server.on_bind_first_reply()
 
+            elif self.optimistic:
+                # 已经回复过 socks client
+                self.set_established()
+                self.server.fast_path()
+
             else:  # cmd_connect
                 self.server.write(data)
-                self.set_state(self.STATE_Established)
+                self.set_established()
                 self.server.on_client_established()
         else:
-            self.server.write(data)
             self.set_state(self.STATE_Error)
+            if self.optimistic:
+                # socks client 已经在发送数据, 只能断开连接
+                self.server.transport.loseConnection()
+            else:
+                self.server.write(data)
             self.transport.loseConnection()
 
     def receiveRemoteConnection(self, data):
         log.debug('receiveRemoteConnection {data!r}', data=data)
         self.server.write(data)
-        self.set_state(self.STATE_Established)
+        self.set_established()
         self.server.on_client_established()
 
     def modify_udp_cmd_response(self, ver, rep):
@@ -213,11 +402,18 @@ class ProxyClient(protocol.Protocol):
     def write(self, data):
         # 加密
         if self.is_state(self.STATE_Established):
-            data = self.shadow.encrypt_data(data)
-        else:
-            data = self.shadow.encrypt_protocol_data(data)
+            self.relay_outbound(data)
 
-        self.transport.write(data)
+        elif self.optimistic:
+            # 命令的回复还没有到, 数据跟在命令后面发送
+            if self._early is not None:
+                self._early.append(self.data_encrypter(data))
+                self.early_ready()
+            else:
+                self.relay_outbound(data)
+
+        else:
+            self.send(self.shadow.encrypt_protocol_data(data))
 
     def is_state(self, state):
         return self._state == state
@@ -226,6 +422,163 @@ class ProxyClient(protocol.Protocol):
         self._state = state
 
 
+class ProxyClientPool(object):
+    """
+    预先连接到 remote 并完成认证的 ProxyClient, 停在 STATE_WaitingCommand 等待使用
+    新的浏览器连接取出一个后直接发送命令, 省去连接和认证的两个往返
+    """
+
+    def __init__(self, factory, proxy_host_port, size=4, idle_timeout=30, refill_delay=1, max_refill_delay=60):
+        self.factory = factory
+        self.reactor = factory.reactor
+        self.proxy_host_port = proxy_host_port
+        self.size = size
+        self.idle_timeout = idle_timeout  # 空闲太久的连接可能已经被中间设备断开, 关闭后重新建立
+        self.refill_delay = refill_delay
+        self.max_refill_delay = max_refill_delay  # 连续失败时补充的间隔加倍, 最多 max_refill_delay 秒
+        self.failures = 0  # 连续失败的连接或认证次数
+
+        self.idle = {}  # client -> 就绪时间, 按就绪的先后排列
+        self._connecting = 0  # 正在连接或认证的数量
+        self._waiting = []  # 池中没有连接时等待的 (server, defer, 开始时间)
+        self._refill_call = None
+        self._sweeper = LoopingCall(self.sweep)
+        self._sweeper.clock = self.reactor
+
+        self.hits = 0
+        self.misses = 0
+        self.wait_time = 0.0  # 未命中时等待连接就绪的总时间
+
+    def start(self):
+        if not self._sweeper.running:
+            self._sweeper.start(max(self.idle_timeout / 2, 1), now=False)
+        self.refill()
+
+    def stop(self):
+        if self._sweeper.running:
+            self._sweeper.stop()
+        if self._refill_call is not None and self._refill_call.active():
+            self._refill_call.cancel()
+        self._refill_call = None
+
+        for client in list(self.idle):
+            client.transport.loseConnection()
+
+    def acquire(self, server):
+        """
+        :return: defer, 结果是已经绑定 server 的 ProxyClient
+        """
+        if self.idle:
+            # 后就绪的连接先用, 先就绪的留给 sweep 超时关闭
+            client, _ = self.idle.popitem()
+            self.hits += 1
+            client.attach(server)
+            self.refill()
+            return defer.succeed(client)
+
+        self.misses += 1
+        d = defer.Deferred()
+        self._waiting.append((server, d, self.reactor.seconds()))
+        self.refill()
+        return d
+
+    def refill(self):
+        if self.failures and self._refill_call is not None and self._refill_call.active():
+            # 退避期间只为等待者建立连接, 不补充空闲连接
+            wanted = len(self._waiting)
+        else:
+            self._refill_call = None
+            # 除了等待者需要的连接, 还要保持 size 个空闲连接
+            wanted = self.size + len(self._waiting)
+
+        while len(self.idle) + self._connecting < wanted:
+            self.connect()
+
+    def schedule_refill(self):
+        if self._refill_call is None:
+            delay = self.refill_delay
+            if self.failures:
+                # remote 不可达或者 token 错误时不要每隔 refill_delay 秒重连一次
+                delay = min(self.refill_delay * 2 ** (self.failures - 1), self.max_refill_delay)
+            self._refill_call = self.reactor.callLater(delay, self.refill)
+
+    def connect(self):
+        self._connecting += 1
+        point = clientFromString(self.reactor, f"tcp:{self.proxy_host_port}:timeout={self.factory.connect_timeout}")
+        d = connectProtocol(point, ProxyClient(pool=self))
+
+        def failed(failure):
+            log.error('pool connect failed: {message}', message=failure.getErrorMessage())
+            self.connect_failed()
+
+        d.addErrback(failed)
+
+    def connect_failed(self):
+        self._connecting -= 1
+        self.failures += 1
+
+        if not self._connecting:
+            # remote 不可达, 不让等待者一直等下去
+            waiting, self._waiting = self._waiting, []
+            for server, d, _ in waiting:
+                d.errback(errors.HostUnreachable())
+
+        self.schedule_refill()
+
+    def auth_failed(self, client):
+        """ remote 拒绝了 token, 之后在 client_lost 中退避重连 """
+        log.error('pool authentication failed, check the token')
+        # 等待者使用同一个 token, 不会成功
+        waiting, self._waiting = self._waiting, []
+        for server, d, _ in waiting:
+            d.errback(errors.LoginAuthenticationFailed())
+
+    def client_ready(self, client):
+        self._connecting -= 1
+        self.failures = 0
+
+        while self._waiting:
+            server, d, start = self._waiting.pop(0)
+            if not server.transport.connected:
+                # 浏览器已经断开, 不能让 defer 一直挂着
+                d.errback(error.ConnectionLost())
+                continue
+
+            self.wait_time += self.reactor.seconds() - start
+            client.attach(server)
+            d.callback(client)
+            return
+
+        self.idle[client] = self.reactor.seconds()
+
+    def client_lost(self, client):
+        if self.idle.pop(client, None) is None:
+            # 还没有完成认证就断开了
+            self.connect_failed()
+        else:
+            self.schedule_refill()
+
+    def sweep(self):
+        now = self.reactor.seconds()
+        for client, ready_time in list(self.idle.items()):
+            if now - ready_time > self.idle_timeout:
+                client.transport.loseConnection()  # client_lost 中补充
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'size': self.size,
+            'idle': len(self.idle),
+            'connecting': self._connecting,
+            'waiting': len(self._waiting),
+            'failures': self.failures,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'avg_wait': self.wait_time / self.misses if self.misses else 0.0,
+        }
+
+
 class UDPProxyClient(protocol.DatagramProtocol):
     """与远端 UDP PROXY 交换数据 加密解密"""
 
@@ -245,14 +598,36 @@ class UDPProxyClient(protocol.DatagramProtocol):
         log.info('start udp {address}', address=self.address)
 
     def datagramReceived(self, data, addr):
+        datagram = self.relay(data, addr)
+        if datagram is not None:
+            self.transport.write(*datagram)
+
+    def datagramsReceived(self, datagrams):
+        """ BatchPort 一次取出的多个数据报, 处理后一次发出 """
+        relay = self.relay
+        out = []
+        for data, addr in datagrams:
+            try:
+                datagram = relay(data, addr)
+            except Exception:
+                # 只丢弃这一个, 比如认证失败的 AEAD 数据报, 同一批的其他数据报照常转发
+                log.failure('drop bad datagram from {address}', address=addr)
+                continue
+            if datagram is not None:
+                out.append(datagram)
+        self.transport.write_batch(out)
+
+    def relay(self, data, addr):
+        """
+        :return: (数据, 发往的地址), 丢弃时返回 None
+        """
         if addr == self.origin_addr:
             # 加密
-            data = self.shadow.encrypt_udp_data(data)
-            self.transport.write(data, self.peer_addr)
+            return self.shadow.encrypt_udp_data(data), self.peer_addr
         elif addr == self.peer_addr:
             # 解密
-            data = self.shadow.decrypt_udp_data(data)
-            self.transport.write(data, self.origin_addr)
+            return self.shadow.decrypt_udp_data(data), self.origin_addr
+        return None
 
     def connectionRefused(self):
         # 如果没有服务器监听我们发送到的地址，则调用。
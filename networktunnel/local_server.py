@@ -3,13 +3,21 @@ import struct
 
 from twisted.internet import defer, protocol
 from twisted.internet.endpoints import clientFromString, connectProtocol
+from twisted.logger import Logger
 
 from config import ConfigManager
 from networktunnel import constants, errors
 from networktunnel.base import BaseSocksServer
+from networktunnel.executor import CryptoExecutor, WriteStats
 from networktunnel.helpers import parse_address
-from networktunnel.local_client import ProxyClient, UDPProxyClient
+from networktunnel.local_client import (ProxyClient, ProxyClientPool,
+                                        UDPProxyClient)
+from networktunnel.mux import DEFAULT_WINDOW, MuxTunnelPool
 from networktunnel.shadow import ShadowProtocol
+from networktunnel.timeouts import TimeoutWheel
+from networktunnel.udp_batch import listen_udp
+
+log = Logger()
 
 
 class TransferServer(BaseSocksServer):
@@ -21,8 +29,33 @@ class TransferServer(BaseSocksServer):
         # 接受 socks client 的数据
         if self.is_state(self.STATE_ESTABLISHED):
             self.client.write(data)
+            return
+
+        # 一次读取可能包含多个握手消息, 或者只有半个消息
+        self._buffer.feed(data)
+        self.process_buffer()
+
+    def process_buffer(self):
+        """ 处理缓冲区中的消息, 等待 remote 时停下, 状态改变后再继续 """
+        while True:
+            if self.is_state(self.STATE_ESTABLISHED):
+                # 和命令一起发送过来的首个数据
+                if self._buffer:
+                    self.client.write(self._buffer.read_all())
+                return
+
+            if self.is_state(self.STATE_ERROR):
+                self.transport.loseConnection()
+                return
 
-        elif self.is_state(self.STATE_CONNECTED):  # 建立了连接
+            message = self.next_message()
+            if message is None:
+                return
+
+            self.protocolDataReceived(message)
+
+    def protocolDataReceived(self, data):
+        if self.is_state(self.STATE_CONNECTED):  # 建立了连接
             # 这个状态下开始建立本地端口转发客户端
             self.negotiate_methods(data)
 
@@ -47,11 +80,18 @@ class TransferServer(BaseSocksServer):
             # STATE_ERROR
             self.log.error('Unexpected data, STATE: {state}', state=self._state)
 
+    def drain_client(self, client):
+        if isinstance(client, ProxyClient):
+            # 先写出合并中和线程池中的数据, 再由 BaseSocksServer 关闭到 remote 的连接
+            return client.flush_writes()
+        return super().drain_client(client)
+
     def on_client_auth_ok(self):
         self.log.info('client authentication success')
         self.write(struct.pack('!BB', self._version, constants.AUTH_ANONYMOUS))
         self.set_state(self.STATE_SENT_AUTHENTICATION_RESULT)
         self.transport.resumeProducing()
+        self.process_buffer()
 
     def on_client_auth_error(self):
         self.log.info('client authentication failure')
@@ -67,6 +107,14 @@ class TransferServer(BaseSocksServer):
     def on_client_established(self):
         self.log.info('local client established')
         self.set_state(self.STATE_ESTABLISHED)
+        self.handshake_done(watch_idle=self.udp_client is None)
+        self.process_buffer()
+        self.fast_path()
+
+    def fast_path(self):
+        """ 转发状态下 socks client 的数据直接交给 client, 不再经过状态判断 """
+        self.dataReceived = self.track_activity(self.client.write)
+        self.write = self.transport.write
 
     def negotiate_methods(self, data: bytes):
         """ 协商 methods """
@@ -125,7 +173,13 @@ class TransferServer(BaseSocksServer):
             raise errors.CommandNotSupported(f"Not implement {cmd} yet!")
 
         def send_command(request):
-            self.client.sendCommand(request)
+            if cmd == constants.CMD_CONNECT and self.factory.pipeline:
+                # 乐观地回复 socks client, 首个数据和命令一起发送给 remote, remote 连接失败时直接断开
+                self.make_reply(constants.SOCKS5_GRANTED)
+                self.client.sendCommand(request, optimistic=True)
+                self.on_client_established()
+            else:
+                self.client.sendCommand(request)
 
         d.addCallback(do_parse)
         d.addCallback(send_command)
@@ -139,15 +193,36 @@ class TransferServer(BaseSocksServer):
         org_host, org_port = parse_address(atyp, data)
 
         self.udp_client = UDPProxyClient(self, addr=(org_host, org_port), atyp=atyp)
-        self.udp_port = self.factory.reactor.listenUDP(0, self.udp_client)
+        self.udp_port = listen_udp(self.factory.reactor, 0, self.udp_client, batch=self.factory.udp_batch)
 
     def start_client(self):
         self.log.info('start client')
 
         self.transport.pauseProducing()
+
+        if self.factory.mux_pool is not None:
+            # 在已经认证的隧道上打开一个流, 省去连接和认证的往返
+            d = self.factory.mux_pool.open_stream(self)
+            d.addCallback(lambda stream: self.on_client_auth_ok())
+            return d
+
+        if self.factory.client_pool is not None:
+            # 连接池中的连接已经完成认证
+            d = self.factory.client_pool.acquire(self)
+            d.addCallback(lambda client: self.on_client_auth_ok())
+            return d
+
         conf = ConfigManager().default
         proxy_host_port = conf.get('local', 'proxy_host_port')
-        point = clientFromString(self.factory.reactor, f"tcp:{proxy_host_port}")
+        point = clientFromString(self.factory.reactor, f"tcp:{proxy_host_port}:timeout={self.factory.connect_timeout}")
+
+        if self.factory.pipeline:
+            # 不等待认证的结果, 认证消息和之后的命令一起发送
+            client = ProxyClient(self, pipeline=True)
+            d = connectProtocol(point, client)
+            d.addErrback(lambda failure: self.on_error(errors.HostUnreachable()))
+            self.on_client_auth_ok()
+            return defer.succeed(client)
 
         d = connectProtocol(point, ProxyClient(self))
 
@@ -167,7 +242,8 @@ class TransferServerFactory(protocol.Factory):
         self.reactor = reactor
         self.num_protocols = 0
 
-        conf = ConfigManager().default
+        config = ConfigManager()
+        conf = config.default
         self.shadow = ShadowProtocol(
             key=conf.get('local', 'key'),
             data_salt=conf.get('local', 'data_salt'),
@@ -175,3 +251,67 @@ class TransferServerFactory(protocol.Factory):
             data_cipher=conf.get('local', 'data_cipher'),
             pro_cipher=conf.get('local', 'pro_cipher'),
         )
+
+        # 握手和连接 remote 使用 [default] timeout, 转发阶段没有数据超过 idle_timeout 秒时关闭, 0 表示不检查
+        self.handshake_timeout = config.getTimeOut()
+        self.connect_timeout = config.getTimeOut()
+        self.idle_timeout = conf.getint('default', 'idle_timeout', fallback=0)
+        self.timeouts = TimeoutWheel(reactor)
+
+        # UDP ASSOCIATE 在 Linux 上用 recvmmsg / sendmmsg 批量收发
+        self.udp_batch = conf.getboolean('local', 'udp_batch', fallback=False)
+
+        # 同一次 reactor 循环中写往隧道的数据合并成一次加密和写入, 0 表示不合并
+        self.coalesce_size = conf.getint('local', 'coalesce_size', fallback=0)
+        self.write_stats = WriteStats()
+
+        self.crypto_executor = None
+        crypto_workers = conf.getint('local', 'crypto_workers', fallback=0)
+        if crypto_workers > 0:
+            self.crypto_executor = CryptoExecutor(
+                reactor,
+                workers=crypto_workers,
+                threshold=conf.getint('local', 'crypto_threshold', fallback=64 * 1024),
+            )
+
+        self.mux_pool = None
+        if conf.getboolean('local', 'mux', fallback=False):
+            self.mux_pool = MuxTunnelPool(
+                self,
+                proxy_host_port=conf.get('local', 'proxy_host_port'),
+                token=conf.get('local', 'token', fallback='').encode(),
+                tunnels=conf.getint('local', 'mux_tunnels', fallback=2),
+                window=conf.getint('local', 'mux_window', fallback=DEFAULT_WINDOW),
+            )
+
+        self.client_pool = None
+        pool_size = conf.getint('local', 'pool_size', fallback=0)
+        if pool_size > 0 and self.mux_pool is None:
+            self.client_pool = ProxyClientPool(
+                self,
+                proxy_host_port=conf.get('local', 'proxy_host_port'),
+                size=pool_size,
+                idle_timeout=conf.getint('local', 'pool_idle_timeout', fallback=30),
+            )
+
+        # 流水线握手需要从连续的密文中切分协议消息, rsa 协议加密时不能使用
+        self.pipeline = conf.getboolean('local', 'pipeline', fallback=False) and self.mux_pool is None
+        self.pipeline_delay = conf.getfloat('local', 'pipeline_delay', fallback=0.05)
+        if self.pipeline and not self.shadow.pro_length_preserving:
+            log.warn('pipeline is not supported with pro_cipher {cipher}', cipher=conf.get('local', 'pro_cipher'))
+            self.pipeline = False
+
+    def startFactory(self):
+        if self.client_pool is not None:
+            self.client_pool.start()
+        if self.crypto_executor is not None:
+            self.crypto_executor.start()
+
+    def stopFactory(self):
+        if self.client_pool is not None:
+            self.client_pool.stop()
+        if self.mux_pool is not None:
+            self.mux_pool.stop()
+        if self.crypto_executor is not None:
+            self.crypto_executor.stop()
+        self.timeouts.stop()
@@ -0,0 +1,633 @@
+import abc
+import struct
+
+from twisted.internet import defer, error, protocol
+from twisted.internet.endpoints import clientFromString, connectProtocol
+from twisted.logger import Logger
+
+from networktunnel import constants, errors
+from networktunnel.base import MAX_MESSAGE_SIZE, MessageBuffer
+from networktunnel.executor import WriteCoalescer, make_pipe
+from networktunnel.flow import read_gate
+from networktunnel.helpers import (create_reply, parse_address,
+                                   socks_request_length)
+
+log = Logger()
+
+# 多路复用隧道中的帧, 在隧道连接的数据通道中传输 (已经过数据加密)
+# +------+-----------+--------+----------+
+# | TYPE | STREAM ID | LENGTH | PAYLOAD  |
+# +------+-----------+--------+----------+
+# |  1   |     4     |   2    | Variable |
+# +------+-----------+--------+----------+
+FRAME_OPEN = 0x01  # 负载是 socks 请求 VER CMD RSV ATYP DST.ADDR DST.PORT
+FRAME_REPLY = 0x02  # 负载是 socks 回复
+FRAME_DATA = 0x03
+FRAME_WINDOW = 0x04  # 负载是 4 字节的窗口增量
+FRAME_CLOSE = 0x05
+
+FRAME_HEADER = struct.Struct('!BIH')
+MAX_FRAME_PAYLOAD = 0xFFFF
+DEFAULT_WINDOW = 256 * 1024
+DEFAULT_MAX_STREAMS = 256  # remote 端每条隧道同时打开的流数上限
+
+
+def mux_request(window: int = DEFAULT_WINDOW) -> bytes:
+    """
+    把隧道连接切换为多路复用模式的命令, 两端的流窗口必须一致, 所以用 DST.ADDR 携带窗口大小
+    """
+    return struct.pack('!4BIH', constants.SOCKS5_VER, constants.CMD_MUX, constants.RSV, constants.ATYP_IPV4, window, 0)
+
+
+def parse_mux_request(data: bytes) -> int:
+    try:
+        window = struct.unpack_from('!I', data, 4)[0]
+    except struct.error:
+        raise errors.ParsingError()
+
+    return window or DEFAULT_WINDOW
+
+
+class FrameParser(object):
+    """ 累积隧道中的数据, 解析出完整的帧, 不完整的帧留到下次 """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes):
+        self._buffer += data
+
+        frames = []
+        pos = 0
+        end = len(self._buffer)
+        header_size = FRAME_HEADER.size
+
+        with memoryview(self._buffer) as view:
+            while end - pos >= header_size:
+                frame_type, stream_id, length = FRAME_HEADER.unpack_from(view, pos)
+                if end - pos - header_size < length:
+                    break
+
+                pos += header_size
+                frames.append((frame_type, stream_id, bytes(view[pos:pos + length])))
+                pos += length
+
+        del self._buffer[:pos]
+        return frames
+
+
+class MuxStream(object, metaclass=abc.ABCMeta):
+    """
+    隧道中的一个流, 两端各有一个本地端点 (浏览器连接或目标服务器连接)
+    发送窗口用完时暂停本地端点的读取, 对端确认后恢复
+    """
+
+    def __init__(self, session, stream_id):
+        self.session = session
+        self.stream_id = stream_id
+        self.producer = None  # 本地端点的 transport
+
+        self.send_window = session.window
+        self._consumed = 0  # 已经交给本地端点但还没有返还给对端的窗口
+        self._credit_paused = False
+        self._producer_paused = False
+        self.closed = False
+
+    # 对端 -> 本地端点
+    @abc.abstractmethod
+    def deliver(self, data):
+        """"""
+
+    def data_received(self, data):
+        self.deliver(data)
+        self._consumed += len(data)
+        self._send_credit()
+
+    def _send_credit(self):
+        if self._credit_paused or self.closed or self._consumed < self.session.window // 2:
+            return
+
+        self.session.send_frame(FRAME_WINDOW, self.stream_id, struct.pack('!I', self._consumed))
+        self._consumed = 0
+
+    # 本地端点 transport 的写缓冲区满时暂停返还窗口, 对端也就停止发送
+    def pauseProducing(self):
+        self._credit_paused = True
+
+    def resumeProducing(self):
+        self._credit_paused = False
+        self._send_credit()
+
+    def stopProducing(self):
+        self.close()
+
+    def reply_received(self, data):
+        # 只有 local 端的流会收到 REPLY, 对端发错了帧, 忽略
+        log.info('unexpected reply for stream {id}', id=self.stream_id)
+
+    # 本地端点 -> 对端
+    def send(self, data):
+        if self.closed:
+            return
+
+        view = memoryview(data)
+        for offset in range(0, len(view), MAX_FRAME_PAYLOAD):
+            self.session.send_frame(FRAME_DATA, self.stream_id, view[offset:offset + MAX_FRAME_PAYLOAD])
+
+        self.send_window -= len(data)
+        if self.send_window <= 0:
+            self.pause_producer()
+
+    def window_update(self, increment):
+        self.send_window += increment
+        if self.send_window > 0 and not self.session.paused:
+            self.resume_producer()
+
+    def pause_producer(self):
+        if self.producer is not None and not self._producer_paused:
+            self._producer_paused = True
+            read_gate(self.producer).pause(self)
+
+    def resume_producer(self):
+        if self.producer is not None and self._producer_paused:
+            self._producer_paused = False
+            read_gate(self.producer).resume(self)
+
+    def close(self):
+        """ 本地端点关闭, 通知对端 """
+        if self.closed:
+            return
+
+        self.closed = True
+        self.session.send_frame(FRAME_CLOSE, self.stream_id, b'')
+        self.session.remove_stream(self)
+
+    def close_received(self):
+        """ 对端关闭了这个流 """
+        self.closed = True
+        self.session.remove_stream(self)
+        self.lose_endpoint()
+
+    @abc.abstractmethod
+    def lose_endpoint(self):
+        """"""
+
+
+class MuxSession(object, metaclass=abc.ABCMeta):
+    """ 一条隧道连接上所有流的集合, 负责帧的收发和分发 """
+
+    def __init__(self, tunnel, window=DEFAULT_WINDOW):
+        self.tunnel = tunnel  # 有 write 方法, 写入的数据会被加密
+        self.window = window
+        self.streams = {}
+        self.paused = False
+        self.broken = False  # 收到错误的帧, 隧道正在关闭
+
+        self._parser = FrameParser()
+
+    def send_frame(self, frame_type, stream_id, payload):
+        self.tunnel.write(b''.join([FRAME_HEADER.pack(frame_type, stream_id, len(payload)), payload]))
+
+    def write(self, data):
+        """ 隧道中解密后的数据 """
+        for frame_type, stream_id, payload in self._parser.feed(data):
+            if self.broken:
+                return
+            self.frame_received(frame_type, stream_id, payload)
+
+    def frame_received(self, frame_type, stream_id, payload):
+        stream = self.streams.get(stream_id)
+
+        if frame_type == FRAME_OPEN:
+            self.open_received(stream_id, payload)
+
+        elif stream is None:
+            # 流已经关闭, 丢弃迟到的帧
+            if frame_type != FRAME_CLOSE:
+                log.debug('frame {type} for unknown stream {id}', type=frame_type, id=stream_id)
+
+        elif frame_type == FRAME_DATA:
+            stream.data_received(payload)
+
+        elif frame_type == FRAME_WINDOW:
+            if len(payload) != 4:
+                self.protocol_error(f'window frame of {len(payload)} bytes for stream {stream_id}')
+                return
+            stream.window_update(struct.unpack('!I', payload)[0])
+
+        elif frame_type == FRAME_REPLY:
+            stream.reply_received(payload)
+
+        elif frame_type == FRAME_CLOSE:
+            stream.close_received()
+
+        else:
+            log.info('unknown frame {type} for stream {id}', type=frame_type, id=stream_id)
+
+    @abc.abstractmethod
+    def open_received(self, stream_id, request):
+        """"""
+
+    def protocol_error(self, message):
+        """ 对端发来不合法的帧, 之后的数据也不可信, 关闭整条隧道 """
+        log.error('mux protocol error: {message}', message=message)
+        self.broken = True
+        self.tunnel.transport.loseConnection()
+
+    def remove_stream(self, stream):
+        self.streams.pop(stream.stream_id, None)
+
+    # 隧道 transport 的写缓冲区满时暂停所有流的本地端点
+    def pauseProducing(self):
+        self.paused = True
+        for stream in list(self.streams.values()):
+            stream.pause_producer()
+
+    def resumeProducing(self):
+        self.paused = False
+        for stream in list(self.streams.values()):
+            if stream.send_window > 0:
+                stream.resume_producer()
+
+    def stopProducing(self):
+        self.connection_lost()
+
+    def connection_lost(self):
+        for stream in list(self.streams.values()):
+            stream.closed = True
+            stream.lose_endpoint()
+        self.streams.clear()
+
+
+# remote 端
+class MuxTargetClient(protocol.Protocol):
+    """ remote 端每个流到目标服务器的连接 """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.early_data = []  # 预热连接交接之前收到的数据
+
+    def connectionMade(self):
+        self.stream.producer = self.transport
+        self.transport.registerProducer(self.stream, True)
+
+    def dataReceived(self, data):
+        self.stream.send(data)
+
+    def connectionLost(self, reason):
+        self.stream.close()
+
+
+class MuxServerStream(MuxStream):
+
+    def __init__(self, session, stream_id):
+        super().__init__(session, stream_id)
+        self.client = None
+
+    def deliver(self, data):
+        if self.client is not None:
+            self.client.transport.write(data)
+
+    def lose_endpoint(self):
+        if self.client is not None and self.client.transport:
+            self.client.transport.loseConnection()
+
+
+class MuxServerSession(MuxSession):
+    """ remote 端, 把隧道中的流分发到各自的目标服务器连接 """
+
+    def __init__(self, server, window=DEFAULT_WINDOW, max_streams=DEFAULT_MAX_STREAMS):
+        super().__init__(server, window)
+        self.server = server
+        self.max_streams = max_streams
+        self.rejected = 0
+        self.transport = self  # BaseSocksServer.connectionLost 会调用 client.transport.loseConnection
+
+    def open_received(self, stream_id, request):
+        if stream_id in self.streams:
+            # 不能覆盖正在使用的流
+            log.info('mux stream {id} already open', id=stream_id)
+            return
+
+        if len(self.streams) >= self.max_streams:
+            # 隧道中的流不经过 connectionslimit, 每条隧道单独限制
+            self.rejected += 1
+            self.send_frame(FRAME_REPLY, stream_id, create_reply(constants.SOCKS5_VER, constants.SOCKS5_REJECTED))
+            return
+
+        stream = MuxServerStream(self, stream_id)
+        self.streams[stream_id] = stream
+
+        try:
+            ver, cmd, rsv, atyp = struct.unpack('!4B', request[:4])
+            if cmd != constants.CMD_CONNECT:
+                raise errors.CommandNotSupported(f"Not support {cmd} in mux stream")
+
+            domain, port = parse_address(atyp, request)
+        except (struct.error, errors.SOCKSError) as e:
+            code = getattr(e, 'code', constants.SOCKS5_GENERAL_FAILURE)
+            self.send_frame(FRAME_REPLY, stream_id, create_reply(constants.SOCKS5_VER, code))
+            stream.close()
+            return
+
+        client = MuxTargetClient(stream)
+        d = self.server.factory.connect(domain, port, client)
+
+        def success(ignored):
+            stream.client = client
+            if stream.closed:
+                client.transport.loseConnection()
+                return
+
+            if self.server.shaper is not None:
+                client.dataReceived = self.server.shaper.wrap(client.transport, stream.send)
+
+            reply = create_reply(constants.SOCKS5_VER, constants.SOCKS5_GRANTED, client.transport.getHost())
+            self.send_frame(FRAME_REPLY, stream_id, reply)
+
+            # 回复之后再发送目标服务器先发送的数据
+            early, client.early_data = client.early_data, []
+            for data in early:
+                client.dataReceived(data)
+
+        def error(failure):
+            log.info('mux stream {id} connect to {domain}:{port} failed', id=stream_id, domain=domain, port=port)
+            if not stream.closed:
+                reply = create_reply(constants.SOCKS5_VER, constants.SOCKS5_HOST_UNREACHABLE)
+                self.send_frame(FRAME_REPLY, stream_id, reply)
+                stream.close()
+
+        d.addCallbacks(success, error)
+
+    def loseConnection(self):
+        self.connection_lost()
+
+
+# local 端
+class MuxClientStream(MuxStream):
+    """ local 端的流, 作为 TransferServer 的 client 使用 """
+
+    def __init__(self, session, stream_id, server):
+        super().__init__(session, stream_id)
+        self.server = server
+        self.server.client = self
+        self.transport = self  # BaseSocksServer.connectionLost 会调用 client.transport.loseConnection
+
+        self.producer = server.transport
+        server.transport.registerProducer(self, True)
+
+    def sendCommand(self, data):
+        self.session.send_frame(FRAME_OPEN, self.stream_id, data)
+
+    def reply_received(self, data):
+        try:
+            _, rep = struct.unpack('!BB', data[:2])
+        except struct.error:
+            rep = constants.SOCKS5_GENERAL_FAILURE
+
+        self.server.write(data)
+        if rep == constants.SOCKS5_GRANTED:
+            self.server.on_client_established()
+        else:
+            self.close()
+            self.lose_endpoint()
+
+    def write(self, data):
+        self.send(data)
+
+    def deliver(self, data):
+        self.server.write(data)
+
+    def loseConnection(self):
+        self.close()
+
+    def lose_endpoint(self):
+        if self.server.transport:
+            self.server.transport.loseConnection()
+
+
+class MuxClientSession(MuxSession):
+
+    def __init__(self, tunnel, window=DEFAULT_WINDOW):
+        super().__init__(tunnel, window)
+        self._next_id = 1
+
+    def open_stream(self, server):
+        stream_id = self._next_id
+        self._next_id += 2  # local 端使用奇数
+
+        stream = MuxClientStream(self, stream_id, server)
+        self.streams[stream_id] = stream
+        return stream
+
+    def open_received(self, stream_id, request):
+        # remote 端不会主动打开流
+        self.send_frame(FRAME_CLOSE, stream_id, b'')
+
+
+class MuxTunnelClient(protocol.Protocol):
+    """
+    local 端到 remote 的隧道连接, 完成认证后发送 CMD_MUX 命令, 之后传输多路复用的帧
+    """
+    STATE_Connected = 0x02
+    STATE_SentAuthentication = 0x05
+    STATE_SentCommand = 0x08
+    STATE_Established = 0x0b
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.shadow = pool.factory.shadow
+        self.session = None
+        self._state = None
+        self._buffer = MessageBuffer()  # 认证和命令的回复可能分成几次到达, 也可能一起到达
+
+        self.data_encrypter = self.shadow.make_data_encrypter()
+        self.data_decrypter = self.shadow.make_data_decrypter()
+        self.relay_inbound = None
+        self.relay_outbound = None
+
+    def connectionMade(self):
+        self._state = self.STATE_Connected
+        token = self.pool.token
+        request = b''.join([struct.pack('!BB', constants.SOCKS5_VER, len(token)), token])
+        self.transport.write(self.shadow.encrypt_protocol_data(request))
+        self._state = self.STATE_SentAuthentication
+
+    def dataReceived(self, data):
+        if self._state == self.STATE_Established:
+            self.relay_inbound(data)
+            return
+
+        if not self.shadow.pro_length_preserving:
+            self.protocolDataReceived(self.shadow.decrypt_protocol_data(data))
+            return
+
+        self._buffer.feed(data)
+        while self._buffer and self._state != self.STATE_Established:
+            if self.transport.disconnecting:
+                return
+
+            ciphertext = self._buffer.peek(MAX_MESSAGE_SIZE - 1)
+            message, used = self.shadow.read_protocol_message(ciphertext, self.message_length)
+            if message is None:
+                return
+
+            self._buffer.skip(used)
+            self.protocolDataReceived(message)
+
+        if self._buffer:
+            self.relay_inbound(self._buffer.read_all())
+
+    def message_length(self, data: bytes):
+        """ 当前状态下期望的协议消息长度 """
+        if self._state == self.STATE_SentAuthentication:
+            return 2
+
+        return socks_request_length(data)
+
+    def protocolDataReceived(self, data):
+        if self._state == self.STATE_SentAuthentication:
+            if data[1:2] != bytes([constants.AUTH_SUCCESS]):
+                log.error('mux tunnel authentication failure')
+                self.transport.loseConnection()
+                return
+
+            self.transport.write(self.shadow.encrypt_protocol_data(mux_request(self.pool.window)))
+            self._state = self.STATE_SentCommand
+
+        elif self._state == self.STATE_SentCommand:
+            if data[1:2] != bytes([constants.SOCKS5_GRANTED]):
+                log.error('remote server does not support mux tunnel')
+                self.transport.loseConnection()
+                return
+
+            self.session = MuxClientSession(self, self.pool.window)
+            executor = self.pool.factory.crypto_executor
+            self.relay_inbound = make_pipe(executor, self.data_decrypter, self.session.write, self.transport)
+            self.relay_outbound = make_pipe(executor, self.data_encrypter, self.transport.write)
+            factory = self.pool.factory
+            if factory.coalesce_size > 0:
+                # 多个流的小帧合并成一次加密和写入
+                self.relay_outbound = WriteCoalescer(self.pool.reactor, self.relay_outbound,
+                                                     factory.coalesce_size, factory.write_stats)
+            self.transport.registerProducer(self.session, True)
+            self._state = self.STATE_Established
+            self.pool.tunnel_ready(self)
+
+    def write(self, data):
+        self.relay_outbound(data)
+
+    def connectionLost(self, reason):
+        log.info('mux tunnel lost: {message}', message=reason.getErrorMessage())
+        if self.session is not None:
+            self.session.connection_lost()
+        self.pool.tunnel_lost(self)
+
+
+class MuxTunnelPool(object):
+    """ local 端保持 N 条已认证的隧道连接, 新的 socks 会话在负载最小的隧道上打开一个流 """
+
+    def __init__(self, factory, proxy_host_port, token, tunnels=2, window=DEFAULT_WINDOW, reconnect_delay=1,
+                 max_reconnect_delay=60):
+        self.factory = factory
+        self.reactor = factory.reactor
+        self.proxy_host_port = proxy_host_port
+        self.token = token
+        self.size = tunnels
+        self.window = window
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay  # 连续失败时重连的间隔加倍, 最多 max_reconnect_delay 秒
+        self.failures = 0  # 连续失败的连接或认证次数
+
+        self.tunnels = []
+        self._connecting = 0  # 正在连接或认证的数量
+        self._waiting = []
+        self._reconnect_call = None
+        self._started = False
+
+    def start(self):
+        self._started = True
+        self._refill()
+
+    def stop(self):
+        self._started = False
+        if self._reconnect_call is not None and self._reconnect_call.active():
+            self._reconnect_call.cancel()
+        self._reconnect_call = None
+
+    def connect(self):
+        self._connecting += 1
+        point = clientFromString(self.reactor, f"tcp:{self.proxy_host_port}:timeout={self.factory.connect_timeout}")
+        d = connectProtocol(point, MuxTunnelClient(self))
+
+        def failed(failure):
+            log.error('mux tunnel connect failed: {message}', message=failure.getErrorMessage())
+            self.connect_failed()
+
+        d.addErrback(failed)
+
+    def connect_failed(self):
+        self._connecting -= 1
+        self.failures += 1
+        self._fail_waiting()
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if not self._started or (self._reconnect_call is not None and self._reconnect_call.active()):
+            return
+
+        delay = self.reconnect_delay
+        if self.failures:
+            # remote 不可达或者 token 错误时不要每隔 reconnect_delay 秒重连一次
+            delay = min(self.reconnect_delay * 2 ** (self.failures - 1), self.max_reconnect_delay)
+        self._reconnect_call = self.reactor.callLater(delay, self._refill)
+
+    def _refill(self):
+        self._reconnect_call = None
+        # 先算好数量, 同步失败的连接不会在这里重试
+        for _ in range(self.size - len(self.tunnels) - self._connecting):
+            self.connect()
+
+    def tunnel_ready(self, tunnel):
+        self._connecting -= 1
+        self.failures = 0
+        self.tunnels.append(tunnel)
+
+        waiting, self._waiting = self._waiting, []
+        for server, d in waiting:
+            if server.transport.connected:
+                d.callback(tunnel.session.open_stream(server))
+            else:
+                # 浏览器已经断开, 不能让 defer 一直挂着
+                d.errback(error.ConnectionLost())
+
+    def tunnel_lost(self, tunnel):
+        if tunnel in self.tunnels:
+            self.tunnels.remove(tunnel)
+            self.schedule_reconnect()
+        else:
+            # 没有完成认证和 CMD_MUX 就断开了
+            self.connect_failed()
+
+    def _fail_waiting(self):
+        if self.tunnels or self._connecting:
+            return
+
+        waiting, self._waiting = self._waiting, []
+        for server, d in waiting:
+            d.errback(errors.HostUnreachable())
+
+    def open_stream(self, server):
+        """
+        :return: defer, 结果是 MuxClientStream
+        """
+        if not self._started:
+            self.start()
+
+        if self.tunnels:
+            tunnel = min(self.tunnels, key=lambda t: len(t.session.streams))
+            return defer.succeed(tunnel.session.open_stream(server))
+
+        d = defer.Deferred()
+        self._waiting.append((server, d))
+        return d
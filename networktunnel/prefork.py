@@ -0,0 +1,208 @@
+import json
+import os
+import socket
+import sys
+
+from twisted.application import service
+from twisted.internet import protocol
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+log = Logger()
+
+HEARTBEAT_FD = 3  # worker 通过这个文件描述符向 supervisor 报告状态
+WORKER_ARG = '--worker'
+
+
+def is_worker():
+    return WORKER_ARG in sys.argv
+
+
+def worker_args(script: str, port: int) -> list:
+    """ supervisor 启动 worker 的命令行 """
+    return [sys.executable, script, WORKER_ARG, str(port)]
+
+
+def worker_port() -> int:
+    return int(sys.argv[sys.argv.index(WORKER_ARG) + 1])
+
+
+def listen_reuseport(reactor, port: int, factory, interface: str = ''):
+    """
+    使用 SO_REUSEPORT 监听端口, 多个 worker 进程绑定同一个端口, 由内核分配连接
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError('SO_REUSEPORT is not supported on this platform')
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((interface, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+
+    # adoptStreamPort 会复制文件描述符, 原来的 socket 可以关闭
+    listening_port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    sock.close()
+
+    return listening_port
+
+
+def run_worker(reactor, factory, port: int, interface: str = '', interval: float = 5):
+    """ worker 进程: 监听端口, 定时向 supervisor 发送心跳 """
+    listen_reuseport(reactor, port, factory, interface)
+
+    heartbeat = os.fdopen(HEARTBEAT_FD, 'w')
+    parent_pid = os.getppid()
+
+    def beat():
+        # supervisor 退出后 worker 也退出
+        if os.getppid() != parent_pid:
+            reactor.stop()
+            return
+
+        try:
+            heartbeat.write(json.dumps({'pid': os.getpid(), 'num_protocols': factory.num_protocols}) + '\n')
+            heartbeat.flush()
+        except OSError:
+            reactor.stop()
+
+    LoopingCall(beat).start(interval)
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.num_protocols = 0
+        self.last_seen = supervisor.reactor.seconds()
+        self._buffer = b''
+
+    def connectionMade(self):
+        self.last_seen = self.supervisor.reactor.seconds()
+        log.info('worker {index} started, pid {pid}', index=self.index, pid=self.transport.pid)
+
+    def childDataReceived(self, childFD, data):
+        if childFD != HEARTBEAT_FD:
+            # worker 的 stdout/stderr 写入 supervisor 的日志
+            for line in data.decode(errors='replace').splitlines():
+                log.info('worker {index}: {line}', index=self.index, line=line)
+            return
+
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        for line in lines:
+            try:
+                status = json.loads(line)
+            except ValueError:
+                continue
+
+            self.num_protocols = status.get('num_protocols', 0)
+            self.last_seen = self.supervisor.reactor.seconds()
+
+    def processEnded(self, reason):
+        log.info('worker {index} ended: {message}', index=self.index, message=reason.getErrorMessage())
+        self.supervisor.worker_ended(self)
+
+    def kill(self):
+        try:
+            self.transport.signalProcess('KILL')
+        except Exception:
+            pass
+
+
+class PreforkSupervisor(object):
+    """
+    启动 N 个 worker 进程, 检查心跳, 崩溃或失去响应的 worker 会被重启
+    """
+
+    def __init__(self, reactor, args, workers: int, interval: float = 5, timeout: float = 15, restart_delay: float = 1):
+        self.reactor = reactor
+        self.args = args  # worker 的命令行, 第一个是可执行文件
+        self.workers = workers
+        self.interval = interval
+        self.timeout = timeout
+        self.restart_delay = restart_delay
+
+        self.processes = {}
+        self.restarts = 0
+        self._restart_calls = {}  # index -> 等待重启的 DelayedCall
+        self._health_check = LoopingCall(self.check_health)
+        self._health_check.clock = reactor
+        self._stopping = False
+
+    @property
+    def num_protocols(self):
+        return sum(process.num_protocols for process in self.processes.values())
+
+    def start(self):
+        self._stopping = False
+        for index in range(self.workers):
+            self.spawn(index)
+
+        self._health_check.start(self.interval, now=False)
+
+    def stop(self):
+        self._stopping = True
+        if self._health_check.running:
+            self._health_check.stop()
+
+        # 还没有重启的 worker 不再启动
+        for call in self._restart_calls.values():
+            if call.active():
+                call.cancel()
+        self._restart_calls = {}
+
+        for process in self.processes.values():
+            try:
+                process.transport.signalProcess('TERM')
+            except Exception:
+                pass
+
+    def spawn(self, index):
+        self._restart_calls.pop(index, None)
+        if self._stopping:
+            return
+
+        process = WorkerProcess(self, index)
+        self.processes[index] = process
+        self.reactor.spawnProcess(
+            process,
+            self.args[0],
+            self.args,
+            env=os.environ,
+            childFDs={0: 'w', 1: 'r', 2: 'r', HEARTBEAT_FD: 'r'},
+        )
+
+    def worker_ended(self, process):
+        if self.processes.get(process.index) is not process:
+            return
+
+        del self.processes[process.index]
+        if not self._stopping:
+            self.restarts += 1
+            self._restart_calls[process.index] = self.reactor.callLater(self.restart_delay, self.spawn, process.index)
+
+    def check_health(self):
+        now = self.reactor.seconds()
+        for process in list(self.processes.values()):
+            if now - process.last_seen > self.timeout:
+                log.warn('worker {index} not responding, restart it', index=process.index)
+                process.kill()  # processEnded 中重启
+
+        log.info('{workers} workers, {num} connections', workers=len(self.processes), num=self.num_protocols)
+
+
+class PreforkService(service.Service):
+
+    def __init__(self, reactor, args, workers):
+        self.supervisor = PreforkSupervisor(reactor, args, workers)
+
+    def startService(self):
+        super().startService()
+        self.supervisor.start()
+
+    def stopService(self):
+        super().stopService()
+        self.supervisor.stop()
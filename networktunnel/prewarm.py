@@ -0,0 +1,175 @@
+from twisted.internet import protocol
+from twisted.logger import Logger
+
+from networktunnel.helpers import LRUCache
+from networktunnel.timeouts import TIMEOUT_IDLE
+
+log = Logger()
+
+
+class _WarmProtocol(protocol.Protocol):
+    """ 预先建立的目标服务器连接, 交给 ProxyClient 之前暂存收到的数据 (server-speaks-first 的协议) """
+
+    def __init__(self, prewarmer, key, target):
+        self.prewarmer = prewarmer
+        self.key = key
+        self.target = target
+        self.received = []
+
+    def connectionMade(self):
+        self.prewarmer.ready(self)
+
+    def dataReceived(self, data):
+        self.received.append(data)
+
+    def connectionLost(self, reason):
+        self.prewarmer.lost(self)
+
+    def on_timeout(self, reason):
+        self.prewarmer.expired += 1
+        self.transport.loseConnection()
+
+    def hand_off(self, proto):
+        """
+        transport 之后的事件直接交给 proto, 已经收到的数据放进 proto.early_data,
+        由 proto 在 SOCKS 回复之后转发, 这时 server 还在握手状态
+        """
+        transport = self.transport
+        transport.protocol = proto
+        proto.makeConnection(transport)
+
+        received, self.received = self.received, []
+        proto.early_data.extend(received)
+
+
+class _Target(object):
+    __slots__ = ('hits', 'last_seen', 'idle', 'connecting')
+
+    def __init__(self):
+        self.hits = 0  # last_seen 之前 idle_timeout 秒内的连续请求数
+        self.last_seen = 0.0
+        self.idle = []  # 就绪的连接, 按就绪的先后排列
+        self.connecting = 0
+
+
+class ConnectionPrewarmer(object):
+    """
+    remote 端对频繁连接的目标 (host, port) 预先建立几个 TCP 连接, 下一个 CONNECT 直接使用, 省去一次握手
+    最近 idle_timeout 秒内请求超过 hot 次的目标才预热, 最多记录 targets 个目标, 超出时淘汰最久没有使用的
+    """
+
+    def __init__(self, reactor, dial, timeouts, sockets=2, targets=64, idle_timeout=10, hot=3):
+        """
+        :param dial: dial(host, port, proto) -> defer, 真正建立连接的函数
+        :param timeouts: 共享的 TimeoutWheel, 空闲超过 idle_timeout 秒的连接关闭
+        :param sockets: 每个目标保持的空闲连接数
+        """
+        self.reactor = reactor
+        self.dial = dial
+        self.timeouts = timeouts
+        self.sockets = sockets
+        self.idle_timeout = idle_timeout
+        self.hot = hot
+        self.targets = LRUCache(capacity=targets)  # (host, port) -> _Target
+
+        self.hits = 0
+        self.misses = 0
+        self.warmed = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def acquire(self, host: str, port: int, proto) -> bool:
+        """
+        有空闲的预热连接时交给 proto
+        :return: False 表示没有可用的连接, 需要自己建立
+        """
+        key = (host, port)
+        target = self._target(key)
+
+        now = self.reactor.seconds()
+        if now - target.last_seen > self.idle_timeout:
+            target.hits = 0
+        target.hits += 1
+        target.last_seen = now
+
+        try:
+            while target.idle:
+                # 后就绪的连接先用, 先就绪的更可能已经被目标服务器关闭
+                warm = target.idle.pop()
+                self.timeouts.cancel(warm)
+                if warm.transport.connected and not warm.transport.disconnecting:
+                    warm.hand_off(proto)
+                    self.hits += 1
+                    return True
+
+            self.misses += 1
+            return False
+        finally:
+            self.refill(key, target)
+
+    def _target(self, key):
+        try:
+            return self.targets.get(key)
+        except KeyError:
+            pass
+
+        if len(self.targets) >= self.targets.capacity:
+            _, evicted = self.targets.cache.popitem(last=False)
+            self.evicted += 1
+            self._close(evicted)
+
+        target = _Target()
+        self.targets.set(key, target)
+        return target
+
+    def refill(self, key, target):
+        if target.hits < self.hot:
+            return
+
+        while len(target.idle) + target.connecting < self.sockets:
+            target.connecting += 1
+            d = self.dial(key[0], key[1], _WarmProtocol(self, key, target))
+            d.addErrback(self._failed, key, target)
+
+    def _failed(self, failure, key, target):
+        target.connecting -= 1
+        log.info('prewarm {host} {port} failed: {message}', host=key[0], port=key[1], message=failure.getErrorMessage())
+
+    def ready(self, warm):
+        target = warm.target
+        target.connecting -= 1
+        if self.targets.cache.get(warm.key) is not target:
+            warm.transport.loseConnection()  # 目标已经被淘汰
+            return
+
+        target.idle.append(warm)
+        self.warmed += 1
+        self.timeouts.schedule(warm, self.idle_timeout, TIMEOUT_IDLE)
+
+    def lost(self, warm):
+        self.timeouts.cancel(warm)
+        if warm in warm.target.idle:
+            warm.target.idle.remove(warm)
+
+    def _close(self, target):
+        idle, target.idle = target.idle, []
+        for warm in idle:
+            self.timeouts.cancel(warm)
+            warm.transport.loseConnection()
+
+    def stop(self):
+        for target in list(self.targets.cache.values()):
+            self._close(target)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'targets': len(self.targets),
+            'idle': sum(len(target.idle) for target in self.targets.cache.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'warmed': self.warmed,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
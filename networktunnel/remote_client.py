@@ -1,7 +1,8 @@
 from twisted.internet import protocol
 from twisted.logger import Logger
 
-from networktunnel.helpers import create_udp_frame, parse_udp_frame
+from networktunnel.flow import read_gate
+from networktunnel.udp_nat import UdpNatTable
 
 log = Logger()
 
@@ -13,6 +14,7 @@ class ProxyClient(protocol.Protocol):
         self.server.client = self
         self.peer_address = None
         self.host_address = None
+        self.early_data = []  # 预热连接交接之前收到的数据
 
     def connectionMade(self):
         self.peer_address = self.transport.getPeer()
@@ -23,11 +25,11 @@ class ProxyClient(protocol.Protocol):
         # flow control (this stops connections from filling
         # this proxy memory when one side produces data at a
         # higher rate than the other can consume).
-        self.transport.registerProducer(self.server.transport, True)
-        self.server.transport.registerProducer(self.transport, True)
+        self.transport.registerProducer(read_gate(self.server.transport), True)
+        self.server.transport.registerProducer(read_gate(self.transport), True)
 
         # For FAST transfer
-        # self.server.dataReceived, self.dataReceived = self.write, self.server.write
+        self.write = self.transport.write
 
         log.info(f'Connect ok to {self.peer_address} request from {self.server.transport.getPeer()}')
 
@@ -36,8 +38,9 @@ class ProxyClient(protocol.Protocol):
                  address=self.peer_address,
                  message=reason.getErrorMessage())
         if self.server is not None and self.server.transport:
-            self.server.transport.loseConnection()
-            self.server = None
+            server, self.server = self.server, None
+            # 合并中和线程池中的数据都写进隧道之后再关闭
+            server.flush_writes().addCallback(lambda ignored: server.transport.loseConnection())
 
     def dataReceived(self, data):
         self.server.write(data)  # 转发数据
@@ -45,6 +48,16 @@ class ProxyClient(protocol.Protocol):
     def write(self, data):
         self.transport.write(data)
 
+    def fast_path(self):
+        """ server 进入转发状态后, 收到的数据直接交给加密管道 """
+        relay = self.server.shaper.wrap(self.transport, self.server.relay_outbound)
+        self.dataReceived = self.server.track_activity(relay)
+
+        # 回复 GRANTED 之后才能转发目标服务器先发送的数据 (如 SMTP / SSH 的 banner)
+        early, self.early_data = self.early_data, []
+        for data in early:
+            self.dataReceived(data)
+
 
 class BindProxyClient(protocol.Protocol):
     def __init__(self, factory, server):
@@ -59,18 +72,20 @@ class BindProxyClient(protocol.Protocol):
         self.host_address = self.transport.getHost()
         log.info(f'wait connect from {self.peer_address}')
 
-        self.transport.registerProducer(self.server.transport, True)
-        self.server.transport.registerProducer(self.transport, True)
+        self.transport.registerProducer(read_gate(self.server.transport), True)
+        self.server.transport.registerProducer(read_gate(self.transport), True)
 
+        self.write = self.transport.write
         self.server.transport.resumeProducing()
 
-        self.on_bind_connect_success()
+        self.server.on_bind_connect_success()
 
     def connectionLost(self, reason):
         log.info(f'Connection lost {self.peer_address} {reason.getErrorMessage()}')
         if self.server is not None and self.server.transport:
-            self.server.transport.loseConnection()
-            self.server = None
+            server, self.server = self.server, None
+            # 合并中和线程池中的数据都写进隧道之后再关闭
+            server.flush_writes().addCallback(lambda ignored: server.transport.loseConnection())
 
     def dataReceived(self, data):
         self.server.write(data)
@@ -78,61 +93,88 @@ class BindProxyClient(protocol.Protocol):
     def write(self, data):
         self.transport.write(data)
 
+    def fast_path(self):
+        relay = self.server.shaper.wrap(self.transport, self.server.relay_outbound)
+        self.dataReceived = self.server.track_activity(relay)
+
 
 class UdpProxyClient(protocol.DatagramProtocol):
     def __init__(self, server, addr, atyp):
         self.server = server
         self.server.client = self
-        self.shadow = self.server.factory.shadow
+        factory = self.server.factory
+        self.shadow = factory.shadow
 
         self.origin_addr = addr
         self.origin_atyp = atyp
         self.host_address = None
 
-        self.allowed_address = {
-            self.origin_addr: self.origin_atyp
-        }
+        self.targets = UdpNatTable(
+            factory.reactor,
+            factory.timeouts,
+            send=self.send_to_target,
+            resolver=factory.resolver,
+            capacity=factory.udp_targets,
+            idle_timeout=factory.udp_idle_timeout,
+        )
 
     def startProtocol(self):
         self.host_address = self.transport.getHost()
         log.info(f'upd start {self.host_address}')
 
-    def datagramReceived(self, data, addr):
-        if addr not in self.allowed_address:
-            log.debug('drop data form: {addr}', addr=addr)
-            return
+    def stopProtocol(self):
+        self.targets.close()
 
+    def datagramReceived(self, data, addr):
+        datagram = self.relay(data, addr)
+        if datagram is not None:
+            self.transport.write(*datagram)
+
+    def datagramsReceived(self, datagrams):
+        """ BatchPort 一次取出的多个数据报, 处理后一次发出 """
+        relay = self.relay
+        out = []
+        for data, addr in datagrams:
+            try:
+                datagram = relay(data, addr)
+            except Exception:
+                # 只丢弃这一个, 比如认证失败的 AEAD 数据报, 同一批的其他数据报照常转发
+                log.failure('drop bad datagram from {address}', address=addr)
+                continue
+            if datagram is not None:
+                out.append(datagram)
+        self.transport.write_batch(out)
+
+    def relay(self, data, addr):
+        """
+        :return: (数据, 发往的地址), 丢弃时返回 None
+        """
         if addr == self.origin_addr:
-            self.receive_from_origin(data)
-        else:
-            self.receive_from_target(data, addr)
+            return self.receive_from_origin(data)
+
+        if self.origin_addr[1] == 0 and addr[0] == self.origin_addr[0]:
+            # 客户端没有给出端口, 第一个来自客户端地址的数据报确定端口
+            self.origin_addr = addr
+            return self.receive_from_origin(data)
+
+        return self.receive_from_target(data, addr)
 
     def receive_from_target(self, data, addr):
         # 封包 -> 发往客户端, data 未加密
-        host, port = addr
-        atyp = self.allowed_address.get(addr)
-
-        data = create_udp_frame(0, atyp, host, port, data)
+        frame = self.targets.inbound(data, addr)
+        if frame is None:
+            log.debug('drop data form: {addr}', addr=addr)
+            return None
 
-        data = self.shadow.encrypt_udp_data(data)
-        self.transport.write(data, self.origin_addr)
+        return self.shadow.encrypt_udp_data(frame), self.origin_addr
 
     def receive_from_origin(self, data):
-        data = self.shadow.decrypt_udp_data(data)
-        # 解包 -> 发往目标服务器
-        frag, atyp, host, port, buff = parse_udp_frame(data)
-
-        remote_addr = (host, port)
-
-        if remote_addr not in self.allowed_address:
-            self.allowed_address.update(remote_addr=atyp)
-
-        if frag != 0:
-            # todo 分片
-            return  # 这里直接丢弃
+        # 解包 -> 发往目标服务器, 不加密
+        return self.targets.outbound(self.shadow.decrypt_udp_data(data))
 
-        # 不加密直接发给目标服务器
-        self.transport.write(data, remote_addr)
+    def send_to_target(self, data, addr):
+        if self.transport is not None:
+            self.transport.write(data, addr)
 
     def connectionRefused(self):
         # 如果没有服务器监听我们发送到的地址，则调用。
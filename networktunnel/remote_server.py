@@ -1,18 +1,32 @@
 # -*- coding: utf-8 -*-
-import socket
 import struct
 
 from twisted.internet import defer, protocol
 from twisted.internet.endpoints import (clientFromString, connectProtocol,
                                         serverFromString)
+from twisted.logger import Logger
 
 from config import ConfigManager
 from networktunnel import constants, errors
-from networktunnel.base import BaseSocksServer
+from networktunnel.admission import AdmissionQueue
+from networktunnel.base import MAX_MESSAGE_SIZE, BaseSocksServer
+from networktunnel.executor import (CryptoExecutor, WriteCoalescer,
+                                    WriteStats, drain, make_pipe)
+from networktunnel.happy_eyeballs import (CONNECT_STAGGER, AddressStats,
+                                          ConnectRace)
 from networktunnel.helpers import get_method, parse_address
+from networktunnel.mux import DEFAULT_MAX_STREAMS, MuxServerSession, parse_mux_request
+from networktunnel.prewarm import ConnectionPrewarmer
 from networktunnel.remote_client import (BindProxyClientFactory, ProxyClient,
                                          UdpProxyClient)
+from networktunnel.resolver import CachingResolver, parse_servers
 from networktunnel.shadow import ShadowProtocol
+from networktunnel.shaping import Shaping
+from networktunnel.splice import SpliceRelay, splice_supported
+from networktunnel.timeouts import TIMEOUT_COMMAND, TIMEOUT_HANDSHAKE, TimeoutWheel
+from networktunnel.udp_batch import listen_udp
+
+log = Logger()
 
 
 class SocksServer(BaseSocksServer):
@@ -23,6 +37,17 @@ class SocksServer(BaseSocksServer):
         self._auth_types = [constants.AUTH_TOKEN]
         self._auth_method = None
 
+        # 连接专用的数据加解密上下文
+        self.data_encrypter = None
+        self.data_decrypter = None
+        self.relay_inbound = None
+        self.relay_outbound = None
+        self.coalescer = None
+        self.outbound_pipe = None  # coalescer 之下的数据管道
+        self.user = None  # 认证通过的 token, 同一个 token 的连接共享限速
+        self.shaper = None
+        self._pending = defer.succeed(None)
+
     def connectionMade(self):
         super().connectionMade()
 
@@ -30,35 +55,87 @@ class SocksServer(BaseSocksServer):
         self.set_state(self.STATE_SENT_METHOD)
         self._auth_method = constants.AUTH_TOKEN
 
+        self.data_encrypter = self.factory.shadow.make_data_encrypter()
+        self.data_decrypter = self.factory.shadow.make_data_decrypter()
+
         self.log.info('Connection made {address}', address=self.peer_address)
 
+        # 超过 connectionslimit 时暂停读取, 排队等待其他连接断开
+        if self.factory.admission is not None:
+            self.factory.admission.request(self, getattr(self.transport, 'server', None))
+
     def connectionLost(self, reason):
         self.log.info('Connection lost {address} {message}',
                       address=self.peer_address,
                       message=reason.getErrorMessage())
+        if self.shaper is not None:
+            self.shaper.stop()
+        if self.factory.admission is not None:
+            self.factory.admission.release(self)
         super().connectionLost(reason)
 
     def dataReceived(self, data):
         # 解密
+        if self.is_state(self.STATE_ESTABLISHED):  # 所有就绪
+            self.relay_inbound(data)
+            return
+
+        if self.factory.shadow.pro_length_preserving:
+            # local 端可能把认证, 命令和首个数据合并在一次写入中发送, 按消息长度切分
+            self._buffer.feed(data)
+            self._pending.addCallback(lambda ignored: self.process_buffer())
+            self._pending.addErrback(self.on_error)
+            return
+
+        # 协议消息可能在线程池中解密 (rsa), 通过 defer 链保证消息的处理顺序
+        self._pending.addCallback(lambda ignored: self.factory.shadow.decrypt_protocol_data_deferred(data))
+        self._pending.addCallback(self.protocolDataReceived)
+        self._pending.addErrback(self.on_error)
+
+    def next_message(self):
+        """ 缓冲区中是密文, 解密前缀后按消息长度切分 """
+        ciphertext = self._buffer.peek(MAX_MESSAGE_SIZE - 1)  # 版本号不在密文中
+        message, used = self.factory.shadow.read_protocol_message(ciphertext, self.message_length)
+        if message is not None:
+            self._buffer.skip(used)
+
+        return message
+
+    def process_buffer(self):
+        """
+        依次处理缓冲区中的协议消息, 每个消息处理完成 (可能需要等待认证或连接) 后再处理下一个
+        :return: defer or None
+        """
         if self.is_state(self.STATE_ESTABLISHED):
-            data = self.factory.shadow.decrypt_data(data)
-        else:
-            data = self.factory.shadow.decrypt_protocol_data(data)
+            # 握手之后的密文是转发数据
+            if self._buffer:
+                self.relay_inbound(self._buffer.read_all())
+            return
 
-        if self.is_state(self.STATE_ESTABLISHED):  # 所有就绪
-            self.client.write(data)
+        if not self._buffer:
+            return
 
-        elif self.is_state(self.STATE_CONNECTED):  # 建立了连接
-            self.negotiate_methods(data)
+        message = self.next_message()
+        if message is None:
+            return  # 等待更多数据, 或者当前状态不接收消息
+
+        d = defer.maybeDeferred(self.protocolDataReceived, message)
+        d.addCallback(lambda ignored: self.process_buffer())
+        return d
+
+    def protocolDataReceived(self, data):
+        """ :return: defer or None, 完成后才处理下一个消息 """
+        if self.is_state(self.STATE_CONNECTED):  # 建立了连接
+            return self.negotiate_methods(data)
 
         elif self.is_state(self.STATE_SENT_METHOD):  # 发送了认证方法
             if self._auth_method == constants.AUTH_TOKEN:
-                self.auth_token(data)
+                return self.auth_token(data)
             else:
                 self.on_error(errors.LoginAuthenticationFailed())
 
         elif self.is_state(self.STATE_SENT_AUTHENTICATION_RESULT):  # 解析命令
-            self.parse_command(data)
+            return self.parse_command(data)
 
         elif self.is_state(self.STATE_ERROR):
             self.transport.loseConnection()
@@ -76,16 +153,55 @@ class SocksServer(BaseSocksServer):
     def write(self, data):
         # 加密
         if self.is_state(self.STATE_ESTABLISHED):
-            data = self.factory.shadow.encrypt_data(data)
+            self.relay_outbound(data)
         else:
-            data = self.factory.shadow.encrypt_protocol_data(data)
-        self.transport.write(data)
+            self.transport.write(self.factory.shadow.encrypt_protocol_data(data))
+
+    def start_relay(self):
+        """ 进入转发状态, 创建两个方向的数据管道 """
+        executor = None if self.factory.shadow.data_is_plain else self.factory.crypto_executor
+        self.relay_inbound = make_pipe(executor, self.data_decrypter, self.client.write, self.transport)
+        self.relay_outbound = self.outbound_pipe = make_pipe(executor, self.data_encrypter, self.transport.write,
+                                                             self.client.transport)
+        if self.factory.coalesce_size > 0:
+            self.coalescer = WriteCoalescer(self.factory.reactor, self.relay_outbound,
+                                            self.factory.coalesce_size, self.factory.write_stats)
+            self.relay_outbound = self.coalescer
+        self.set_state(self.STATE_ESTABLISHED)
+
+        # 快速路径: 实例属性覆盖方法, 之后每个数据块直接进入数据管道, 不再经过状态判断
+        self.shaper = self.factory.shaping.shaper(self.user)
+        self.dataReceived = self.track_activity(self.shaper.wrap(self.transport, self.relay_inbound))
+        self.write = self.relay_outbound
+
+        # 和命令一起发送过来的首个数据
+        if self._buffer:
+            self.relay_inbound(self._buffer.read_all())
+
+    def flush_writes(self):
+        """
+        关闭连接之前写出合并中的数据
+        :return: defer, 线程池中加密的数据也写出之后触发
+        """
+        if self.coalescer is not None:
+            self.coalescer.flush()
+        return drain(self.outbound_pipe)
+
+    def drain_client(self, client):
+        # 隧道关闭时, 线程池中解密的数据写给目标服务器之后再关闭
+        return drain(self.relay_inbound)
+
+    def on_splice_closed(self, inbound, outbound):
+        self.log.info('splice relay closed {address}, {inbound} bytes in, {outbound} bytes out',
+                      address=self.peer_address, inbound=inbound, outbound=outbound)
 
     def on_bind_connect_success(self):
         # 第二个回复在预期的传入连接成功或失败之后发生
         self.log.info('Second response received with bind cmd')
         self.make_reply(constants.SOCKS5_GRANTED, address=self.client.peer_address)
-        self.set_state(self.STATE_ESTABLISHED)
+        self.start_relay()
+        self.client.fast_path()
+        self.handshake_done()
 
     # request
     # +----+----------+----------+
@@ -161,8 +277,11 @@ class SocksServer(BaseSocksServer):
             dd = auth_token(token)
 
             def on_success(result):
+                self.user = token
                 self.write(struct.pack('!BB', self._version, constants.AUTH_SUCCESS))
                 self.set_state(self.STATE_SENT_AUTHENTICATION_RESULT)
+                # local 端连接池中的连接认证之后停在这里等待使用, 不受握手超时限制
+                self.factory.timeouts.schedule(self, self.factory.command_timeout, TIMEOUT_COMMAND)
 
             dd.addCallback(on_success)
 
@@ -188,6 +307,8 @@ class SocksServer(BaseSocksServer):
         """ 解析命令 """
         self.log.info('Parse the request command')
         self.set_state(self.STATE_RECEIVED_COMMAND)
+        # 连接目标服务器重新使用握手超时
+        self.factory.timeouts.schedule(self, self.factory.handshake_timeout, TIMEOUT_HANDSHAKE)
 
         if len(data) < 4:
             return defer.fail(errors.ParsingError())
@@ -209,6 +330,9 @@ class SocksServer(BaseSocksServer):
             if cmd == constants.CMD_UDP_ASSOCIATE:
                 return self.do_udp_associate(domain, port, atyp)  # defer
 
+            if cmd == constants.CMD_MUX:
+                return self.do_mux(data)  # defer
+
             raise errors.CommandNotSupported(f"Not implement {cmd} yet!")
 
         d.addCallback(assign_command)
@@ -227,8 +351,7 @@ class SocksServer(BaseSocksServer):
         # Don't read anything from the connecting client until we have somewhere to send it to.
         self.transport.pauseProducing()
 
-        point = clientFromString(self.factory.reactor, f"tcp:host={domain}:port={port}")
-        d = connectProtocol(point, ProxyClient(self))
+        d = self.factory.connect(domain, port, ProxyClient(self))
 
         def success(ignored):
             self.log.info("connected to {domain}, {port}", domain=domain, port=port)
@@ -237,7 +360,16 @@ class SocksServer(BaseSocksServer):
             self.transport.resumeProducing()
 
             self.make_reply(constants.SOCKS5_GRANTED, address=self.client.host_address)
-            self.set_state(self.STATE_ESTABLISHED)
+            self.start_relay()
+            self.client.fast_path()
+
+            if self.factory.splice and not self.factory.shaping.enabled:
+                # 不需要加密, 之后的数据交给内核转发, 不再经过 Python, 无法检查空闲
+                relay = SpliceRelay(self.factory.reactor, self.transport, self.client.transport, self.on_splice_closed)
+                relay.start()
+                self.handshake_done(watch_idle=False)
+            else:
+                self.handshake_done()
 
         def error(failure):
             raise errors.HostUnreachable()
@@ -283,17 +415,36 @@ class SocksServer(BaseSocksServer):
         self.log.info('do udp associate command')
 
         # fix :: 0.0.0.0
-        if host == socket.inet_aton('0.0.0.0') or host == socket.inet_pton(socket.AF_INET6, '::'):
+        if host in ('0.0.0.0', '::'):
             host = self.peer_address.host
 
         self.udp_client = UdpProxyClient(self, addr=(host, port), atyp=atyp)
-        self.udp_port = self.factory.reactor.listenUDP(0, self.udp_client)
+        self.udp_port = listen_udp(self.factory.reactor, 0, self.udp_client, batch=self.factory.udp_batch)
         self.make_reply(constants.SOCKS5_GRANTED, self.udp_port.getHost())
         self.set_state(self.STATE_ESTABLISHED)
+        self.handshake_done(watch_idle=False)
         self.log.info('udp command success')
 
         return defer.succeed(self.udp_port)
 
+    def do_mux(self, data: bytes):
+        """
+        自定义命令, 这条连接成为多路复用隧道, 之后的数据是 mux 帧, 每个帧属于一个 CONNECT 流
+        :param data: 请求的 DST.ADDR 是 local 端使用的流窗口大小
+        :return: defer
+        """
+        self.log.info('do mux command')
+
+        window = parse_mux_request(data)
+        self.client = MuxServerSession(self, window, self.factory.mux_max_streams)
+        self.make_reply(constants.SOCKS5_GRANTED, self.host_address)
+        self.start_relay()
+        # 隧道写缓冲区满时暂停所有流的目标服务器连接
+        self.transport.registerProducer(self.client, True)
+        self.handshake_done(watch_idle=False)
+
+        return defer.succeed(self.client)
+
 
 class SocksServerFactory(protocol.Factory):
     protocol = SocksServer
@@ -302,7 +453,8 @@ class SocksServerFactory(protocol.Factory):
         self.num_protocols = 0
         self.reactor = reactor
 
-        conf = ConfigManager().default
+        config = ConfigManager()
+        conf = config.default
         self.shadow = ShadowProtocol(
             key=conf.get('remote', 'key'),
             data_salt=conf.get('remote', 'data_salt'),
@@ -310,3 +462,118 @@ class SocksServerFactory(protocol.Factory):
             data_cipher=conf.get('remote', 'data_cipher'),
             pro_cipher=conf.get('remote', 'pro_cipher'),
         )
+
+        # 数据不加密时, CONNECT 会话在 Linux 上可以用 splice 零拷贝转发
+        self.splice = conf.getboolean('remote', 'splice', fallback=False)
+        if self.splice and not (self.shadow.data_is_plain and splice_supported()):
+            log.warn('splice requires data_cipher none and os.splice (Linux, Python 3.10+)')
+            self.splice = False
+
+        # 令牌桶限速, 字节/秒, 0 表示不限速
+        self.shaping = Shaping(
+            reactor,
+            connection_rate=conf.getint('remote', 'connection_rate', fallback=0),
+            user_rate=conf.getint('remote', 'user_rate', fallback=0),
+            global_rate=conf.getint('remote', 'global_rate', fallback=0),
+        )
+
+        # 握手和连接目标服务器使用 [default] timeout, 转发阶段没有数据超过 idle_timeout 秒时关闭, 0 表示不检查
+        self.handshake_timeout = config.getTimeOut()
+        self.connect_timeout = config.getTimeOut()
+        self.idle_timeout = conf.getint('default', 'idle_timeout', fallback=0)
+        # 认证之后等待命令的超时, 必须大于 local 端连接池的 pool_idle_timeout
+        self.command_timeout = conf.getint('remote', 'command_timeout', fallback=120)
+        self.timeouts = TimeoutWheel(reactor)
+
+        # 目标服务器的域名用 twisted.names 异步解析并缓存, 关闭时使用 Twisted 默认的线程池 getaddrinfo
+        self.resolver = None
+        if conf.getboolean('remote', 'dns_cache', fallback=False):
+            self.resolver = CachingResolver(
+                reactor,
+                servers=parse_servers(conf.get('remote', 'dns_servers', fallback='')),
+                capacity=conf.getint('remote', 'dns_cache_size', fallback=4096),
+                negative_ttl=conf.getint('remote', 'dns_negative_ttl', fallback=30),
+                stale_ttl=conf.getint('remote', 'dns_stale_ttl', fallback=300),
+            )
+
+        # 解析出多个地址时并行连接 (Happy Eyeballs), 按每个 IP 最近的连接耗时排序
+        self.connect_stagger = conf.getfloat('remote', 'connect_stagger', fallback=CONNECT_STAGGER)
+        self.address_stats = AddressStats(reactor)
+
+        # 对频繁连接的目标预先建立几个连接, 下一个 CONNECT 直接使用
+        self.prewarmer = None
+        if conf.getboolean('remote', 'prewarm', fallback=False):
+            self.prewarmer = ConnectionPrewarmer(
+                reactor,
+                self.dial,
+                self.timeouts,
+                sockets=conf.getint('remote', 'prewarm_sockets', fallback=2),
+                targets=conf.getint('remote', 'prewarm_targets', fallback=64),
+                idle_timeout=conf.getint('remote', 'prewarm_idle_timeout', fallback=10),
+                hot=conf.getint('remote', 'prewarm_hot', fallback=3),
+            )
+
+        # UDP ASSOCIATE 在 Linux 上用 recvmmsg / sendmmsg 批量收发
+        self.udp_batch = conf.getboolean('remote', 'udp_batch', fallback=False)
+        # 每个 UDP ASSOCIATE 最多记录 udp_targets 个目标, 空闲超过 udp_idle_timeout 秒的目标删除
+        self.udp_targets = conf.getint('remote', 'udp_targets', fallback=256)
+        self.udp_idle_timeout = conf.getint('remote', 'udp_idle_timeout', fallback=60)
+        # 每条 mux 隧道同时打开的流数上限, 超出的 OPEN 回复 REJECTED
+        self.mux_max_streams = conf.getint('remote', 'mux_max_streams', fallback=DEFAULT_MAX_STREAMS)
+
+        # 同时处理的连接数上限, 0 表示不限制
+        self.admission = None
+        connections_limit = conf.getint('remote', 'connectionslimit', fallback=0)
+        if connections_limit > 0:
+            self.admission = AdmissionQueue(
+                reactor,
+                limit=connections_limit,
+                queue_size=conf.getint('remote', 'admission_queue', fallback=connections_limit),
+                timeout=conf.getfloat('remote', 'admission_timeout', fallback=10),
+            )
+
+        # 同一次 reactor 循环中写往隧道的数据合并成一次加密和写入, 0 表示不合并
+        self.coalesce_size = conf.getint('remote', 'coalesce_size', fallback=0)
+        self.write_stats = WriteStats()
+
+        self.crypto_executor = None
+        crypto_workers = conf.getint('remote', 'crypto_workers', fallback=0)
+        if crypto_workers > 0:
+            self.crypto_executor = CryptoExecutor(
+                reactor,
+                workers=crypto_workers,
+                threshold=conf.getint('remote', 'crypto_threshold', fallback=64 * 1024),
+            )
+
+    def connect(self, domain: str, port: int, proto):
+        """
+        连接目标服务器, CONNECT 命令和多路复用的流都从这里发起
+        :return: defer
+        """
+        if self.prewarmer is not None and self.prewarmer.acquire(domain, port, proto):
+            return defer.succeed(proto)
+
+        return self.dial(domain, port, proto)
+
+    def dial(self, domain: str, port: int, proto):
+        if self.resolver is None:
+            point = clientFromString(self.reactor, f"tcp:host={domain}:port={port}:timeout={self.connect_timeout}")
+            return connectProtocol(point, proto)
+
+        def connect(addresses):
+            race = ConnectRace(self.reactor, addresses, port, proto, self.address_stats,
+                               stagger=self.connect_stagger, timeout=self.connect_timeout)
+            return race.start()
+
+        return self.resolver.resolve(domain).addCallback(connect)
+
+    def startFactory(self):
+        if self.crypto_executor is not None:
+            self.crypto_executor.start()
+
+    def stopFactory(self):
+        if self.prewarmer is not None:
+            self.prewarmer.stop()
+        if self.crypto_executor is not None:
+            self.crypto_executor.stop()
+        self.timeouts.stop()
@@ -0,0 +1,187 @@
+import socket
+
+from twisted.internet import defer
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.logger import Logger
+from twisted.names import client, dns, hosts, resolve
+
+from networktunnel import errors
+from networktunnel.helpers import LRUCache
+
+log = Logger()
+
+DNS_TIMEOUT = (1, 3, 11)  # 每次重试的超时, 总共不超过 15 秒
+
+
+def parse_servers(value: str) -> list:
+    """ '8.8.8.8, 1.1.1.1:5353' -> [('8.8.8.8', 53), ('1.1.1.1', 5353)] """
+    servers = []
+    for server in value.split(','):
+        server = server.strip()
+        if not server:
+            continue
+
+        host, _, port = server.rpartition(':') if server.count(':') == 1 else (server, '', '')
+        servers.append((host, int(port or 53)))
+
+    return servers
+
+
+class _Entry(object):
+    """ 缓存的解析结果, addresses 为空表示解析失败 (否定缓存) """
+    __slots__ = ('addresses', 'expires')
+
+    def __init__(self, addresses, expires):
+        self.addresses = addresses
+        self.expires = expires
+
+
+class CachingResolver(object):
+    """
+    remote 端连接目标服务器前的域名解析, 用 twisted.names 异步查询 A 和 AAAA 记录,
+    代替 Twisted 默认在线程池中调用的 getaddrinfo
+
+    - 结果按 TTL 缓存在 LRUCache 中, 解析失败的域名缓存 negative_ttl 秒
+    - 过期 stale_ttl 秒以内的结果继续使用, 同时在后台重新解析
+    - 同一个域名同时只有一个查询, 其他请求等待它的结果
+    """
+
+    def __init__(self, reactor, servers=None, capacity=4096, min_ttl=5, max_ttl=3600,
+                 negative_ttl=30, stale_ttl=300, resolver=None):
+        """
+        :param servers: [(host, port)], 为空时使用 /etc/resolv.conf
+        :param resolver: twisted.names 的 IResolver, 测试时替换
+        """
+        self.reactor = reactor
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+
+        if resolver is None:
+            upstream = client.Resolver(
+                resolv=None if servers else '/etc/resolv.conf',
+                servers=servers or None,
+                timeout=DNS_TIMEOUT,
+                reactor=reactor,
+            )
+            resolver = resolve.ResolverChain([hosts.Resolver(), upstream])
+        self.resolver = resolver
+
+        self.cache = LRUCache(capacity=capacity)
+        self._inflight = {}  # host -> [等待结果的 defer]
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.lookups = 0
+        self.failures = 0
+        self.lookup_time = 0.0
+        self.max_lookup_time = 0.0
+
+    def resolve(self, host: str):
+        """
+        :return: defer, 结果是 IP 地址的列表, IPv4 在前
+        """
+        if isIPAddress(host) or isIPv6Address(host):
+            return defer.succeed([host])
+
+        now = self.reactor.seconds()
+        try:
+            entry = self.cache.get(host)
+        except KeyError:
+            entry = None
+
+        if entry is not None:
+            if now < entry.expires:
+                if not entry.addresses:
+                    self.negative_hits += 1
+                    return defer.fail(errors.HostUnreachable())
+
+                self.hits += 1
+                return defer.succeed(entry.addresses)
+
+            if entry.addresses and now < entry.expires + self.stale_ttl:
+                # 先用旧的结果, 后台刷新
+                self.stale_hits += 1
+                self.lookup(host).addErrback(lambda failure: None)
+                return defer.succeed(entry.addresses)
+
+        self.misses += 1
+        return self.lookup(host)
+
+    def lookup(self, host: str):
+        d = defer.Deferred()
+        waiting = self._inflight.get(host)
+        if waiting is not None:
+            self.coalesced += 1
+            waiting.append(d)
+            return d
+
+        self._inflight[host] = [d]
+        self.lookups += 1
+        start = self.reactor.seconds()
+
+        queries = defer.DeferredList([
+            self.resolver.lookupAddress(host, timeout=DNS_TIMEOUT),
+            self.resolver.lookupIPV6Address(host, timeout=DNS_TIMEOUT),
+        ], consumeErrors=True)
+        queries.addCallback(self._got_answers, host, start)
+        return d
+
+    def _got_answers(self, results, host, start):
+        now = self.reactor.seconds()
+        elapsed = now - start
+        self.lookup_time += elapsed
+        if elapsed > self.max_lookup_time:
+            self.max_lookup_time = elapsed
+
+        ipv4, ipv6, ttl = [], [], self.max_ttl
+        for success, result in results:
+            if not success:
+                continue
+
+            answers, _, _ = result
+            for record in answers:
+                if record.type == dns.A:
+                    ipv4.append(socket.inet_ntop(socket.AF_INET, record.payload.address))
+                elif record.type == dns.AAAA:
+                    ipv6.append(socket.inet_ntop(socket.AF_INET6, record.payload.address))
+                else:
+                    continue
+                ttl = min(ttl, record.ttl)
+
+        addresses = ipv4 + ipv6
+        if addresses:
+            ttl = max(ttl, self.min_ttl)
+            self.cache.set(host, _Entry(addresses, now + ttl))
+        else:
+            self.failures += 1
+            log.info('resolve {host} failed', host=host)
+            entry = self.cache.cache.get(host)
+            if entry is None or not entry.addresses or now >= entry.expires + self.stale_ttl:
+                self.cache.set(host, _Entry([], now + self.negative_ttl))
+
+        for d in self._inflight.pop(host):
+            if addresses:
+                d.callback(addresses)
+            else:
+                d.errback(errors.HostUnreachable())
+
+    def stats(self):
+        requests = self.hits + self.stale_hits + self.negative_hits + self.misses
+        return {
+            'size': len(self.cache),
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'lookups': self.lookups,
+            'failures': self.failures,
+            'hit_ratio': (requests - self.misses) / requests if requests else 0.0,
+            'avg_lookup_time': self.lookup_time / self.lookups if self.lookups else 0.0,
+            'max_lookup_time': self.max_lookup_time,
+        }
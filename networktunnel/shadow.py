@@ -2,9 +2,147 @@ import base64
 import binascii
 import struct
 
-from networktunnel.ciphers import RSAManager, TableManager, ciphers
+from twisted.internet import defer, threads
+
+from networktunnel.ciphers import (AEADCipher, PlainCipher, RSAManager,
+                                   StreamCipher, TableManager, ciphers)
 from networktunnel.helpers import udp_frame_header_length
 
+AEAD_CHUNK_SIZE_MASK = 0x3FFF  # 每个 AEAD 分块的最大负载
+
+
+# AEAD 数据流格式, salt 在每个方向上只发送一次
+# +--------+---------------+-------+----------------+-------+-----+
+# |  SALT  | LENGTH(加密)  |  TAG  | PAYLOAD(加密)  |  TAG  | ... |
+# +--------+---------------+-------+----------------+-------+-----+
+# |Variable|       2       |   N   |    Variable    |   N   | ... |
+# +--------+---------------+-------+----------------+-------+-----+
+class AEADStreamEncrypter(object):
+    """ 把连续的数据切分成 AEAD 分块并加密 """
+
+    def __init__(self, cipher_manager: AEADCipher):
+        # 每个连接使用随机 salt, 避免不同连接和不同方向之间 nonce 重复
+        self.salt, self._encrypt = cipher_manager.make_encrypter()
+        self._salt_sent = False
+
+    def __call__(self, data: bytes) -> bytes:
+        chunks = []
+        if not self._salt_sent:
+            chunks.append(self.salt)
+            self._salt_sent = True
+
+        view = memoryview(data)
+        for offset in range(0, len(view), AEAD_CHUNK_SIZE_MASK):
+            payload = view[offset:offset + AEAD_CHUNK_SIZE_MASK]
+            chunks.extend(self._encrypt(struct.pack('!H', len(payload))))
+            chunks.extend(self._encrypt(payload))
+
+        return b''.join(chunks)
+
+
+class AEADStreamDecrypter(object):
+    """
+    累积不完整的 AEAD 分块, 每次调用时一次性解密所有完整的分块,
+    缓冲区预先分配, 只有剩余的不完整分块才会被移动到缓冲区开头
+    """
+
+    def __init__(self, cipher_manager: AEADCipher, buffer_size: int = 64 * 1024):
+        self._manager = cipher_manager
+        self._decrypt = None  # 收到 salt 之后创建
+        self._tag_size = cipher_manager.TAG_SIZE
+        self._payload_length = None  # 已解密长度头, 等待负载
+
+        self._buffer = bytearray(buffer_size)
+        self._end = 0
+
+    def _feed(self, data: bytes):
+        end = self._end + len(data)
+        if end > len(self._buffer):
+            self._buffer.extend(bytes(end - len(self._buffer)))
+        self._buffer[self._end:end] = data
+        self._end = end
+
+    def __call__(self, data: bytes) -> bytes:
+        self._feed(data)
+
+        plaintext = []
+        pos = 0
+        tag_size = self._tag_size
+
+        with memoryview(self._buffer) as view:
+            if self._decrypt is None:
+                salt_size = self._manager.SALT_SIZE
+                if self._end < salt_size:
+                    return b''
+                self._decrypt = self._manager.make_decrypter(bytes(view[:salt_size]))
+                pos = salt_size
+
+            while True:
+                if self._payload_length is None:
+                    if self._end - pos < 2 + tag_size:
+                        break
+                    length = self._decrypt(view[pos:pos + 2], view[pos + 2:pos + 2 + tag_size])
+                    self._payload_length = struct.unpack('!H', length)[0] & AEAD_CHUNK_SIZE_MASK
+                    pos += 2 + tag_size
+
+                end = pos + self._payload_length + tag_size
+                if end > self._end:
+                    break
+
+                plaintext.append(self._decrypt(view[pos:end - tag_size], view[end - tag_size:end]))
+                self._payload_length = None
+                pos = end
+
+            # 只移动剩余的不完整分块
+            rest = self._end - pos
+            if pos and rest:
+                view[:rest] = view[pos:self._end]
+            self._end = rest
+
+        return b''.join(plaintext)
+
+
+# 流加密数据流格式, IV 在每个方向上只发送一次
+# +--------+-------------------+
+# |   IV   |   PAYLOAD(加密)   |
+# +--------+-------------------+
+# |Variable|      Variable     |
+# +--------+-------------------+
+class StreamEncrypter(object):
+    """ 流加密的数据流, 每个连接每个方向使用随机 IV, 在第一块密文前面发送 """
+
+    def __init__(self, cipher_manager: StreamCipher):
+        self.iv, self._encrypt = cipher_manager.make_encrypter()
+        self._iv_sent = False
+
+    def __call__(self, data: bytes) -> bytes:
+        if not self._iv_sent:
+            self._iv_sent = True
+            return b''.join([self.iv, self._encrypt(data)])
+        return self._encrypt(data)
+
+
+class StreamDecrypter(object):
+    """ 先收集完整的 IV, 之后的数据直接解密 """
+
+    def __init__(self, cipher_manager: StreamCipher):
+        self._manager = cipher_manager
+        self._decrypt = None
+        self._iv = b''
+
+    def __call__(self, data: bytes) -> bytes:
+        if self._decrypt is not None:
+            return self._decrypt(data)
+
+        iv_size = self._manager.IV_SIZE
+        self._iv += bytes(data)
+        if len(self._iv) < iv_size:
+            return b''
+
+        self._decrypt = self._manager.make_decrypter(self._iv[:iv_size])
+        rest, self._iv = self._iv[iv_size:], b''
+        return self._decrypt(rest)
+
 
 class ShadowProtocol(object):
 
@@ -12,25 +150,80 @@ class ShadowProtocol(object):
         data_cip_cls = ciphers.get(data_cipher)
         pro_cip_cls = ciphers.get(pro_cipher)
 
-        if data_cip_cls in (RSAManager, TableManager):
+        if data_cip_cls in (RSAManager, TableManager, PlainCipher):
             self.data_salt = data_salt
         else:
             self.data_salt = binascii.a2b_hex(base64.b64decode(data_salt.encode()))
 
         self.data_cipher_manager = data_cip_cls(key)
+        self.data_is_aead = isinstance(self.data_cipher_manager, AEADCipher)
+        if self.data_is_aead:
+            self.data_cipher_manager.pin_salt(self.data_salt)
+        self.data_is_plain = isinstance(self.data_cipher_manager, PlainCipher)
+        self.data_is_stream = isinstance(self.data_cipher_manager, StreamCipher)
 
-        if pro_cip_cls in (RSAManager, TableManager):
+        if pro_cip_cls in (RSAManager, TableManager, PlainCipher):
             self.pro_salt = pro_salt
         else:
             self.pro_salt = binascii.a2b_hex(base64.b64decode(pro_salt.encode()))
 
         self.pro_cipher_manager = pro_cip_cls(key)
+        if isinstance(self.pro_cipher_manager, AEADCipher):
+            # 协议消息都用配置的 pro_salt
+            self.pro_cipher_manager.pin_salt(self.pro_salt)
+        self.pro_offload_decrypt = getattr(self.pro_cipher_manager, 'offload_decrypt', False)
+        # 流加密和置换表加密时密文长度等于明文长度, 可以从连续的密文中切分出协议消息
+        self.pro_length_preserving = not self.pro_offload_decrypt and \
+            not isinstance(self.pro_cipher_manager, AEADCipher)
+
+    def make_data_encrypter(self):
+        """
+        创建一个连接专用的数据加密上下文, 握手时创建一次, 之后随数据流推进,
+        避免每个数据块都重建 cipher 并从同一个 IV 重新开始
+        """
+        if self.data_is_aead:
+            return AEADStreamEncrypter(self.data_cipher_manager)
+        if self.data_is_stream:
+            return StreamEncrypter(self.data_cipher_manager)
+        return self.data_cipher_manager.make_decrypter(self.data_salt)
+
+    def make_data_decrypter(self):
+        """ 与 make_data_encrypter 对应的连接专用数据解密上下文 """
+        if self.data_is_aead:
+            return AEADStreamDecrypter(self.data_cipher_manager)
+        if self.data_is_stream:
+            return StreamDecrypter(self.data_cipher_manager)
+        _, decrypt = self.data_cipher_manager.make_encrypter(self.data_salt)
+        return decrypt
 
     def decrypt_data(self, message):
+        if self.data_is_aead:
+            # 数据报模式: SALT + 密文 + TAG
+            salt_size = self.data_cipher_manager.SALT_SIZE
+            tag_size = self.data_cipher_manager.TAG_SIZE
+            if len(message) < salt_size + tag_size:
+                raise ValueError('AEAD datagram too short')
+            decrypt = self.data_cipher_manager.make_decrypter(message[:salt_size])
+            return decrypt(message[salt_size:-tag_size], message[-tag_size:])
+
+        if self.data_is_stream:
+            # 数据报模式: IV + 密文
+            iv_size = self.data_cipher_manager.IV_SIZE
+            return self.data_cipher_manager.make_decrypter(message[:iv_size])(message[iv_size:])
+
         _, encrypt = self.data_cipher_manager.make_encrypter(self.data_salt)
         return encrypt(message)
 
     def encrypt_data(self, ciphertext):
+        if self.data_is_aead:
+            # 每个数据报使用随机 salt 派生子密钥, nonce 从 0 开始也不会重复
+            salt, encrypt = self.data_cipher_manager.make_encrypter()
+            return b''.join([salt, *encrypt(ciphertext)])
+
+        if self.data_is_stream:
+            iv, encrypt = self.data_cipher_manager.make_encrypter()
+            return b''.join([iv, encrypt(ciphertext)])
+
         decrypt = self.data_cipher_manager.make_decrypter(self.data_salt)
         return decrypt(ciphertext)
 
@@ -50,13 +243,37 @@ class ShadowProtocol(object):
         message = self.decrypt_protocol(ciphertext)
         return b''.join([b'\x05', message])  # 解密后加上第一位版本号
 
+    def read_protocol_message(self, ciphertext, message_length):
+        """
+        从握手阶段累积的密文中取出第一个协议消息, 后面可能紧跟着下一个消息或转发数据
+        每个消息使用新的 cipher 加密, 流加密可以只解密前缀, 只适用于 pro_length_preserving
+        :param message_length: 根据明文计算消息长度的函数, 数据不完整时返回 None
+        :return: (消息, 消耗的密文长度), 数据不完整时返回 (None, 0)
+        """
+        message = self.decrypt_protocol_data(ciphertext)
+        length = message_length(message)
+        if length is None or length > len(message):
+            return None, 0
+
+        return message[:length], length - 1  # 版本号不在密文中
+
+    def decrypt_protocol_data_deferred(self, ciphertext):
+        """
+        rsa 私钥运算会阻塞 reactor, 放到线程池中解密, 其它 cipher 直接同步解密
+        :return: defer
+        """
+        if self.pro_offload_decrypt:
+            return threads.deferToThread(self.decrypt_protocol_data, ciphertext)
+
+        return defer.maybeDeferred(self.decrypt_protocol_data, ciphertext)
+
     def encrypt_udp_data(self, message):
         atyp = ord(message[3:4])
         header_length = udp_frame_header_length(atyp, message)
 
         # 去除头3位无用的数据后再加密
         secret_header_data = self.encrypt_protocol(message[3:header_length])
-        secret_data = self.encrypt_data(message[4:])
+        secret_data = self.encrypt_data(message[header_length:])
 
         return b''.join([
             bytes([len(secret_header_data)]),
@@ -0,0 +1,119 @@
+import weakref
+
+from networktunnel.flow import read_gate
+
+
+class TokenBucket(object):
+    """
+    令牌桶, rate 字节/秒, 最多积累 burst 个令牌
+    令牌可以透支, 透支后返回需要暂停的时间, 每个数据块只有几次浮点运算
+    """
+
+    def __init__(self, clock, rate: float, burst: float = None):
+        self.clock = clock
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = clock.seconds()
+
+    def consume(self, size: int) -> float:
+        """
+        扣除 size 个令牌
+        :return: 需要暂停读取的秒数, 0 表示不需要暂停
+        """
+        now = self.clock.seconds()
+        tokens = self.tokens + (now - self.updated) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+
+        self.updated = now
+        self.tokens = tokens - size
+
+        if self.tokens >= 0:
+            return 0.0
+
+        return -self.tokens / self.rate
+
+
+class ConnectionShaper(object):
+    """
+    一个会话使用的所有令牌桶 (连接, 用户, 全局), 数据转发之后扣除令牌,
+    透支时通过 ReadGate 暂停读取, 到时间后释放, 对端流控的暂停不受影响
+    """
+
+    def __init__(self, reactor, buckets):
+        self.reactor = reactor
+        self.buckets = buckets
+        self._paused = {}  # transport -> DelayedCall
+
+    def wrap(self, transport, sink):
+        """ 包装转发函数, 没有限速时直接返回 sink """
+        if not self.buckets:
+            return sink
+
+        buckets = self.buckets
+
+        def received(data):
+            sink(data)
+
+            size = len(data)
+            delay = 0.0
+            for bucket in buckets:
+                wait = bucket.consume(size)
+                if wait > delay:
+                    delay = wait
+
+            if delay and transport not in self._paused:
+                read_gate(transport).pause(self)
+                self._paused[transport] = self.reactor.callLater(delay, self._resume, transport)
+
+        return received
+
+    def _resume(self, transport):
+        del self._paused[transport]
+        read_gate(transport).resume(self)
+
+    def stop(self):
+        for call in self._paused.values():
+            if call.active():
+                call.cancel()
+        self._paused.clear()
+
+
+class Shaping(object):
+    """
+    factory 持有的限速配置, 每个会话得到自己的 ConnectionShaper
+    同一个 token 的所有连接共享一个桶, 没有连接使用时自动释放
+    """
+
+    def __init__(self, reactor, connection_rate=0, user_rate=0, global_rate=0, burst_seconds=1.0):
+        self.reactor = reactor
+        self.connection_rate = connection_rate
+        self.user_rate = user_rate
+        self.burst_seconds = burst_seconds
+
+        self.global_bucket = self.new_bucket(global_rate) if global_rate > 0 else None
+        self.user_buckets = weakref.WeakValueDictionary()
+
+    @property
+    def enabled(self):
+        return bool(self.connection_rate or self.user_rate or self.global_bucket)
+
+    def new_bucket(self, rate):
+        return TokenBucket(self.reactor, rate, rate * self.burst_seconds)
+
+    def shaper(self, user=None):
+        buckets = []
+        if self.connection_rate > 0:
+            buckets.append(self.new_bucket(self.connection_rate))
+
+        if self.user_rate > 0 and user is not None:
+            bucket = self.user_buckets.get(user)
+            if bucket is None:
+                bucket = self.user_buckets[user] = self.new_bucket(self.user_rate)
+            buckets.append(bucket)
+
+        if self.global_bucket is not None:
+            buckets.append(self.global_bucket)
+
+        return ConnectionShaper(self.reactor, buckets)
@@ -0,0 +1,227 @@
+import os
+import socket
+
+from twisted.logger import Logger
+
+log = Logger()
+
+SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+PIPE_SIZE = 64 * 1024  # 默认的管道容量
+MAX_ROUNDS = 16  # 每次事件最多搬运的次数, 避免一个连接占用 reactor
+
+
+def splice_supported() -> bool:
+    return hasattr(os, 'splice') and hasattr(os, 'pipe2')
+
+
+class _Endpoint(object):
+    """
+    注册到 reactor 的 socket, 读事件属于以它为源的方向, 写事件属于以它为目标的方向
+    """
+
+    def __init__(self, relay, transport):
+        self.relay = relay
+        self.transport = transport
+        self.fd = transport.fileno()
+        self.source = None
+        self.sink = None
+
+    def fileno(self):
+        return self.fd
+
+    def logPrefix(self):
+        return 'splice'
+
+    def doRead(self):
+        self.source.pump()
+
+    def doWrite(self):
+        self.sink.pump()
+
+    def connectionLost(self, reason):
+        self.relay.abort()
+
+
+class _Direction(object):
+    """ src -> 管道 -> dst, 管道中有数据时停止读取 src, 实现流控 """
+
+    def __init__(self, relay, src: _Endpoint, dst: _Endpoint):
+        self.relay = relay
+        self.reactor = relay.reactor
+        self.src = src
+        self.dst = dst
+        src.source = self
+        dst.sink = self
+
+        self.pipe_r, self.pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.pending = 0  # 管道中还没有写出的字节数
+        self.bytes = 0
+        self.done = False
+
+        self._reading = False
+        self._writing = False
+
+    def start(self):
+        self.wait_readable()
+
+    def pump(self):
+        if self.done:
+            return
+
+        try:
+            for _ in range(MAX_ROUNDS):
+                if self.pending:
+                    try:
+                        n = os.splice(self.pipe_r, self.dst.fd, self.pending, flags=SPLICE_FLAGS)
+                    except BlockingIOError:
+                        self.wait_writable()
+                        return
+
+                    self.pending -= n
+                    self.bytes += n
+                    continue
+
+                self.wait_readable()
+                try:
+                    n = os.splice(self.src.fd, self.pipe_w, PIPE_SIZE, flags=SPLICE_FLAGS)
+                except BlockingIOError:
+                    return
+
+                if n == 0:
+                    self.finish()
+                    return
+
+                self.pending += n
+
+            # 次数用完时管道中还有数据, 等待可写继续搬运, 只等可读的话对端不再发送就停住了
+            if self.pending:
+                self.wait_writable()
+        except OSError as e:
+            log.info('splice relay error: {message}', message=e)
+            self.relay.abort()
+
+    def wait_readable(self):
+        if self._writing:
+            self._writing = False
+            self.reactor.removeWriter(self.dst)
+        if not self._reading:
+            self._reading = True
+            self.reactor.addReader(self.src)
+
+    def wait_writable(self):
+        if self._reading:
+            self._reading = False
+            self.reactor.removeReader(self.src)
+        if not self._writing:
+            self._writing = True
+            self.reactor.addWriter(self.dst)
+
+    def stop(self):
+        if self._reading:
+            self._reading = False
+            self.reactor.removeReader(self.src)
+        if self._writing:
+            self._writing = False
+            self.reactor.removeWriter(self.dst)
+
+    def finish(self):
+        """ src 已经关闭写入, 管道也已经清空, 关闭 dst 的写入 (半关闭) """
+        self.done = True
+        self.stop()
+
+        try:
+            self.dst.transport.socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+        self.relay.direction_done()
+
+    def close(self):
+        self.stop()
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+class SpliceRelay(object):
+    """
+    两个 TCP 连接之间的零拷贝转发, 数据经过内核管道用 os.splice 搬运, 不进入 Python
+    只能用于不需要加密的连接, 接管之前两个 transport 的写缓冲区必须已经清空
+    """
+
+    def __init__(self, reactor, transport_a, transport_b, on_close=None):
+        self.reactor = reactor
+        self.transports = (transport_a, transport_b)
+        self.on_close = on_close  # 关闭后调用 on_close(a_to_b 字节数, b_to_a 字节数)
+
+        self.directions = None
+        self.closed = False
+        self._flush_call = None
+
+    @property
+    def bytes_a_to_b(self):
+        return self.directions[0].bytes if self.directions else 0
+
+    @property
+    def bytes_b_to_a(self):
+        return self.directions[1].bytes if self.directions else 0
+
+    def start(self):
+        """ 等待 Twisted 写完缓冲区中的数据, 然后接管两个 socket """
+        self._flush_call = None
+        if self.closed:
+            return
+
+        if not all(transport.connected for transport in self.transports):
+            self.closed = True
+            return
+
+        for transport in self.transports:
+            # 等待期间不再读取, 之后的数据和 EOF 留在内核中交给 splice
+            # 先注销对端注册的流控, 写缓冲区清空时不会再恢复读取
+            transport.unregisterProducer()
+            transport.stopReading()
+
+        if not all(self.flushed(transport) for transport in self.transports):
+            self._flush_call = self.reactor.callLater(0.01, self.start)
+            return
+
+        for transport in self.transports:
+            transport.stopWriting()
+
+        a, b = (_Endpoint(self, transport) for transport in self.transports)
+        self.directions = (_Direction(self, a, b), _Direction(self, b, a))
+        for direction in self.directions:
+            direction.start()
+
+    def flushed(self, transport):
+        """
+        transport 的写缓冲区是否已经清空
+        Twisted 的 transport 在写缓冲区有数据时注册为 writer, 写完后注销, 这里只用 IReactorFDSet 的公开接口判断
+        """
+        return transport not in self.reactor.getWriters()
+
+    def direction_done(self):
+        if all(direction.done for direction in self.directions):
+            self.close()
+
+    def abort(self):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+
+        if self.directions:
+            for direction in self.directions:
+                direction.close()
+
+        # 交还给 Twisted 关闭, 触发两端协议的 connectionLost
+        for transport in self.transports:
+            transport.loseConnection()
+
+        if self.on_close is not None:
+            self.on_close(self.bytes_a_to_b, self.bytes_b_to_a)
@@ -0,0 +1,81 @@
+import math
+
+from twisted.internet.task import LoopingCall
+
+TIMEOUT_HANDSHAKE = 'handshake'
+TIMEOUT_IDLE = 'idle'
+TIMEOUT_COMMAND = 'command'  # 认证之后等待命令
+
+
+class TimeoutWheel(object):
+    """
+    所有连接共享的超时检查, 超时时间按 interval 秒分槽, 一个 LoopingCall 每次只处理到期的槽,
+    不需要每个连接一个 DelayedCall, 精度为 interval 秒
+    到期时调用 conn.on_timeout(reason), conn 可以在其中重新 schedule
+    """
+
+    def __init__(self, reactor, interval: float = 1.0):
+        self.reactor = reactor
+        self.interval = interval
+        self.now = reactor.seconds()  # 粗粒度的时钟, 每次检查时更新, 转发数据时用来记录活动时间
+
+        self._slots = {}  # 槽号 -> {conn: reason}
+        self._entries = {}  # conn -> 槽号
+        self._loop = LoopingCall(self.sweep)
+        self._loop.clock = reactor
+
+        self.expired = {}  # reason -> 超时关闭的连接数
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, conn, timeout: float, reason: str):
+        """ timeout 秒后超时, 替换 conn 之前的超时, timeout 不大于 0 时只取消 """
+        self.cancel(conn)
+        if timeout <= 0:
+            return
+
+        self.now = self.reactor.seconds()
+        slot = math.ceil((self.now + timeout) / self.interval)
+        self._slots.setdefault(slot, {})[conn] = reason
+        self._entries[conn] = slot
+
+        if not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def cancel(self, conn):
+        slot = self._entries.pop(conn, None)
+        if slot is None:
+            return
+
+        entries = self._slots[slot]
+        del entries[conn]
+        if not entries:
+            del self._slots[slot]
+
+    def sweep(self):
+        self.now = self.reactor.seconds()
+        current = math.floor(self.now / self.interval)
+
+        for slot in sorted(slot for slot in self._slots if slot <= current):
+            for conn, reason in self._slots.pop(slot).items():
+                del self._entries[conn]
+                conn.on_timeout(reason)
+
+        if not self._entries and self._loop.running:
+            self._loop.stop()
+
+    def expire(self, reason: str):
+        """ 记录一次超时关闭 """
+        self.expired[reason] = self.expired.get(reason, 0) + 1
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def stats(self):
+        return {
+            'watching': len(self._entries),
+            'slots': len(self._slots),
+            'expired': dict(self.expired),
+        }
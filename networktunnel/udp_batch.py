@@ -0,0 +1,201 @@
+import ctypes
+import errno
+import os
+import socket
+import struct
+
+from twisted.internet import udp
+from twisted.logger import Logger
+
+try:
+    from networktunnel.libc import HAS_MMSG, iovec, libc, mmsghdr
+except OSError:  # 没有 glibc
+    HAS_MMSG = False
+
+log = Logger()
+
+BATCH_SIZE = 64  # 每次系统调用最多收发的数据报数
+SOCKADDR_SIZE = 128  # sizeof(struct sockaddr_storage)
+ADDRESS_CACHE_SIZE = 4096
+
+_READ_IGNORE = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNREFUSED)
+
+
+def batch_supported() -> bool:
+    return HAS_MMSG
+
+
+class _Buffers(object):
+    """
+    recvmmsg / sendmmsg 使用的 mmsghdr 数组和数据缓冲区, 按最大数据报长度预先分配
+    reactor 是单线程的, 所有端口共享同一组缓冲区
+    """
+
+    def __init__(self, count, size):
+        self.count = count
+        self.size = size
+        self.data = ctypes.create_string_buffer(count * size)
+        self.names = ctypes.create_string_buffer(count * SOCKADDR_SIZE)
+        self.iovecs = (iovec * count)()
+        self.msgs = (mmsghdr * count)()
+
+        self.msgs_base = ctypes.addressof(self.msgs)
+        self.data_base = ctypes.addressof(self.data)
+        self.names_base = ctypes.addressof(self.names)
+        for i in range(count):
+            self.iovecs[i].iov_base = self.data_base + i * size
+            self.iovecs[i].iov_len = size
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = self.names_base + i * SOCKADDR_SIZE
+            hdr.msg_namelen = SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+
+
+_buffers = {}  # (用途, 最大数据报长度) -> _Buffers
+
+
+def _get_buffers(kind, size):
+    buffers = _buffers.get((kind, size))
+    if buffers is None:
+        buffers = _buffers[(kind, size)] = _Buffers(BATCH_SIZE, size)
+    return buffers
+
+
+class BatchPort(udp.Port):
+    """
+    Linux 上批量收发的 UDP 端口, 一次可读事件用 recvmmsg 取出最多 BATCH_SIZE 个数据报,
+    整批交给 protocol.datagramsReceived([(data, addr)]), protocol 处理后用 write_batch 一次 sendmmsg 发出
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._addresses = {}  # sockaddr -> (host, port)
+        self._sockaddrs = {}  # (host, port) -> sockaddr
+
+    def doRead(self):
+        buffers = _get_buffers('recv', self.maxPacketSize)
+        msgs = buffers.msgs
+        string_at = ctypes.string_at
+
+        read = 0
+        while read < self.maxThroughput:
+            n = libc.recvmmsg(self.fileno(), buffers.msgs_base, buffers.count, socket.MSG_DONTWAIT, None)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err not in _READ_IGNORE:
+                    log.warn('recvmmsg error: {message}', message=os.strerror(err))
+                return
+
+            datagrams = []
+            for i in range(n):
+                hdr = msgs[i].msg_hdr
+                length = msgs[i].msg_len
+                data = string_at(buffers.data_base + i * buffers.size, length)
+                name = string_at(buffers.names_base + i * SOCKADDR_SIZE, hdr.msg_namelen)
+                hdr.msg_namelen = SOCKADDR_SIZE  # 内核改写了地址长度, 下次接收前恢复
+
+                addr = self._addresses.get(name)
+                if addr is None:
+                    addr = self._parse_sockaddr(name)
+                datagrams.append((data, addr))
+                read += length
+
+            try:
+                self.protocol.datagramsReceived(datagrams)
+            except BaseException:
+                log.failure('datagramsReceived error')
+
+            if n < buffers.count:
+                return
+
+    def _parse_sockaddr(self, name):
+        family = struct.unpack_from('=H', name)[0]
+        (port,) = struct.unpack_from('!H', name, 2)
+        if family == socket.AF_INET6:
+            addr = (socket.inet_ntop(socket.AF_INET6, name[8:24]), port)
+        else:
+            addr = (socket.inet_ntop(socket.AF_INET, name[4:8]), port)
+
+        if len(self._addresses) >= ADDRESS_CACHE_SIZE:
+            self._addresses.clear()
+        self._addresses[name] = addr
+        return addr
+
+    def _sockaddr(self, addr):
+        name = self._sockaddrs.get(addr)
+        if name is not None:
+            return name
+
+        host, port = addr
+        try:
+            if self.addressFamily == socket.AF_INET6:
+                name = b''.join([
+                    struct.pack('=H', socket.AF_INET6),
+                    struct.pack('!HI', port, 0),
+                    socket.inet_pton(socket.AF_INET6, host),
+                    struct.pack('=I', 0),
+                ])
+            else:
+                name = b''.join([
+                    struct.pack('=H', socket.AF_INET),
+                    struct.pack('!H', port),
+                    socket.inet_pton(socket.AF_INET, host),
+                    bytes(8),
+                ])
+        except (OSError, TypeError, struct.error):
+            return None  # 不是这个端口能发送的 IP 地址
+
+        if len(self._sockaddrs) >= ADDRESS_CACHE_SIZE:
+            self._sockaddrs.clear()
+        self._sockaddrs[addr] = name
+        return name
+
+    def write_batch(self, datagrams):
+        """ [(data, (host, port))] 一次 sendmmsg 发出, 发送缓冲区满时和 write 一样丢弃 """
+        buffers = _get_buffers('send', self.maxPacketSize)
+        msgs = buffers.msgs
+        memmove = ctypes.memmove
+
+        for offset in range(0, len(datagrams), buffers.count):
+            count = 0
+            for data, addr in datagrams[offset:offset + buffers.count]:
+                name = self._sockaddr(addr)
+                if name is None or len(data) > buffers.size:
+                    if name is not None:
+                        self.write(data, addr)
+                    continue
+
+                memmove(buffers.data_base + count * buffers.size, data, len(data))
+                memmove(buffers.names_base + count * SOCKADDR_SIZE, name, len(name))
+                buffers.iovecs[count].iov_len = len(data)
+                msgs[count].msg_hdr.msg_namelen = len(name)
+                count += 1
+
+            self._send(buffers.msgs_base, count)
+
+    def _send(self, msgs_base, count):
+        sent = 0
+        while sent < count:
+            n = libc.sendmmsg(self.fileno(), msgs_base + sent * ctypes.sizeof(mmsghdr), count - sent, 0)
+            if n >= 0:
+                sent += n
+                continue
+
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            if err != errno.EINTR:
+                sent += 1  # 跳过出错的数据报, 继续发送后面的
+
+
+def listen_udp(reactor, port: int, protocol, interface: str = '', batch: bool = False):
+    """
+    batch 为 True 并且系统支持时使用 BatchPort, protocol 需要实现 datagramsReceived
+    """
+    if batch and HAS_MMSG and hasattr(protocol, 'datagramsReceived'):
+        udp_port = BatchPort(port, protocol, interface, reactor=reactor)
+        udp_port.startListening()
+        return udp_port
+
+    return reactor.listenUDP(port, protocol, interface)
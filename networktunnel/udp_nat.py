@@ -0,0 +1,213 @@
+import socket
+import struct
+from collections import OrderedDict
+
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.logger import Logger
+
+from networktunnel import constants, errors
+from networktunnel.helpers import create_udp_frame, parse_address, udp_frame_header_length
+from networktunnel.timeouts import TIMEOUT_IDLE
+
+log = Logger()
+
+PENDING_LIMIT = 8  # 解析域名期间最多暂存的数据报数
+
+
+def reply_header(addr) -> bytes:
+    """ (ip, port) -> 回复给客户端的 RSV FRAG ATYP ADDR PORT """
+    host, port = addr
+    if isIPv6Address(host):
+        return create_udp_frame(0, constants.ATYP_IPV6, socket.inet_pton(socket.AF_INET6, host), port, b'')
+    return create_udp_frame(0, constants.ATYP_IPV4, socket.inet_aton(host), port, b'')
+
+
+class _Mapping(object):
+    """ 一个目标: 客户端请求中的地址 -> 目标的 (ip, port) """
+    __slots__ = ('table', 'key', 'addr', 'header', 'last_seen', 'pending')
+
+    def __init__(self, table, key):
+        self.table = table
+        self.key = key  # 请求中 ATYP DST.ADDR DST.PORT 的原始字节
+        self.addr = None  # 域名解析完成前为 None
+        self.header = None  # 预先编码的回复头
+        self.last_seen = 0.0
+        self.pending = []  # 解析域名期间收到的数据
+
+    def on_timeout(self, reason):
+        self.table.on_timeout(self, reason)
+
+
+class UdpNatTable(object):
+    """
+    一个 UDP ASSOCIATE 的目标地址表, 两个方向都是一次字典查找:
+
+    - 客户端 -> 目标: 请求头的原始字节 -> 目标的 (ip, port), 域名只在第一次发送时解析
+    - 目标 -> 客户端: (ip, port) -> 预先编码的回复头, 不在表中的来源丢弃
+
+    两个方向都没有数据超过 idle_timeout 秒的目标由共享的 TimeoutWheel 清除,
+    最多 capacity 个目标, 超出时淘汰最久没有发送数据的
+    """
+
+    def __init__(self, reactor, timeouts, send, resolver=None, capacity=256, idle_timeout=60):
+        """
+        :param timeouts: 共享的 TimeoutWheel
+        :param send: send(data, addr), 域名解析完成后发送暂存的数据
+        :param resolver: CachingResolver, 为 None 时使用 reactor.resolve
+        """
+        self.reactor = reactor
+        self.timeouts = timeouts
+        self.send = send
+        self.resolver = resolver
+        self.capacity = capacity
+        self.idle_timeout = idle_timeout
+
+        self.by_request = OrderedDict()  # 请求头 -> _Mapping, 按最近发送的先后排列
+        self.by_addr = {}  # (ip, port) -> _Mapping
+
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.by_request)
+
+    def outbound(self, frame: bytes):
+        """
+        客户端发来的已解密的 UDP 帧
+        :return: (数据, 目标的 (ip, port)), 丢弃或者等待域名解析时返回 None
+        """
+        try:
+            header_length = udp_frame_header_length(frame[3], frame)
+        except (IndexError, errors.AddressNotSupported):
+            self.dropped += 1
+            return None
+
+        if frame[2] != 0:
+            # todo 分片
+            self.dropped += 1
+            return None  # 这里直接丢弃
+
+        key = frame[3:header_length]
+        data = frame[header_length:]
+
+        mapping = self.by_request.get(key)
+        if mapping is None:
+            mapping = self._create(key, frame)
+            if mapping is None:
+                self.dropped += 1
+                return None
+        else:
+            self.by_request.move_to_end(key)
+
+        mapping.last_seen = self.timeouts.now
+        if mapping.addr is None:
+            if len(mapping.pending) < PENDING_LIMIT:
+                mapping.pending.append(data)
+            else:
+                self.dropped += 1
+            return None
+
+        # 同一个目标的另一个请求地址过期时删除了反向记录
+        self.by_addr.setdefault(mapping.addr, mapping)
+        return data, mapping.addr
+
+    def inbound(self, data: bytes, addr):
+        """
+        目标发来的数据
+        :return: 加上回复头的 UDP 帧, 不是已知目标时返回 None
+        """
+        mapping = self.by_addr.get(addr)
+        if mapping is None:
+            self.dropped += 1
+            return None
+
+        mapping.last_seen = self.timeouts.now
+        return mapping.header + data
+
+    def _create(self, key, frame):
+        try:
+            host, port = parse_address(frame[3], frame)
+        except (errors.AddressNotSupported, UnicodeDecodeError, struct.error):
+            return None
+
+        if len(self.by_request) >= self.capacity:
+            _, evicted = self.by_request.popitem(last=False)
+            self.evicted += 1
+            self._forget(evicted)
+
+        mapping = _Mapping(self, key)
+        self.by_request[key] = mapping
+        self.created += 1
+        self.timeouts.schedule(mapping, self.idle_timeout, TIMEOUT_IDLE)
+
+        if isIPAddress(host) or isIPv6Address(host):
+            self._bind(mapping, (host, port))
+            return mapping
+
+        if self.resolver is not None:
+            d = self.resolver.resolve(host)
+        else:
+            d = self.reactor.resolve(host).addCallback(lambda ip: [ip])
+        d.addCallbacks(self._resolved, self._failed, callbackArgs=(mapping, port), errbackArgs=(mapping, host))
+        return mapping
+
+    def _bind(self, mapping, addr):
+        mapping.addr = addr
+        mapping.header = reply_header(addr)
+        self.by_addr[addr] = mapping
+
+    def _resolved(self, addresses, mapping, port):
+        if self.by_request.get(mapping.key) is not mapping:
+            return  # 已经过期或者被淘汰
+
+        self._bind(mapping, (addresses[0], port))
+        pending, mapping.pending = mapping.pending, []
+        for data in pending:
+            self.send(data, mapping.addr)
+
+    def _failed(self, failure, mapping, host):
+        log.info('udp resolve {host} failed: {message}', host=host, message=failure.getErrorMessage())
+        if self.by_request.get(mapping.key) is mapping:
+            self.dropped += len(mapping.pending)
+            self.remove(mapping)
+
+    def on_timeout(self, mapping, reason):
+        # 转发数据时只记录 last_seen, 到期时再计算真正的空闲时间
+        remaining = mapping.last_seen + self.idle_timeout - self.timeouts.now
+        if remaining > 0:
+            self.timeouts.schedule(mapping, remaining, reason)
+            return
+
+        self.expired += 1
+        self.timeouts.expire(reason)
+        self.remove(mapping)
+
+    def remove(self, mapping):
+        if self.by_request.get(mapping.key) is mapping:
+            del self.by_request[mapping.key]
+        self._forget(mapping)
+
+    def _forget(self, mapping):
+        self.timeouts.cancel(mapping)
+        mapping.pending = []
+        # 多个请求地址 (域名和 IP) 可能对应同一个目标, 只删除自己的记录
+        if mapping.addr is not None and self.by_addr.get(mapping.addr) is mapping:
+            del self.by_addr[mapping.addr]
+
+    def close(self):
+        by_request, self.by_request = self.by_request, OrderedDict()
+        for mapping in by_request.values():
+            self._forget(mapping)
+        self.by_addr = {}
+
+    def stats(self):
+        return {
+            'size': len(self.by_request),
+            'addresses': len(self.by_addr),
+            'created': self.created,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'dropped': self.dropped,
+        }
@@ -1,3 +1,4 @@
+import os
 import platform
 
 if platform.system() == 'Linux':
@@ -18,6 +19,8 @@ from twisted.python.logfile import DailyLogFile
 
 from config import ConfigManager
 from networktunnel.logger import textFileLogObserver
+from networktunnel.prefork import (PreforkService, PreforkSupervisor, is_worker,
+                                  run_worker, worker_args, worker_port)
 from networktunnel.remote_server import SocksServerFactory
 from networktunnel.service import TunnelService
 from settings import BASE_DIR
@@ -37,8 +40,14 @@ def get_application():
     tunnel_service.setServiceParent(top_service)
 
     port = conf.getint('remote', 'port', fallback=6778)
-    tcp_service = internet.TCPServer(port, SocksServerFactory(reactor), interface='0.0.0.0')
-    tcp_service.setServiceParent(top_service)
+    workers = conf.getint('remote', 'workers', fallback=0)
+    if workers > 0:
+        # 多进程模式, 每个 worker 使用 SO_REUSEPORT 监听同一个端口
+        prefork_service = PreforkService(reactor, worker_args(os.path.join(BASE_DIR, 'server.py'), port), workers)
+        prefork_service.setServiceParent(top_service)
+    else:
+        tcp_service = internet.TCPServer(port, SocksServerFactory(reactor), interface='0.0.0.0')
+        tcp_service.setServiceParent(top_service)
 
     top_service.setServiceParent(application)
 
@@ -52,8 +61,19 @@ def main():
 
         log.startLogging(sys.stdout)
 
-    endpoint = TCP4ServerEndpoint(reactor, conf.getint('remote', 'ServerPort', fallback=6778))
-    endpoint.listen(SocksServerFactory(reactor))
+    port = conf.getint('remote', 'ServerPort', fallback=6778)
+    workers = conf.getint('remote', 'workers', fallback=0)
+
+    if is_worker():
+        run_worker(reactor, SocksServerFactory(reactor), worker_port())
+    elif workers > 0:
+        supervisor = PreforkSupervisor(reactor, worker_args(os.path.join(BASE_DIR, 'server.py'), port), workers)
+        reactor.callWhenRunning(supervisor.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+    else:
+        endpoint = TCP4ServerEndpoint(reactor, port)
+        endpoint.listen(SocksServerFactory(reactor))
+
     reactor.run()
 
 
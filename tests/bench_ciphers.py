@@ -0,0 +1,131 @@
+# python -m tests.bench_ciphers --output bench.json
+# python -m tests.bench_ciphers --baseline bench.json  # 与上次结果比较
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+
+import Crypto
+
+from networktunnel.ciphers import AEADCipher, ciphers
+from tests.bench_shadow import make_shadow
+
+PAYLOAD_SIZES = (64, 256, 1024, 4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024)
+TINY_MESSAGE = b'\x05\x01\x80'  # 认证方法协商, 最常见的协议小消息
+
+
+def measure(func, min_time):
+    """ 重复调用 func 直到超过 min_time 秒, 返回每次调用的平均秒数 """
+    rounds = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        rounds += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time and rounds >= 3:
+            return elapsed / rounds
+
+
+def host_info():
+    return {
+        'hostname': platform.node(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'system': platform.platform(),
+        'python': sys.version.split()[0],
+        'pycryptodome': Crypto.__version__,
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def bench_cipher(name, min_time):
+    result = {}
+
+    cls = ciphers[name]
+    result['construct_us'] = measure(lambda: cls('bench key'), min_time) * 1e6
+
+    # rsa 只用于协议消息, 不测数据加密
+    protocol_only = getattr(cls, 'offload_decrypt', False)
+    shadow = make_shadow('none' if protocol_only else name, pro_cipher=name)
+
+    result['tiny_message_us'] = measure(lambda: shadow.encrypt_protocol(TINY_MESSAGE), min_time) * 1e6
+    result['tiny_decrypt_us'] = None
+    if not isinstance(shadow.pro_cipher_manager, AEADCipher):
+        # 解密真实的密文, rsa 解密随机数据只会得到 sentinel
+        ciphertext = shadow.encrypt_protocol(TINY_MESSAGE)
+        if protocol_only and shadow.decrypt_protocol(ciphertext) != TINY_MESSAGE:
+            raise RuntimeError(f'{name} protocol round trip failed')
+        result['tiny_decrypt_us'] = measure(lambda: shadow.decrypt_protocol(ciphertext), min_time) * 1e6
+
+    bulk = {}
+    if not protocol_only:
+        result['context_us'] = measure(shadow.make_data_encrypter, min_time) * 1e6
+        encrypt = shadow.make_data_encrypter()
+        for size in PAYLOAD_SIZES:
+            data = os.urandom(size)
+            seconds = measure(lambda: encrypt(data), min_time)
+            bulk[str(size)] = size / seconds / 1024 / 1024
+
+    result['bulk_mbps'] = bulk
+
+    return result
+
+
+def compare(results, baseline, threshold):
+    """ 打印与 baseline 相比的变化, 返回退化的项目数 """
+    regressions = 0
+    for name, result in results.items():
+        old = baseline.get('results', {}).get(name)
+        if not old:
+            continue
+
+        for size, speed in result['bulk_mbps'].items():
+            old_speed = old['bulk_mbps'].get(size)
+            if not speed or not old_speed:
+                continue
+
+            ratio = speed / old_speed
+            flag = ''
+            if ratio < 1 - threshold:
+                flag = 'REGRESSION'
+                regressions += 1
+            print(f'{name:<26}{size:>9}{old_speed:>12.1f}{speed:>12.1f}{ratio:>8.2f} {flag}', file=sys.stderr)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='throughput benchmark of every cipher in the registry')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per measurement')
+    parser.add_argument('--output', help='write JSON result to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON result of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown ratio reported as regression')
+    parser.add_argument('ciphers', nargs='*', default=list(ciphers))
+    args = parser.parse_args()
+
+    report = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'host': host_info(),
+        'payload_sizes': list(PAYLOAD_SIZES),
+        'results': {name: bench_cipher(name, args.min_time) for name in args.ciphers},
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+        if compare(report['results'], baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# python -m tests.bench_executor --connections 8 --size 256
+import argparse
+import os
+import time
+
+from twisted.internet import defer, reactor, task
+
+from networktunnel.executor import CryptoExecutor, make_pipe
+from tests.bench_shadow import make_shadow
+
+CHUNK_SIZE = 256 * 1024
+
+
+@defer.inlineCallbacks
+def relay(shadow, executor, connections, total):
+    """ 每个连接各自的加密管道, 所有连接同时发送, 返回 MB/s """
+    data = os.urandom(CHUNK_SIZE)
+    rounds = max(total // CHUNK_SIZE // connections, 1)
+    received = [0]
+    done = defer.Deferred()
+    expected = rounds * connections * CHUNK_SIZE
+
+    def sink(result):
+        received[0] += len(result)
+        if received[0] >= expected and not done.called:
+            done.callback(None)
+
+    pipes = [make_pipe(executor, shadow.make_data_encrypter(), sink) for _ in range(connections)]
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for pipe in pipes:
+            pipe(data)
+        # 让 reactor 有机会处理线程池返回的结果, 模拟连续的 dataReceived
+        yield task.deferLater(reactor, 0, lambda: None)
+
+    yield done
+    return expected / (time.perf_counter() - start) / 1024 / 1024
+
+
+@defer.inlineCallbacks
+def main(args):
+    total = args.size * 1024 * 1024
+    shadow = make_shadow(args.cipher)
+
+    speed = yield relay(shadow, None, args.connections, total)
+    print(f"{'workers':<10}{'MB/s':>10}")
+    print(f"{'inline':<10}{speed:>10.1f}")
+
+    for workers in range(1, args.max_workers + 1):
+        executor = CryptoExecutor(reactor, workers, threshold=64 * 1024)
+        speed = yield relay(shadow, executor, args.connections, total)
+        executor.stop()
+        print(f'{workers:<10}{speed:>10.1f}')
+
+    reactor.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='inline vs thread pool encryption throughput')
+    parser.add_argument('--cipher', default='aes-256-cfb')
+    parser.add_argument('--connections', type=int, default=8)
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--size', type=int, default=256, help='data size in MB')
+    reactor.callWhenRunning(main, parser.parse_args())
+    reactor.run()
@@ -0,0 +1,79 @@
+# python -m tests.bench_fastpath --chunk 512 --count 200000
+import argparse
+import time
+
+from twisted.internet import reactor
+from twisted.test import proto_helpers
+
+from networktunnel.remote_client import ProxyClient
+from networktunnel.remote_server import SocksServer, SocksServerFactory
+from tests.bench_shadow import make_shadow
+
+
+class NullTransport(proto_helpers.StringTransport):
+    """ 丢弃写入的数据, 只测量协议层的开销 """
+
+    def write(self, data):
+        pass
+
+
+def make_session(cipher):
+    """ remote 端一个已经进入转发状态的 CONNECT 会话 """
+    factory = SocksServerFactory(reactor)
+    factory.shadow = make_shadow(cipher)
+
+    server = factory.buildProtocol(('127.0.0.1', 1080))
+    server.makeConnection(NullTransport())
+    client = ProxyClient(server)
+    client.makeConnection(NullTransport())
+
+    server.start_relay()
+    client.fast_path()
+    return server, client
+
+
+def slow_path(server, client):
+    """ 去掉实例属性, 回到按状态分发的方法 """
+    for proto in (server, client):
+        for name in ('dataReceived', 'write'):
+            proto.__dict__.pop(name, None)
+
+
+def measure(server, client, chunk, count):
+    """ 每个数据块从隧道到目标服务器, 再从目标服务器回到隧道, 返回每块的微秒数 """
+    start = time.perf_counter()
+    for _ in range(count):
+        server.dataReceived(chunk)
+        client.dataReceived(chunk)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='established relay per-chunk overhead')
+    parser.add_argument('--cipher', default='none')
+    parser.add_argument('--chunk', type=int, default=512)
+    parser.add_argument('--count', type=int, default=200000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    chunk = b'x' * args.chunk
+
+    fast = make_session(args.cipher)
+    slow = make_session(args.cipher)
+    slow_path(*slow)
+    assert SocksServer.dataReceived is slow[0].dataReceived.__func__
+
+    # 交替运行, 取最好的一次, 减少预热和噪声的影响
+    before = after = float('inf')
+    for _ in range(args.rounds):
+        before = min(before, measure(*slow, chunk, args.count))
+        after = min(after, measure(*fast, chunk, args.count))
+
+    print(f'cipher: {args.cipher}, chunk: {args.chunk} bytes')
+    print(f'state dispatch: {before:.2f} us/chunk')
+    print(f'fast path:      {after:.2f} us/chunk')
+    print(f'saved:          {before - after:.2f} us/chunk ({(before - after) / before:.0%})')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# python -m tests.bench_shadow --size 100
+import argparse
+import base64
+import binascii
+import json
+import os
+import tempfile
+import time
+
+from Crypto.PublicKey import RSA
+
+from networktunnel.ciphers import ciphers
+from networktunnel.shadow import ShadowProtocol
+from tools.make_password import make_password
+
+CHUNK_SIZE = 16 * 1024
+
+
+def make_salt(cipher_name):
+    """ 生成与 ShadowProtocol 配置格式一致的 salt, table 和 rsa 是临时的 key 文件, 用完后交给 remove_salt 删除 """
+    manager = ciphers[cipher_name]('bench')
+    if cipher_name == 'none':
+        return ''
+
+    if cipher_name == 'table':
+        fd, path = tempfile.mkstemp(suffix='.pem')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(make_password()['encrypt'], fp)
+        return path
+
+    if cipher_name == 'rsa':
+        fd, path = tempfile.mkstemp(suffix='.pem')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(RSA.generate(1024).exportKey())
+        return path
+
+    if manager.is_stream_cipher:
+        salt = manager.random_iv()
+    else:
+        salt = manager.random_salt()
+    return base64.b64encode(binascii.b2a_hex(salt)).decode()
+
+
+def remove_salt(salt):
+    if salt and os.path.isabs(salt) and os.path.exists(salt):
+        os.remove(salt)
+
+
+def make_shadow(data_cipher, pro_cipher='aes-128-cfb'):
+    """ table 和 rsa 第一次使用时才读取 key 文件, 读入缓存后删除临时文件 """
+    salts = []
+    try:
+        salts.append(make_salt(data_cipher))
+        salts.append(make_salt(pro_cipher))
+        shadow = ShadowProtocol(
+            key='bench key',
+            data_salt=salts[0],
+            data_cipher=data_cipher,
+            pro_salt=salts[1],
+            pro_cipher=pro_cipher,
+        )
+        shadow.make_data_encrypter()
+        shadow.encrypt_protocol(b'')
+        return shadow
+    finally:
+        for salt in salts:
+            remove_salt(salt)
+
+
+def relay(encrypt, decrypt, total):
+    """ 模拟一条连接两端: 加密 -> 解密, 返回 MB/s """
+    data = os.urandom(CHUNK_SIZE)
+    rounds = max(total // CHUNK_SIZE, 1)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        decrypt(encrypt(data))
+    elapsed = time.perf_counter() - start
+
+    return rounds * CHUNK_SIZE / elapsed / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description='per-chunk vs per-connection cipher contexts')
+    parser.add_argument('--size', type=int, default=100, help='relay size in MB')
+    parser.add_argument('ciphers', nargs='*', default=['aes-128-cfb', 'aes-256-cfb', 'chacha20', 'salsa20', 'rc4', 'table'])
+    args = parser.parse_args()
+
+    total = args.size * 1024 * 1024
+
+    print(f"{'cipher':<14}{'per-chunk MB/s':>16}{'persistent MB/s':>18}")
+    for name in args.ciphers:
+        shadow = make_shadow(name)
+        per_chunk = relay(shadow.encrypt_data, shadow.decrypt_data, total)
+        persistent = relay(shadow.make_data_encrypter(), shadow.make_data_decrypter(), total)
+        print(f'{name:<14}{per_chunk:>16.1f}{persistent:>18.1f}')
+
+
+if __name__ == "__main__":
+    main()
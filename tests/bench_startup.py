@@ -0,0 +1,53 @@
+# python -m tests.bench_startup --users 10000 --keys 10000
+import argparse
+import time
+
+from networktunnel.ciphers import bytes_to_key
+from networktunnel.shadow import ShadowProtocol
+from tests.bench_shadow import make_salt, remove_salt
+
+
+def load_users(users, keys, data_salt, pro_salt, data_cipher, pro_cipher):
+    """ 模拟为每个配置的用户构建一个 ShadowProtocol, 返回耗时 """
+    start = time.perf_counter()
+    for index in range(users):
+        ShadowProtocol(
+            key=f'user key {index % keys}',
+            data_salt=data_salt,
+            data_cipher=data_cipher,
+            pro_salt=pro_salt,
+            pro_cipher=pro_cipher,
+        )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='factory start-up time with many configured users')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--keys', type=int, default=10000, help='distinct keys among the users')
+    parser.add_argument('--data-cipher', default='aes-256-cfb')
+    parser.add_argument('--pro-cipher', default='aes-128-cfb')
+    args = parser.parse_args()
+
+    data_salt = make_salt(args.data_cipher)
+    pro_salt = make_salt(args.pro_cipher)
+
+    def run():
+        return load_users(args.users, args.keys, data_salt, pro_salt, args.data_cipher, args.pro_cipher)
+
+    try:
+        bytes_to_key.cache_clear()
+        cold = run()
+        info = bytes_to_key.cache_info()
+        warm = run()
+    finally:
+        remove_salt(data_salt)
+        remove_salt(pro_salt)
+
+    print(f'users: {args.users}, distinct keys: {args.keys}')
+    print(f'cold start: {cold * 1000:.1f} ms, derivations: {info.misses}')
+    print(f'warm start: {warm * 1000:.1f} ms, derivations: {bytes_to_key.cache_info().misses - info.misses}')
+
+
+if __name__ == "__main__":
+    main()
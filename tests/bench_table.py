@@ -0,0 +1,40 @@
+# python -m tests.bench_table
+import os
+import time
+
+from networktunnel.ciphers import TableCipher, TranslateTableCipher
+from tools.make_password import make_password
+
+CHUNK_SIZES = (1024, 16 * 1024, 256 * 1024)
+TOTAL_BYTES = 16 * 1024 * 1024
+
+
+def throughput(encrypt, chunk_size, total=TOTAL_BYTES):
+    """ 返回 MB/s """
+    data = os.urandom(chunk_size)
+    rounds = max(total // chunk_size, 1)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        encrypt(data)
+    elapsed = time.perf_counter() - start
+
+    return rounds * chunk_size / elapsed / 1024 / 1024
+
+
+def main():
+    password = make_password()['encrypt']
+    engines = [
+        ('reference', TableCipher(password), TOTAL_BYTES // 16),  # 逐字节实现太慢, 减少数据量
+        ('translate', TranslateTableCipher(password), TOTAL_BYTES),
+    ]
+
+    print(f"{'engine':<12}{'chunk':>10}{'MB/s':>12}")
+    for name, cipher, total in engines:
+        for chunk_size in CHUNK_SIZES:
+            speed = throughput(cipher.encrypt, chunk_size, total)
+            print(f'{name:<12}{chunk_size // 1024:>8}Ki{speed:>12.1f}')
+
+
+if __name__ == "__main__":
+    main()
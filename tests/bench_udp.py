@@ -0,0 +1,122 @@
+# python -m tests.bench_udp --count 100000 --size 200
+import argparse
+import multiprocessing
+import select
+import socket
+import struct
+import time
+from types import SimpleNamespace
+
+from twisted.internet import reactor
+
+from networktunnel import constants
+from networktunnel.local_client import UDPProxyClient
+from networktunnel.udp_batch import batch_supported, listen_udp
+from tests.bench_shadow import make_shadow
+
+
+def load(conn, count, size, window):
+    """
+    子进程: socks client 和 echo 替身 (代替 remote 端)
+    client 保持 window 个数据报在途, echo 原样返回收到的密文
+    """
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(('127.0.0.1', 0))
+    echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    echo.bind(('127.0.0.1', 0))
+    for sock in (client, echo):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.setblocking(False)
+    conn.send((client.getsockname(), echo.getsockname()))
+    relay = conn.recv()
+
+    frame = b''.join([
+        struct.pack('!HBB', 0, 0, constants.ATYP_IPV4),
+        socket.inet_aton('127.0.0.1'),
+        struct.pack('!H', 53),
+        b'x' * size,
+    ])
+
+    sent = received = lost = 0
+    deadline = time.perf_counter() + 60
+    start = end = time.perf_counter()
+    while received + lost < count and time.perf_counter() < deadline:
+        while sent < count and sent - received - lost < window:
+            client.sendto(frame, relay)
+            sent += 1
+
+        readable, _, _ = select.select([client, echo], [], [], 0.5)
+        if not readable:
+            lost = sent - received  # 丢包, 不再等待
+            continue
+
+        if echo in readable:
+            try:
+                while True:
+                    data, addr = echo.recvfrom(65536)
+                    echo.sendto(data, addr)
+            except BlockingIOError:
+                pass
+
+        if client in readable:
+            try:
+                while True:
+                    client.recvfrom(65536)
+                    received += 1
+            except BlockingIOError:
+                end = time.perf_counter()
+
+    conn.send((received, lost, end - start))
+
+
+def run(batch, cipher, count, size, window):
+    server = SimpleNamespace(factory=SimpleNamespace(shadow=make_shadow(cipher)))
+
+    conn, child_conn = multiprocessing.Pipe()
+    child = multiprocessing.Process(target=load, args=(child_conn, count, size, window))
+    child.start()
+    client_addr, echo_addr = conn.recv()
+
+    proxy = UDPProxyClient(server, addr=client_addr, atyp=constants.ATYP_IPV4)
+    proxy.set_peer(echo_addr, constants.ATYP_IPV4)
+    port = listen_udp(reactor, 0, proxy, interface='127.0.0.1', batch=batch)
+    conn.send(('127.0.0.1', port.getHost().port))
+
+    result = {}
+
+    def wait():
+        if conn.poll():
+            result['value'] = conn.recv()
+            port.stopListening()
+            reactor.stop()
+        else:
+            reactor.callLater(0.05, wait)
+
+    reactor.callLater(0, wait)
+    reactor.run()
+    child.join()
+
+    received, lost, elapsed = result['value']
+    return received / elapsed, lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description='UDP ASSOCIATE relay packets per second')
+    parser.add_argument('--cipher', default='aes-128-cfb')
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=200)
+    parser.add_argument('--window', type=int, default=64, help='datagrams in flight')
+    parser.add_argument('--batch', choices=['on', 'off'], default='on')
+    args = parser.parse_args()
+
+    if args.batch == 'on' and not batch_supported():
+        print('recvmmsg / sendmmsg is not available, fall back to per-datagram relay')
+
+    # 每次运行一个模式, reactor 不能重新启动
+    pps, lost = run(args.batch == 'on', args.cipher, args.count, args.size, args.window)
+    print(f'cipher: {args.cipher}, payload: {args.size} bytes, batch: {args.batch}')
+    print(f'round trips: {pps:,.0f} pps (each through the relay twice), lost: {lost}')
+
+
+if __name__ == "__main__":
+    main()
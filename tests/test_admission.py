@@ -0,0 +1,67 @@
+# python -m twisted.trial tests.test_admission
+from twisted.internet import protocol, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from networktunnel.admission import AdmissionQueue
+
+
+class FakePort(object):
+
+    def __init__(self):
+        self.reading = True
+
+    def stopReading(self):
+        self.reading = False
+
+    def startReading(self):
+        self.reading = True
+
+
+class AdmissionQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.port = FakePort()
+        self.admission = AdmissionQueue(self.clock, limit=1, queue_size=2, timeout=5)
+
+    def connect(self):
+        proto = protocol.Protocol()
+        proto.makeConnection(proto_helpers.StringTransport())
+        return proto, self.admission.request(proto, self.port)
+
+    def test_fifo(self):
+        a, admitted = self.connect()
+        self.assertTrue(admitted)
+
+        b, admitted = self.connect()
+        self.assertFalse(admitted)
+        self.assertEqual(b.transport.producerState, 'paused')
+
+        c, _ = self.connect()
+        self.assertFalse(self.port.reading)
+
+        self.clock.advance(1)
+        self.admission.release(a)
+        self.assertEqual(b.transport.producerState, 'producing')
+        self.assertEqual(c.transport.producerState, 'paused')
+        self.assertTrue(self.port.reading)
+
+        stats = self.admission.stats()
+        self.assertEqual(stats['active'], 1)
+        self.assertEqual(stats['waiting'], 1)
+        self.assertEqual(stats['max_depth'], 2)
+        self.assertEqual(stats['avg_wait'], 1)
+
+    def test_expire(self):
+        self.connect()
+        b, _ = self.connect()
+
+        self.clock.advance(5)
+        self.assertTrue(b.transport.disconnecting)
+        self.admission.release(b)
+
+        stats = self.admission.stats()
+        self.assertEqual(stats['expired'], 1)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['active'], 1)
@@ -0,0 +1,52 @@
+# python -m twisted.trial tests.test_base
+import socket
+import struct
+
+from twisted.trial import unittest
+
+from networktunnel import constants
+from networktunnel.base import BaseSocksServer, MessageBuffer
+
+
+class MessageBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proto = BaseSocksServer()
+        self.proto.set_state(BaseSocksServer.STATE_CONNECTED)
+
+    def test_buffer(self):
+        buffer = MessageBuffer()
+        buffer.feed(b'abcdef')
+        self.assertEqual(buffer.read(4), b'abcd')
+        buffer.feed(b'gh')
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(buffer.read_all(), b'efgh')
+        self.assertEqual(len(buffer), 0)
+
+    def test_split_message(self):
+        methods = struct.pack('!BBB', constants.SOCKS5_VER, 1, constants.AUTH_ANONYMOUS)
+
+        self.proto._buffer.feed(methods[:2])
+        self.assertIsNone(self.proto.next_message())
+
+        self.proto._buffer.feed(methods[2:])
+        self.assertEqual(self.proto.next_message(), methods)
+
+    def test_coalesced_messages(self):
+        methods = struct.pack('!BBB', constants.SOCKS5_VER, 1, constants.AUTH_ANONYMOUS)
+        request = b''.join([
+            struct.pack('!4B', constants.SOCKS5_VER, constants.CMD_CONNECT, constants.RSV, constants.ATYP_IPV4),
+            socket.inet_aton('127.0.0.1'),
+            struct.pack('!H', 80),
+        ])
+        self.proto._buffer.feed(methods + request + b'GET / HTTP/1.1')
+
+        self.assertEqual(self.proto.next_message(), methods)
+
+        # 等待 remote 时不接收消息
+        self.proto.set_state(BaseSocksServer.STATE_RECEIVED_METHODS)
+        self.assertIsNone(self.proto.next_message())
+
+        self.proto.set_state(BaseSocksServer.STATE_SENT_AUTHENTICATION_RESULT)
+        self.assertEqual(self.proto.next_message(), request)
+        self.assertEqual(self.proto._buffer.read_all(), b'GET / HTTP/1.1')
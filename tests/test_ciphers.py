@@ -7,7 +7,14 @@ from twisted.trial import unittest
 
 from config import ConfigManager
 from settings import BASE_DIR
-from networktunnel.ciphers import AES128CFB, TableManager, ciphers
+from Crypto.PublicKey import RSA
+
+from networktunnel import ciphers as cipher_module
+from networktunnel.ciphers import (AES128CFB, ChunkedRSACipher, TableCipher,
+                                   TableManager, TranslateTableCipher, ciphers)
+from networktunnel.shadow import (AEAD_CHUNK_SIZE_MASK, AEADStreamDecrypter,
+                                  AEADStreamEncrypter)
+from tools.make_password import make_password
 
 conf = ConfigManager().default
 
@@ -50,3 +57,65 @@ class SocksServerTestCase(unittest.TestCase):
         self.assertTrue(callable(decrypt))
 
         self.assertEqual(decrypt(secret_message).decode(), message)
+
+    def test_translate_table(self):
+        password = make_password()
+        reference = TableCipher(password['encrypt'])
+        cipher = TranslateTableCipher(password['encrypt'])
+        decipher = TranslateTableCipher(password['decrypt'])
+
+        message = os.urandom(4096)
+        secret_message = cipher.encrypt(message)
+
+        self.assertEqual(secret_message, reference.encrypt(message))
+        self.assertEqual(cipher.encrypt(bytearray(message)), secret_message)
+        self.assertEqual(cipher.encrypt(memoryview(message)), secret_message)
+        self.assertEqual(decipher.decrypt(secret_message), message)
+
+    def test_aead_stream(self):
+        for name in ('aes-128-gcm', 'chacha20-ietf-poly1305', 'xchacha20-ietf-poly1305'):
+            manager = ciphers[name](conf.get('local', 'key'))
+            encrypt = AEADStreamEncrypter(manager)
+            decrypt = AEADStreamDecrypter(manager, buffer_size=16)
+
+            message = os.urandom(AEAD_CHUNK_SIZE_MASK * 3 + 100)
+            ciphertext = encrypt(message[:1000]) + encrypt(message[1000:])
+
+            # 模拟 TCP 任意分段
+            plaintext = []
+            for offset in range(0, len(ciphertext), 777):
+                plaintext.append(decrypt(ciphertext[offset:offset + 777]))
+
+            self.assertEqual(b''.join(plaintext), message)
+
+    def test_aead_pinned_salt(self):
+        manager = ciphers['aes-128-gcm'](conf.get('local', 'key'))
+        pinned, salt = manager.random_salt(), manager.random_salt()
+        manager.pin_salt(pinned)
+
+        derived = []
+        hkdf = cipher_module.HKDF
+
+        def counting_hkdf(master, key_len, salt, *args, **kwargs):
+            derived.append(salt)
+            return hkdf(master, key_len, salt, *args, **kwargs)
+
+        self.patch(cipher_module, 'HKDF', counting_hkdf)
+
+        # 固定的 salt 不再派生, 随机的 salt 每次都派生
+        for _ in range(2):
+            for s in (pinned, salt):
+                _, encrypt = manager.make_encrypter(s)
+                decrypt = manager.make_decrypter(s)
+                self.assertEqual(decrypt(*encrypt(b'message')), b'message')
+        self.assertEqual(derived, [salt] * 4)
+
+    def test_rsa_chunked(self):
+        cipher = ChunkedRSACipher(RSA.generate(1024))
+
+        message = os.urandom(cipher.chunk_size * 2 + 1)
+        secret_message = cipher.encrypt(message)
+
+        self.assertEqual(len(secret_message), cipher.block_size * 3)
+        self.assertEqual(cipher.decrypt(secret_message), message)
+        self.assertEqual(cipher.decrypt(secret_message[:-1], sentinel='ERROR'), 'ERROR')
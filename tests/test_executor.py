@@ -0,0 +1,156 @@
+# python -m twisted.trial tests.test_executor
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from networktunnel.executor import OrderedPipe, WriteCoalescer
+from networktunnel.flow import read_gate
+from networktunnel.remote_client import ProxyClient
+from networktunnel.remote_server import SocksServerFactory
+from tests.test_shadow import make_shadow
+
+
+class FakeExecutor(object):
+    """ 任务由测试手动完成 """
+
+    threshold = 4
+    high_water = 8
+
+    def __init__(self):
+        self.jobs = []
+        self.running = True
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def run(self, cipher, data):
+        d = defer.Deferred()
+        self.jobs.append((d, cipher(data)))
+        return d
+
+    def finish(self):
+        d, result = self.jobs.pop(0)
+        d.callback(result)
+
+    def pipe(self, cipher, sink, producer=None):
+        return OrderedPipe(self, cipher, sink, producer)
+
+
+class WriteCoalescerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.written = []
+        self.coalescer = WriteCoalescer(self.clock, self.written.append, max_size=8)
+
+    def test_coalesce_in_one_iteration(self):
+        self.coalescer(b'ab')
+        self.coalescer(b'cd')
+        self.assertEqual(self.written, [])
+
+        self.clock.advance(0)
+        self.assertEqual(self.written, [b'abcd'])
+        self.assertEqual(self.coalescer.stats.stats()['coalesced'], 1)
+
+    def test_flush_when_full(self):
+        self.coalescer(b'abcd')
+        self.coalescer(b'efghij')
+        self.assertEqual(self.written, [b'abcdefghij'])
+
+        # 已经写出, 不会再有定时的 flush
+        self.clock.advance(0)
+        self.assertEqual(len(self.written), 1)
+
+
+class OrderedPipeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = FakeExecutor()
+        self.transport = proto_helpers.StringTransport()
+        self.written = []
+        self.pipe = OrderedPipe(self.executor, bytes.upper, self.written.append, self.transport)
+
+    def test_order_and_high_water(self):
+        self.pipe(b'abcd')
+        self.pipe(b'efghijklm')  # 排队超过 high_water, 暂停读取
+        self.assertEqual(self.transport.producerState, 'paused')
+
+        self.executor.finish()
+        self.executor.finish()
+        self.assertEqual(self.written, [b'ABCD', b'EFGHIJKLM'])
+        self.assertEqual(self.transport.producerState, 'producing')
+
+    def test_flow_control_pause_kept(self):
+        gate = read_gate(self.transport)
+        self.pipe(b'abcd')
+        self.pipe(b'efghijklm')
+        gate.pauseProducing()  # 对端写缓冲区也满了
+
+        self.executor.finish()
+        self.executor.finish()
+        self.assertEqual(self.transport.producerState, 'paused')
+
+        gate.resumeProducing()
+        self.assertEqual(self.transport.producerState, 'producing')
+
+    def test_drained(self):
+        self.successResultOf(self.pipe.drained())
+
+        self.pipe(b'abcd')
+        self.pipe(b'efgh')
+        d = self.pipe.drained()
+        self.executor.finish()
+        self.assertNoResult(d)  # 第二个任务还在线程池中
+
+        self.executor.finish()
+        self.successResultOf(d)
+        self.assertEqual(self.written, [b'ABCD', b'EFGH'])
+
+
+class CloseInFlightTestCase(unittest.TestCase):
+    """ 一端关闭时线程池中还有数据, 写出之后才关闭另一端 """
+
+    def setUp(self):
+        self.factory = SocksServerFactory(task.Clock())
+        self.factory.shadow = make_shadow('aes-128-cfb')
+        self.factory.crypto_executor = self.executor = FakeExecutor()
+        self.factory.coalesce_size = 0
+        self.factory.prewarmer = None
+        self.factory.admission = None
+        self.addCleanup(self.factory.stopFactory)
+
+        self.tunnel = proto_helpers.StringTransport()
+        self.server = self.factory.buildProtocol(('127.0.0.1', 50000))
+        self.server.makeConnection(self.tunnel)
+        self.target = ProxyClient(self.server)
+        self.target.makeConnection(proto_helpers.StringTransport())
+        self.server.start_relay()
+
+    def test_target_closed(self):
+        self.target.dataReceived(b'response')
+        self.target.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual(self.tunnel.value(), b'')
+        self.assertFalse(self.tunnel.disconnecting)
+
+        self.executor.finish()
+        decrypt = self.factory.shadow.make_data_decrypter()
+        self.assertEqual(decrypt(self.tunnel.value()), b'response')
+        self.assertTrue(self.tunnel.disconnecting)
+
+    def test_tunnel_closed(self):
+        encrypt = self.factory.shadow.make_data_encrypter()
+        self.server.dataReceived(encrypt(b'request'))
+        self.server.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertFalse(self.target.transport.disconnecting)
+
+        self.executor.finish()
+        self.assertEqual(self.target.transport.value(), b'request')
+        self.assertTrue(self.target.transport.disconnecting)
+
+    def test_stop_factory(self):
+        self.factory.stopFactory()
+        self.assertFalse(self.executor.running)
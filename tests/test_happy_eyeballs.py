@@ -0,0 +1,87 @@
+# python -m twisted.trial tests.test_happy_eyeballs
+from twisted.internet import error, protocol
+from twisted.internet.testing import MemoryReactorClock
+from twisted.python.failure import Failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from networktunnel import errors
+from networktunnel.happy_eyeballs import AddressStats, ConnectRace
+
+
+class RefusingReactor(MemoryReactorClock):
+    """ 连接 refused 中的地址时同步失败 """
+
+    def __init__(self):
+        super().__init__()
+        self.refused = set()
+
+    def connectTCP(self, host, port, factory, timeout=30, bindAddress=None):
+        connector = super().connectTCP(host, port, factory, timeout, bindAddress)
+        if host in self.refused:
+            factory.clientConnectionFailed(connector, Failure(error.ConnectionRefusedError()))
+        return connector
+
+
+class ConnectRaceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = RefusingReactor()
+        self.stats = AddressStats(self.reactor)
+        self.proto = protocol.Protocol()
+
+    def race(self, addresses):
+        return ConnectRace(self.reactor, addresses, 80, self.proto, self.stats, stagger=0.25).start()
+
+    def attempted(self):
+        return [host for host, *_ in self.reactor.tcpClients]
+
+    def establish(self, index):
+        factory = self.reactor.tcpClients[index][2]
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+
+    def fail(self, index):
+        factory = self.reactor.tcpClients[index][2]
+        factory.clientConnectionFailed(self.reactor.connectors[index], Failure(error.ConnectionRefusedError()))
+
+    def test_stagger(self):
+        d = self.race(['10.0.0.1', '2001:db8::1'])
+        self.assertEqual(self.attempted(), ['2001:db8::1'])
+
+        self.reactor.advance(0.25)
+        self.assertEqual(self.attempted(), ['2001:db8::1', '10.0.0.1'])
+
+        self.reactor.advance(0.05)
+        self.establish(1)
+        self.assertIs(self.successResultOf(d), self.proto)
+
+        # 记住更快的地址, 下次先连接
+        self.assertEqual(self.stats.sort(['10.0.0.1', '2001:db8::1']), ['10.0.0.1', '2001:db8::1'])
+
+    def test_failure_starts_next_attempt(self):
+        d = self.race(['2001:db8::1', '10.0.0.1'])
+        self.fail(0)
+        self.assertEqual(self.attempted(), ['2001:db8::1', '10.0.0.1'])
+        self.assertNoResult(d)
+
+        self.fail(1)
+        self.failureResultOf(d, errors.HostUnreachable)
+
+        # 最近失败过的地址排在最后
+        self.assertEqual(self.stats.sort(['2001:db8::1', '10.0.0.1', '10.0.0.2']),
+                         ['10.0.0.2', '2001:db8::1', '10.0.0.1'])
+
+    def test_synchronous_failure(self):
+        self.reactor.refused.add('10.0.0.1')
+        d = self.race(['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        self.assertEqual(self.attempted(), ['10.0.0.1', '10.0.0.2'])
+
+        # 只留下一个 stagger 定时
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 1)
+        self.reactor.advance(0.25)
+        self.assertEqual(self.attempted(), ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+        self.establish(2)
+        self.assertIs(self.successResultOf(d), self.proto)
@@ -0,0 +1,198 @@
+# python -m twisted.trial tests.test_local_client
+import struct
+
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from networktunnel import constants, errors, local_client
+from networktunnel.local_client import ProxyClientPool
+from networktunnel.local_server import TransferServerFactory
+from tests.test_shadow import make_shadow
+
+
+class ProxyClientPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = TransferServerFactory(self.clock)
+        self.factory.shadow = make_shadow('aes-128-cfb')
+        self.factory.crypto_executor = None
+        self.factory.coalesce_size = 0
+        self.addCleanup(self.factory.stopFactory)
+
+        self.patch(local_client, 'connectProtocol', self.connect)
+        self.clients = []  # 连接池发起的连接, 按发起的先后排列
+
+        self.pool = ProxyClientPool(self.factory, '127.0.0.1:1080', size=2, idle_timeout=10)
+        self.addCleanup(self.pool.stop)
+
+    def connect(self, point, proto):
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.clients.append(proto)
+        return defer.succeed(proto)
+
+    def authenticate(self, client, status=constants.AUTH_SUCCESS):
+        client.dataReceived(self.factory.shadow.encrypt_protocol_data(struct.pack('!BB', constants.SOCKS5_VER, status)))
+
+    def lose(self, client):
+        client.connectionLost(failure.Failure(error.ConnectionDone()))
+
+    def make_server(self):
+        server = self.factory.buildProtocol(('127.0.0.1', 50000))
+        server.makeConnection(proto_helpers.StringTransport())
+        return server
+
+    def test_acquire_hit(self):
+        self.pool.start()
+        self.assertEqual(len(self.clients), 2)
+        for client in self.clients:
+            self.authenticate(client)
+        self.assertEqual(len(self.pool.idle), 2)
+
+        server = self.make_server()
+        d = self.pool.acquire(server)
+        client = self.successResultOf(d)
+        self.assertIs(client.server, server)
+        self.assertIs(server.client, client)
+        self.assertEqual(self.pool.hits, 1)
+
+        # 取出后立即补充一个
+        self.assertEqual(len(self.clients), 3)
+
+    def test_acquire_miss(self):
+        self.pool.start()
+        server = self.make_server()
+        d = self.pool.acquire(server)
+        self.assertNoResult(d)
+        self.assertEqual(self.pool.misses, 1)
+        # size 个空闲连接之外再为等待者建立一个
+        self.assertEqual(len(self.clients), 3)
+
+        self.clock.advance(0.5)
+        self.authenticate(self.clients[0])
+        self.assertIs(self.successResultOf(d), self.clients[0])
+        self.assertEqual(self.pool.wait_time, 0.5)
+        self.assertEqual(len(self.pool.idle), 0)
+
+    def test_waiter_gone(self):
+        self.pool.start()
+        gone, alive = self.make_server(), self.make_server()
+        gone_d = self.pool.acquire(gone)
+        alive_d = self.pool.acquire(alive)
+        gone.transport.connected = False
+
+        # 断开的等待者失败, 就绪的连接交给下一个等待者
+        self.authenticate(self.clients[0])
+        self.failureResultOf(gone_d, error.ConnectionLost)
+        self.assertIs(self.successResultOf(alive_d), self.clients[0])
+        self.assertIs(alive.client, self.clients[0])
+
+    def test_lifo(self):
+        self.pool.start()
+        first, second = self.clients
+        self.authenticate(first)
+        self.clock.advance(1)
+        self.authenticate(second)
+
+        # 后就绪的先用
+        self.assertIs(self.successResultOf(self.pool.acquire(self.make_server())), second)
+        self.assertIs(self.successResultOf(self.pool.acquire(self.make_server())), first)
+
+    def test_refill(self):
+        self.pool.start()
+        first, second = self.clients
+        self.authenticate(first)
+        self.authenticate(second)
+
+        # 空闲连接断开, refill_delay 秒后补充
+        self.lose(first)
+        self.assertEqual(len(self.pool.idle), 1)
+        self.assertEqual(len(self.clients), 2)
+        self.clock.advance(self.pool.refill_delay)
+        self.assertEqual(len(self.clients), 3)
+
+    def test_idle_sweep(self):
+        self.pool.start()
+        first, second = self.clients
+        self.authenticate(first)
+        self.clock.advance(6)
+        self.authenticate(second)
+
+        # 每 idle_timeout / 2 秒检查一次, 空闲超过 idle_timeout 的连接关闭
+        self.clock.advance(5)
+        self.assertTrue(first.transport.disconnecting)
+        self.assertFalse(second.transport.disconnecting)
+
+        self.lose(first)
+        self.clock.advance(self.pool.refill_delay)
+        self.assertEqual(len(self.clients), 3)
+
+    def test_stats(self):
+        self.pool.start()
+        for client in self.clients:
+            self.authenticate(client)
+
+        self.pool.acquire(self.make_server())
+        d = self.pool.acquire(self.make_server())
+        d2 = self.pool.acquire(self.make_server())
+        self.successResultOf(d)
+        self.assertNoResult(d2)
+        self.clock.advance(2)
+        self.authenticate(self.clients[2])
+        self.successResultOf(d2)
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertAlmostEqual(stats['hit_rate'], 2 / 3)
+        self.assertEqual(stats['avg_wait'], 2.0)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['failures'], 0)
+
+    def test_auth_failure_backoff(self):
+        self.pool.max_refill_delay = 4
+        self.pool.start()
+        d = self.pool.acquire(self.make_server())
+
+        def reject_all():
+            for client in self.clients:
+                if client.is_state(client.STATE_SentAuthentication):
+                    self.authenticate(client, status=constants.AUTH_ERROR)
+                    self.lose(client)
+
+        # token 错误, 等待者直接失败
+        reject_all()
+        self.failureResultOf(d, errors.LoginAuthenticationFailed)
+        self.assertEqual(self.pool.failures, 3)
+
+        # 第一次失败安排的重连在 refill_delay 秒后, 之后间隔加倍, 最多 max_refill_delay 秒
+        for delay in (1, 4, 4):
+            count = len(self.clients)
+            self.clock.advance(delay - 0.1)
+            self.assertEqual(len(self.clients), count)
+            self.clock.advance(0.1)
+            self.assertEqual(len(self.clients), count + 2)
+            reject_all()
+
+        # 认证成功后恢复
+        self.clock.advance(4)
+        for client in self.clients[-2:]:
+            self.authenticate(client)
+        self.assertEqual(self.pool.failures, 0)
+        self.assertEqual(len(self.pool.idle), 2)
+
+    def test_backoff_doubles(self):
+        self.pool.size = 1
+        self.pool.start()
+
+        delays = []
+        for _ in range(4):
+            client = self.clients[-1]
+            self.authenticate(client, status=constants.AUTH_ERROR)
+            self.lose(client)
+            delays.append(self.pool._refill_call.getTime() - self.clock.seconds())
+            self.clock.advance(delays[-1])
+
+        self.assertEqual(delays, [1, 2, 4, 8])
@@ -0,0 +1,269 @@
+# python -m twisted.trial tests.test_mux
+import struct
+from types import SimpleNamespace
+
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from networktunnel import constants, errors, mux
+from networktunnel.helpers import create_reply
+from networktunnel.mux import (FRAME_CLOSE, FRAME_DATA, FRAME_HEADER,
+                               FRAME_OPEN, FRAME_REPLY, FRAME_WINDOW,
+                               FrameParser, MuxServerSession, MuxSession,
+                               MuxStream, MuxTunnelPool, mux_request,
+                               parse_mux_request)
+from tests.test_shadow import make_shadow
+
+
+class FakeTunnel(object):
+
+    def __init__(self):
+        self.frames = []
+
+    def write(self, data):
+        self.frames.append(FRAME_HEADER.unpack_from(data) + (bytes(data[FRAME_HEADER.size:]),))
+
+
+class FakeProducer(object):
+
+    def __init__(self):
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class FakeFactory(object):
+
+    def __init__(self):
+        self.connects = []
+
+    def connect(self, domain, port, client):
+        d = defer.Deferred()
+        self.connects.append((domain, port, client, d))
+        return d
+
+
+class FakeServer(FakeTunnel):
+    """ MuxServerSession 的 server, 写入的帧不加密 """
+
+    def __init__(self):
+        super().__init__()
+        self.factory = FakeFactory()
+        self.shaper = None
+        self.transport = proto_helpers.StringTransport()
+
+
+def open_request(port=80):
+    return struct.pack('!4B', constants.SOCKS5_VER, constants.CMD_CONNECT, 0, constants.ATYP_IPV4) + \
+        bytes([127, 0, 0, 1]) + struct.pack('!H', port)
+
+
+def frame(frame_type, stream_id, payload=b''):
+    return FRAME_HEADER.pack(frame_type, stream_id, len(payload)) + payload
+
+
+class EchoStream(MuxStream):
+
+    def deliver(self, data):
+        pass
+
+    def lose_endpoint(self):
+        pass
+
+
+class EchoSession(MuxSession):
+
+    def open_received(self, stream_id, request):
+        pass
+
+
+class MuxTestCase(unittest.TestCase):
+
+    def test_frame_parser(self):
+        frames = FRAME_HEADER.pack(FRAME_DATA, 1, 3) + b'abc' + FRAME_HEADER.pack(FRAME_DATA, 3, 0)
+        parser = FrameParser()
+
+        # 逐字节喂入, 不完整的帧留在缓冲区
+        result = []
+        for i in range(len(frames)):
+            result.extend(parser.feed(frames[i:i + 1]))
+
+        self.assertEqual(result, [(FRAME_DATA, 1, b'abc'), (FRAME_DATA, 3, b'')])
+
+    def test_mux_request(self):
+        self.assertEqual(parse_mux_request(mux_request(65536)), 65536)
+
+    def test_flow_control(self):
+        tunnel = FakeTunnel()
+        session = EchoSession(tunnel, window=1024)
+        stream = EchoStream(session, 1)
+        stream.producer = FakeProducer()
+        session.streams[1] = stream
+
+        stream.send(b'x' * 1024)
+        self.assertTrue(stream.producer.paused)
+
+        session.write(FRAME_HEADER.pack(FRAME_WINDOW, 1, 4) + (512).to_bytes(4, 'big'))
+        self.assertFalse(stream.producer.paused)
+
+        # 收到半个窗口的数据后返还窗口
+        tunnel.frames.clear()
+        session.write(FRAME_HEADER.pack(FRAME_DATA, 1, 512) + b'y' * 512)
+        self.assertEqual(tunnel.frames, [(FRAME_WINDOW, 1, 4, (512).to_bytes(4, 'big'))])
+
+    def test_server_ignores_reply(self):
+        server = FakeServer()
+        session = MuxServerSession(server)
+        session.write(frame(FRAME_OPEN, 1, open_request()))
+        self.assertIn(1, session.streams)
+
+        # REPLY 只应该发给 local 端, remote 端收到时忽略, 流保持打开
+        session.write(frame(FRAME_REPLY, 1, b'\x05\x00'))
+        session.write(frame(0xff, 1, b'?'))
+        self.assertIn(1, session.streams)
+        self.assertEqual(server.frames, [])
+
+    def test_duplicate_open(self):
+        server = FakeServer()
+        session = MuxServerSession(server)
+        session.write(frame(FRAME_OPEN, 1, open_request()))
+        stream = session.streams[1]
+
+        session.write(frame(FRAME_OPEN, 1, open_request(443)))
+        self.assertIs(session.streams[1], stream)
+        self.assertEqual(len(server.factory.connects), 1)
+
+    def test_max_streams(self):
+        server = FakeServer()
+        session = MuxServerSession(server, max_streams=2)
+        for stream_id in (1, 3, 5):
+            session.write(frame(FRAME_OPEN, stream_id, open_request()))
+
+        # 超出上限的流不连接目标, 直接回复 REJECTED
+        self.assertEqual(sorted(session.streams), [1, 3])
+        self.assertEqual(len(server.factory.connects), 2)
+        self.assertEqual(session.rejected, 1)
+        [(frame_type, stream_id, _, reply)] = server.frames
+        self.assertEqual((frame_type, stream_id), (FRAME_REPLY, 5))
+        self.assertEqual(reply[:2], bytes([constants.SOCKS5_VER, constants.SOCKS5_REJECTED]))
+
+        # 关闭一个流之后可以再打开
+        session.write(frame(FRAME_CLOSE, 1))
+        session.write(frame(FRAME_OPEN, 7, open_request()))
+        self.assertEqual(sorted(session.streams), [3, 7])
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, MuxSession, FakeTunnel())
+        self.assertRaises(TypeError, MuxStream, EchoSession(FakeTunnel()), 1)
+
+    def test_bad_window_frame(self):
+        server = FakeServer()
+        session = MuxServerSession(server)
+        session.write(frame(FRAME_OPEN, 1, open_request()))
+        stream = session.streams[1]
+        window = stream.send_window
+
+        # 窗口增量不是 4 字节, 关闭隧道, 同一次收到的后续帧不再处理
+        session.write(frame(FRAME_WINDOW, 1, b'\x00\x01') + frame(FRAME_CLOSE, 1))
+        self.assertTrue(server.transport.disconnecting)
+        self.assertEqual(stream.send_window, window)
+        self.assertFalse(stream.closed)
+
+
+class MuxTunnelPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = SimpleNamespace(reactor=self.clock, shadow=make_shadow('aes-128-cfb'), connect_timeout=5,
+                                       crypto_executor=None, coalesce_size=0)
+        self.points = []  # clientFromString 的描述
+        self.tunnels = []
+        self.connect_error = None
+        self.patch(mux, 'clientFromString', lambda reactor, description: self.points.append(description))
+        self.patch(mux, 'connectProtocol', self.connect)
+
+        self.pool = MuxTunnelPool(self.factory, '127.0.0.1:1080', b'token', tunnels=1)
+        self.addCleanup(self.pool.stop)
+
+    def connect(self, point, proto):
+        if self.connect_error is not None:
+            return defer.fail(self.connect_error)
+
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.tunnels.append(proto)
+        return defer.succeed(proto)
+
+    def replies(self, status=constants.AUTH_SUCCESS):
+        shadow = self.factory.shadow
+        return shadow.encrypt_protocol_data(struct.pack('!BB', constants.SOCKS5_VER, status)) + \
+            shadow.encrypt_protocol_data(create_reply(constants.SOCKS5_VER, constants.SOCKS5_GRANTED))
+
+    def make_server(self):
+        return SimpleNamespace(transport=proto_helpers.StringTransport(), client=None)
+
+    def test_connect_timeout(self):
+        self.pool.start()
+        self.assertEqual(self.points, ['tcp:127.0.0.1:1080:timeout=5'])
+
+    def test_replies_split(self):
+        replies = self.replies()
+        for offset in range(len(replies) + 1):
+            self.pool = MuxTunnelPool(self.factory, '127.0.0.1:1080', b'token', tunnels=1)
+            self.pool.start()
+            tunnel = self.tunnels[-1]
+
+            # 认证和 CMD_MUX 的回复一起到达或者从任意位置切开
+            tunnel.dataReceived(replies[:offset])
+            tunnel.dataReceived(replies[offset:])
+            self.assertEqual(self.pool.tunnels, [tunnel])
+            self.assertIsNotNone(tunnel.session)
+
+    def test_backoff(self):
+        self.connect_error = error.ConnectionRefusedError()
+        d = self.pool.open_stream(self.make_server())
+
+        # 连续失败时重连的间隔加倍, 最多 max_reconnect_delay 秒
+        delays = []
+        for _ in range(8):
+            delays.append(self.pool._reconnect_call.getTime() - self.clock.seconds())
+            self.clock.advance(delays[-1])
+        self.assertEqual(delays, [1, 2, 4, 8, 16, 32, 60, 60])
+        self.failureResultOf(d, errors.HostUnreachable)
+
+        # 认证成功后恢复
+        self.connect_error = None
+        self.clock.advance(60)
+        self.tunnels[-1].dataReceived(self.replies())
+        self.assertEqual(self.pool.failures, 0)
+        self.assertEqual(len(self.pool.tunnels), 1)
+
+    def test_auth_failure_backoff(self):
+        self.pool.start()
+        tunnel = self.tunnels[-1]
+        tunnel.dataReceived(self.replies(constants.AUTH_ERROR))
+        self.assertTrue(tunnel.transport.disconnecting)
+        tunnel.connectionLost(failure.Failure(error.ConnectionDone()))
+
+        # 没有完成认证的隧道和连接失败一样退避
+        self.assertEqual(self.pool.failures, 1)
+        self.assertEqual(self.pool._reconnect_call.getTime(), 1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.tunnels), 2)
+
+    def test_waiter_gone(self):
+        self.pool.start()
+        gone, alive = self.make_server(), self.make_server()
+        gone_d = self.pool.open_stream(gone)
+        alive_d = self.pool.open_stream(alive)
+        gone.transport.connected = False
+
+        self.tunnels[-1].dataReceived(self.replies())
+        self.failureResultOf(gone_d, error.ConnectionLost)
+        stream = self.successResultOf(alive_d)
+        self.assertIs(alive.client, stream)
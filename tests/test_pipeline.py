@@ -0,0 +1,206 @@
+# python -m twisted.trial tests.test_pipeline
+import socket
+import struct
+
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from config import ConfigManager
+from networktunnel import constants, errors, local_server
+from networktunnel.helpers import create_reply
+from networktunnel.local_server import TransferServerFactory
+from networktunnel.remote_server import SocksServerFactory
+from tests.test_shadow import make_shadow
+
+PAYLOAD = b'\x16\x03\x01 client hello'
+RESPONSE = b'\x16\x03\x03 server hello'
+
+
+def connect_request(port=443):
+    return b''.join([
+        struct.pack('!4B', constants.SOCKS5_VER, constants.CMD_CONNECT, constants.RSV, constants.ATYP_IPV4),
+        socket.inet_aton('93.184.216.34'),
+        struct.pack('!H', port),
+    ])
+
+
+class PipelineTestCase(unittest.TestCase):
+    """ 流水线握手: local 端一次写入认证, 命令和首个数据, remote 端按消息长度切分 """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        shadow = make_shadow('aes-128-cfb')
+
+        self.local = TransferServerFactory(self.clock)
+        self.local.shadow = shadow
+        self.local.pipeline = True
+        self.local.mux_pool = None
+        self.local.client_pool = None
+        self.local.crypto_executor = None
+        self.local.coalesce_size = 0
+        self.addCleanup(self.local.stopFactory)
+
+        self.remote = SocksServerFactory(self.clock)
+        self.remote.shadow = shadow
+        self.remote.splice = False
+        self.remote.crypto_executor = None
+        self.remote.coalesce_size = 0
+        self.remote.prewarmer = None
+        self.remote.admission = None
+        self.remote.connect = self.connect_target
+        self.addCleanup(self.remote.stopFactory)
+
+        self.patch(local_server, 'connectProtocol', self.connect_remote)
+        self.tunnel = None  # local 端到 remote 的连接
+        self.targets = []  # remote 端到目标服务器的连接
+        self.connect_result = None
+
+    def connect_remote(self, point, proto):
+        self.tunnel = proto_helpers.StringTransport()
+        proto.makeConnection(self.tunnel)
+        return defer.succeed(proto)
+
+    def connect_target(self, domain, port, proto):
+        if self.connect_result is not None:
+            return self.connect_result
+
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        self.targets.append((domain, port, proto))
+        return defer.succeed(proto)
+
+    def make_browser(self):
+        browser = proto_helpers.StringTransport()
+        server = self.local.buildProtocol(('127.0.0.1', 50000))
+        server.makeConnection(browser)
+        return server, browser
+
+    def make_remote(self):
+        tunnel = proto_helpers.StringTransport()
+        server = self.remote.buildProtocol(('127.0.0.1', 50001))
+        server.makeConnection(tunnel)
+        return server, tunnel
+
+    def pipelined_write(self):
+        """ 浏览器的握手和首个数据, 返回 local 端写往 remote 的密文 """
+        server, browser = self.make_browser()
+        server.dataReceived(struct.pack('!3B', constants.SOCKS5_VER, 1, constants.AUTH_ANONYMOUS))
+        self.assertEqual(self.tunnel.value(), b'')  # 认证消息等待命令
+
+        server.dataReceived(connect_request() + PAYLOAD)
+        return server, browser, self.tunnel.value()
+
+    def assert_remote_relayed(self, server, tunnel):
+        [(domain, port, target)] = self.targets
+        self.assertEqual((domain, port), ('93.184.216.34', 443))
+        self.assertEqual(target.transport.value(), PAYLOAD)
+        self.assertTrue(server.is_state(server.STATE_ESTABLISHED))
+
+        # 认证的回复之后是 GRANTED, 都是协议加密
+        shadow = self.remote.shadow
+        replies = b''.join([
+            shadow.encrypt_protocol_data(struct.pack('!BB', constants.SOCKS5_VER, constants.AUTH_SUCCESS)),
+            shadow.encrypt_protocol_data(
+                create_reply(constants.SOCKS5_VER, constants.SOCKS5_GRANTED, target.transport.getHost())),
+        ])
+        self.assertEqual(tunnel.value(), replies)
+
+    def test_single_write(self):
+        server, browser, written = self.pipelined_write()
+
+        # 乐观的 GRANTED 已经回复给浏览器
+        self.assertEqual(browser.value()[:2], struct.pack('!BB', constants.SOCKS5_VER, constants.AUTH_ANONYMOUS))
+        reply = create_reply(constants.SOCKS5_VER, constants.SOCKS5_GRANTED)
+        self.assertEqual(browser.value()[2:], reply)
+        self.assertTrue(server.is_state(server.STATE_ESTABLISHED))
+
+        # 首个数据到达之前不发送, pipeline_delay 的定时器已经取消
+        self.assertFalse(server.client._early_call.active())
+
+        remote, tunnel = self.make_remote()
+        remote.dataReceived(written)
+        self.assert_remote_relayed(remote, tunnel)
+
+    def test_delay_without_payload(self):
+        server, browser = self.make_browser()
+        server.dataReceived(struct.pack('!3B', constants.SOCKS5_VER, 1, constants.AUTH_ANONYMOUS))
+        server.dataReceived(connect_request(25))
+        self.assertEqual(self.tunnel.value(), b'')
+
+        # server-speaks-first 的协议没有首个数据, 等待 pipeline_delay 后发送握手
+        self.clock.advance(self.local.pipeline_delay)
+        remote, tunnel = self.make_remote()
+        remote.dataReceived(self.tunnel.value())
+        [(domain, port, target)] = self.targets
+        self.assertEqual(port, 25)
+        self.assertTrue(remote.is_state(remote.STATE_ESTABLISHED))
+
+    def test_remote_split(self):
+        _, _, written = self.pipelined_write()
+
+        for offset in range(1, len(written)):
+            self.targets = []
+            remote, tunnel = self.make_remote()
+            remote.dataReceived(written[:offset])
+            remote.dataReceived(written[offset:])
+            self.assert_remote_relayed(remote, tunnel)
+
+    def test_remote_byte_by_byte(self):
+        _, _, written = self.pipelined_write()
+
+        remote, tunnel = self.make_remote()
+        for i in range(len(written)):
+            remote.dataReceived(written[i:i + 1])
+        self.assert_remote_relayed(remote, tunnel)
+
+    def test_local_split(self):
+        _, _, written = self.pipelined_write()
+        remote, tunnel = self.make_remote()
+        remote.dataReceived(written)
+        [(_, _, target)] = self.targets
+        target.dataReceived(RESPONSE)
+        replies = tunnel.value()
+
+        # remote 的两个回复和目标服务器的数据从任意位置切分后到达 local 端
+        for offset in range(1, len(replies)):
+            self.tunnel = None
+            server, browser, _ = self.pipelined_write()
+            browser.clear()
+            server.client.dataReceived(replies[:offset])
+            server.client.dataReceived(replies[offset:])
+
+            self.assertTrue(server.client.is_state(server.client.STATE_Established))
+            self.assertEqual(browser.value(), RESPONSE)  # GRANTED 不会重复回复
+
+    def test_remote_rejects(self):
+        self.connect_result = defer.fail(errors.HostUnreachable())
+        server, browser, written = self.pipelined_write()
+        self.assertTrue(server.is_state(server.STATE_ESTABLISHED))
+
+        remote, tunnel = self.make_remote()
+        remote.dataReceived(written)
+        self.assertTrue(tunnel.disconnecting)
+        self.flushLoggedErrors(errors.HostUnreachable)
+
+        # 浏览器已经收到乐观的 GRANTED, remote 的失败回复不再转发, 只能断开连接
+        browser.clear()
+        server.client.dataReceived(tunnel.value())
+        self.assertTrue(server.client.is_state(server.client.STATE_Error))
+        self.assertEqual(browser.value(), b'')
+        self.assertTrue(browser.disconnecting)
+        self.assertTrue(self.tunnel.disconnecting)
+
+    def test_remote_bad_token(self):
+        _, _, written = self.pipelined_write()
+        token = ConfigManager().default.get('local', 'token').encode()
+        auth_length = len(self.remote.shadow.encrypt_protocol_data(bytes([constants.SOCKS5_VER, len(token)]) + token))
+        bad = bytearray(written)
+        # 修改 token 的最后一个字节, 流加密的密文逐字节对应明文
+        bad[auth_length - 1] ^= 1
+
+        remote, tunnel = self.make_remote()
+        remote.dataReceived(bytes(bad))
+        self.assertTrue(tunnel.disconnecting)
+        self.assertEqual(self.targets, [])  # 命令和数据不再处理
+        self.flushLoggedErrors(errors.LoginAuthenticationFailed)
@@ -0,0 +1,135 @@
+# python -m twisted.trial tests.test_prefork
+import json
+
+from twisted.internet import error
+from twisted.internet.testing import MemoryReactorClock
+from twisted.python import failure
+from twisted.trial import unittest
+
+from networktunnel.prefork import HEARTBEAT_FD, PreforkSupervisor
+
+
+class FakeProcessTransport(object):
+
+    def __init__(self, proto, pid):
+        self.proto = proto
+        self.pid = pid
+        self.signals = []
+
+    def signalProcess(self, signal):
+        if self.pid is None:
+            raise error.ProcessExitedAlready()
+        self.signals.append(signal)
+
+    def end(self, reason=None):
+        self.pid = None
+        self.proto.processEnded(failure.Failure(reason or error.ProcessTerminated(signal=9)))
+
+
+class ProcessReactor(MemoryReactorClock):
+    """ spawnProcess 不启动进程, 记录 FakeProcessTransport """
+
+    def __init__(self):
+        super().__init__()
+        self.spawned = []
+
+    def spawnProcess(self, processProtocol, executable, args=(), env=None, path=None,
+                     uid=None, gid=None, usePTY=False, childFDs=None):
+        transport = FakeProcessTransport(processProtocol, 1000 + len(self.spawned))
+        self.spawned.append((transport, executable, args, childFDs))
+        processProtocol.makeConnection(transport)
+        return transport
+
+
+class PreforkSupervisorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = ProcessReactor()
+        self.supervisor = PreforkSupervisor(self.reactor, ['python', 'server.py', '--worker', '1080'], workers=2,
+                                            interval=5, timeout=15, restart_delay=1)
+        self.addCleanup(self.supervisor.stop)
+
+    def heartbeat(self, process, num_protocols):
+        data = json.dumps({'pid': process.transport.pid, 'num_protocols': num_protocols}).encode() + b'\n'
+        process.childDataReceived(HEARTBEAT_FD, data)
+
+    def test_start(self):
+        self.supervisor.start()
+        self.assertEqual(len(self.reactor.spawned), 2)
+        transport, executable, args, child_fds = self.reactor.spawned[0]
+        self.assertEqual(executable, 'python')
+        self.assertEqual(args, ['python', 'server.py', '--worker', '1080'])
+        self.assertEqual(child_fds[HEARTBEAT_FD], 'r')
+        self.assertEqual(sorted(self.supervisor.processes), [0, 1])
+
+    def test_heartbeat(self):
+        self.supervisor.start()
+        first, second = self.supervisor.processes[0], self.supervisor.processes[1]
+
+        # 心跳可能分成几次到达
+        data = json.dumps({'pid': 1000, 'num_protocols': 3}).encode() + b'\n'
+        first.childDataReceived(HEARTBEAT_FD, data[:5])
+        self.assertEqual(first.num_protocols, 0)
+        first.childDataReceived(HEARTBEAT_FD, data[5:])
+        self.heartbeat(second, 4)
+        self.assertEqual(self.supervisor.num_protocols, 7)
+
+    def test_restart_on_crash(self):
+        self.supervisor.start()
+        crashed = self.supervisor.processes[1]
+        crashed.transport.end()
+        self.assertNotIn(1, self.supervisor.processes)
+
+        # restart_delay 秒后以同样的序号重启
+        self.reactor.advance(1)
+        self.assertEqual(len(self.reactor.spawned), 3)
+        self.assertIsNot(self.supervisor.processes[1], crashed)
+        self.assertIs(self.supervisor.processes[1].transport, self.reactor.spawned[2][0])
+        self.assertEqual(self.supervisor.restarts, 1)
+
+    def test_health_check_kill(self):
+        self.supervisor.start()
+        alive, hung = self.supervisor.processes[0], self.supervisor.processes[1]
+
+        # 只有 worker 0 持续发送心跳
+        for _ in range(4):
+            self.reactor.advance(5)
+            self.heartbeat(alive, 1)
+
+        self.assertEqual(alive.transport.signals, [])
+        self.assertEqual(hung.transport.signals, ['KILL'])
+
+        # 进程退出后重启, 新的 worker 重新计算心跳时间
+        hung.transport.end()
+        self.reactor.advance(1)
+        restarted = self.supervisor.processes[1]
+        self.assertIsNot(restarted, hung)
+        self.reactor.advance(10)
+        self.assertEqual(restarted.transport.signals, [])
+
+    def test_stale_process_ended(self):
+        self.supervisor.start()
+        old = self.supervisor.processes[0]
+        old.transport.end()
+        self.reactor.advance(1)
+        new = self.supervisor.processes[0]
+
+        # 旧进程的 processEnded 重复到达时不影响新的 worker
+        old.processEnded(failure.Failure(error.ProcessDone(0)))
+        self.assertIs(self.supervisor.processes[0], new)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.reactor.spawned), 3)
+
+    def test_shutdown(self):
+        self.supervisor.start()
+        self.supervisor.processes[1].transport.end()  # 等待重启
+        self.supervisor.stop()
+
+        # 所有 worker 收到 TERM, 等待中的重启取消, 健康检查停止
+        self.assertEqual(self.supervisor.processes[0].transport.signals, ['TERM'])
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+        self.supervisor.processes[0].transport.end(error.ProcessDone(0))
+        self.reactor.advance(20)
+        self.assertEqual(len(self.reactor.spawned), 2)
+        self.assertEqual(self.supervisor.processes, {})
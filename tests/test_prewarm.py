@@ -0,0 +1,114 @@
+# python -m twisted.trial tests.test_prewarm
+from twisted.internet import defer, protocol, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from networktunnel import constants
+from networktunnel.helpers import create_reply
+from networktunnel.prewarm import ConnectionPrewarmer
+from networktunnel.remote_server import SocksServerFactory
+from networktunnel.timeouts import TimeoutWheel
+from tests.test_shadow import make_shadow
+
+
+class Recorder(protocol.Protocol):
+
+    def __init__(self):
+        self.received = []
+        self.early_data = []
+
+    def dataReceived(self, data):
+        self.received.append(data)
+
+
+class ConnectionPrewarmerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.dialed = []
+        self.prewarmer = ConnectionPrewarmer(self.clock, self.dial, TimeoutWheel(self.clock),
+                                             sockets=1, targets=2, idle_timeout=10, hot=2)
+
+    def dial(self, host, port, proto):
+        self.dialed.append((host, port))
+        proto.makeConnection(proto_helpers.StringTransport())
+        return defer.succeed(proto)
+
+    def test_hand_off(self):
+        self.assertFalse(self.prewarmer.acquire('example.com', 443, Recorder()))
+        self.assertEqual(self.dialed, [])
+
+        # 第二次请求后目标变热, 预先建立连接
+        self.assertFalse(self.prewarmer.acquire('example.com', 443, Recorder()))
+        self.assertEqual(self.dialed, [('example.com', 443)])
+
+        warm = self.prewarmer.targets.get(('example.com', 443)).idle[0]
+        warm.dataReceived(b'banner')
+
+        proto = Recorder()
+        self.assertTrue(self.prewarmer.acquire('example.com', 443, proto))
+        self.assertIs(proto.transport, warm.transport)
+        self.assertIs(proto.transport.protocol, proto)
+        # banner 留给 proto 在 SOCKS 回复之后转发
+        self.assertEqual(proto.early_data, [b'banner'])
+        self.assertEqual(proto.received, [])
+        self.assertEqual(len(self.dialed), 2)  # 补充
+
+    def test_idle_expire(self):
+        self.prewarmer.acquire('example.com', 443, Recorder())
+        self.prewarmer.acquire('example.com', 443, Recorder())
+        warm = self.prewarmer.targets.get(('example.com', 443)).idle[0]
+
+        self.clock.advance(11)
+        self.assertTrue(warm.transport.disconnecting)
+        self.assertEqual(self.prewarmer.expired, 1)
+
+    def test_lru_evict(self):
+        for host in ('a.com', 'a.com', 'b.com', 'c.com'):
+            self.prewarmer.acquire(host, 80, Recorder())
+
+        self.assertEqual(self.prewarmer.evicted, 1)
+        self.assertEqual(len(self.prewarmer.targets), 2)
+        self.assertNotIn(('a.com', 80), self.prewarmer.targets.cache)
+
+
+class PrewarmConnectTestCase(unittest.TestCase):
+    """ 预热连接经过 SocksServer.do_connect 交接 """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = SocksServerFactory(self.clock)
+        self.factory.splice = False
+        self.factory.crypto_executor = None
+        self.factory.coalesce_size = 0
+        self.factory.shadow = make_shadow('aes-128-cfb')
+        self.factory.prewarmer = ConnectionPrewarmer(self.clock, self.dial, self.factory.timeouts,
+                                                     sockets=1, hot=1)
+        self.addCleanup(self.factory.stopFactory)
+
+        self.server = self.factory.buildProtocol(('127.0.0.1', 1080))
+        self.tr = proto_helpers.StringTransport()
+        self.server.makeConnection(self.tr)
+
+    def dial(self, host, port, proto):
+        proto.makeConnection(proto_helpers.StringTransport())
+        return defer.succeed(proto)
+
+    def test_banner_after_reply(self):
+        # 第一次请求后目标变热, 预热的连接收到 SMTP banner
+        self.factory.prewarmer.acquire('mail.example.com', 25, Recorder())
+        warm = self.factory.prewarmer.targets.get(('mail.example.com', 25)).idle[0]
+        warm.dataReceived(b'220 mail.example.com ESMTP\r\n')
+
+        self.server.set_state(self.server.STATE_SENT_AUTHENTICATION_RESULT)
+        self.server.do_connect('mail.example.com', 25)
+        self.assertEqual(self.factory.prewarmer.hits, 1)
+
+        # 先是协议加密的 GRANTED 回复, 之后才是数据加密的 banner
+        shadow = self.factory.shadow
+        reply = shadow.encrypt_protocol_data(
+            create_reply(constants.SOCKS5_VER, constants.SOCKS5_GRANTED, warm.transport.getHost()))
+        written = self.tr.value()
+        self.assertEqual(written[:len(reply)], reply)
+        decrypt = shadow.make_data_decrypter()
+        self.assertEqual(decrypt(written[len(reply):]), b'220 mail.example.com ESMTP\r\n')
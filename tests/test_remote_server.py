@@ -18,6 +18,7 @@ class SocksServerTestCase(unittest.TestCase):
         DelayedCall.debug = True
 
         factory = SocksServerFactory(reactor)
+        self.addCleanup(factory.timeouts.stop)
         self.proto = factory.buildProtocol(("127.0.0.1", 1080))
         self.tr = proto_helpers.StringTransport()
         self.proto.makeConnection(self.tr)
@@ -0,0 +1,80 @@
+# python -m twisted.trial tests.test_resolver
+from twisted.internet import defer, task
+from twisted.names import dns, error
+from twisted.trial import unittest
+
+from networktunnel import errors
+from networktunnel.resolver import CachingResolver
+
+
+class FakeResolver(object):
+    """ 记录查询次数, 由测试决定什么时候返回结果 """
+
+    def __init__(self):
+        self.queries = []
+
+    def _lookup(self, name, timeout=None):
+        d = defer.Deferred()
+        self.queries.append((name, d))
+        return d
+
+    lookupAddress = lookupIPV6Address = _lookup
+
+    def answer(self, address='1.2.3.4', ttl=60):
+        queries, self.queries = self.queries, []
+        record = dns.RRHeader(name=queries[0][0], type=dns.A, ttl=ttl, payload=dns.Record_A(address, ttl))
+        queries[0][1].callback(([record], [], []))
+        queries[1][1].errback(error.DomainError())
+
+    def fail(self):
+        queries, self.queries = self.queries, []
+        for _, d in queries:
+            d.errback(error.DomainError())
+
+
+class CachingResolverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.upstream = FakeResolver()
+        self.resolver = CachingResolver(self.clock, negative_ttl=10, stale_ttl=30, resolver=self.upstream)
+
+    def test_coalesce_and_cache(self):
+        a = self.resolver.resolve('example.com')
+        b = self.resolver.resolve('example.com')
+        self.assertEqual(len(self.upstream.queries), 2)  # 一次 A, 一次 AAAA
+
+        self.upstream.answer()
+        self.assertEqual(self.successResultOf(a), ['1.2.3.4'])
+        self.assertEqual(self.successResultOf(b), ['1.2.3.4'])
+
+        self.assertEqual(self.successResultOf(self.resolver.resolve('example.com')), ['1.2.3.4'])
+        self.assertEqual(self.upstream.queries, [])
+        self.assertEqual(self.resolver.stats()['coalesced'], 1)
+
+    def test_serve_stale(self):
+        self.resolver.resolve('example.com')
+        self.upstream.answer(ttl=60)
+
+        self.clock.advance(61)
+        self.assertEqual(self.successResultOf(self.resolver.resolve('example.com')), ['1.2.3.4'])
+        self.assertEqual(len(self.upstream.queries), 2)  # 后台刷新
+
+        self.upstream.answer('5.6.7.8')
+        self.assertEqual(self.successResultOf(self.resolver.resolve('example.com')), ['5.6.7.8'])
+
+    def test_negative_cache(self):
+        d = self.resolver.resolve('nx.example.com')
+        self.upstream.fail()
+        self.failureResultOf(d, errors.HostUnreachable)
+
+        self.failureResultOf(self.resolver.resolve('nx.example.com'), errors.HostUnreachable)
+        self.assertEqual(self.upstream.queries, [])
+
+        self.clock.advance(11)
+        self.resolver.resolve('nx.example.com')
+        self.assertEqual(len(self.upstream.queries), 2)
+
+    def test_ip_literal(self):
+        self.assertEqual(self.successResultOf(self.resolver.resolve('::1')), ['::1'])
+        self.assertEqual(self.upstream.queries, [])
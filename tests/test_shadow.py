@@ -0,0 +1,103 @@
+# python -m twisted.trial tests.test_shadow
+import base64
+import binascii
+import os
+import socket
+import struct
+
+from twisted.trial import unittest
+
+from networktunnel import constants
+from networktunnel.ciphers import ciphers
+from networktunnel.shadow import ShadowProtocol
+
+
+def make_shadow(data_cipher, pro_cipher='aes-128-cfb'):
+    def salt(name):
+        manager = ciphers[name]('test')
+        raw = manager.random_iv() if manager.is_stream_cipher else manager.random_salt()
+        return base64.b64encode(binascii.b2a_hex(raw)).decode()
+
+    return ShadowProtocol(key='test key', data_salt=salt(data_cipher), data_cipher=data_cipher,
+                          pro_salt=salt(pro_cipher), pro_cipher=pro_cipher)
+
+
+def udp_frame(data):
+    return b''.join([
+        struct.pack('!HBB', 0, 0, constants.ATYP_IPV4),
+        socket.inet_aton('1.2.3.4'),
+        struct.pack('!H', 53),
+        data,
+    ])
+
+
+class ShadowUdpTestCase(unittest.TestCase):
+
+    def test_aead_round_trip(self):
+        for name in ('aes-128-gcm', 'chacha20-ietf-poly1305'):
+            shadow = make_shadow(name)
+            frame = udp_frame(b'query' * 100)
+            self.assertEqual(shadow.decrypt_udp_data(shadow.encrypt_udp_data(frame)), frame)
+
+    def test_aead_fresh_salt(self):
+        shadow = make_shadow('aes-256-gcm')
+        salt_size = shadow.data_cipher_manager.SALT_SIZE
+
+        first = shadow.encrypt_data(b'same plaintext')
+        second = shadow.encrypt_data(b'same plaintext')
+        # 每个数据报的 salt 和密文都不同
+        self.assertNotEqual(first[:salt_size], second[:salt_size])
+        self.assertNotEqual(first[salt_size:], second[salt_size:])
+        self.assertEqual(shadow.decrypt_data(first), b'same plaintext')
+        self.assertEqual(shadow.decrypt_data(second), b'same plaintext')
+
+    def test_aead_tampered(self):
+        shadow = make_shadow('aes-128-gcm')
+        sealed = bytearray(shadow.encrypt_data(b'payload'))
+        sealed[-1] ^= 1
+        self.assertRaises(ValueError, shadow.decrypt_data, bytes(sealed))
+
+    def test_aead_subkey_per_salt(self):
+        # 不同的 salt 必须派生出不同的子密钥, 否则所有连接共用同一组 key 和 nonce
+        manager = make_shadow('chacha20-ietf-poly1305').data_cipher_manager
+        self.assertNotEqual(manager._derive_subkey(b'a' * manager.SALT_SIZE),
+                            manager._derive_subkey(b'b' * manager.SALT_SIZE))
+
+
+class ShadowStreamTestCase(unittest.TestCase):
+
+    def _round_trip(self, name, splits):
+        shadow = make_shadow(name)
+        encrypt = shadow.make_data_encrypter()
+        decrypt = shadow.make_data_decrypter()
+
+        chunks = [os.urandom(size) for size in (1, 100, 3000, 0, 70000)]
+        ciphertext = b''.join(encrypt(chunk) for chunk in chunks)
+
+        # 密文按任意位置切分后交给解密端
+        plaintext = []
+        for start, end in zip([0] + splits, splits + [len(ciphertext)]):
+            plaintext.append(decrypt(ciphertext[start:end]))
+        self.assertEqual(b''.join(plaintext), b''.join(chunks))
+
+    def test_round_trip(self):
+        for name in ('aes-128-cfb', 'chacha20', 'salsa20', 'rc4', 'aes-128-gcm', 'xchacha20-ietf-poly1305'):
+            self._round_trip(name, [])
+            self._round_trip(name, [1, 2, 3, 5, 8, 13, 21, 34, 35, 36, 1000, 50000])
+            self._round_trip(name, list(range(1, 80)))
+
+    def test_iv_per_connection(self):
+        for name in ('aes-256-cfb', 'chacha20', 'rc4'):
+            shadow = make_shadow(name)
+            first = shadow.make_data_encrypter()(b'same plaintext')
+            second = shadow.make_data_encrypter()(b'same plaintext')
+            iv_size = shadow.data_cipher_manager.IV_SIZE
+            self.assertNotEqual(first[:iv_size], second[:iv_size])
+            self.assertNotEqual(first[iv_size:], second[iv_size:])
+
+    def test_udp_stream(self):
+        shadow = make_shadow('aes-128-cfb')
+        frame = udp_frame(b'query')
+        first = shadow.encrypt_udp_data(frame)
+        self.assertNotEqual(first, shadow.encrypt_udp_data(frame))
+        self.assertEqual(shadow.decrypt_udp_data(first), frame)
@@ -0,0 +1,76 @@
+# python -m twisted.trial tests.test_shaping
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from networktunnel.flow import read_gate
+from networktunnel.shaping import Shaping, TokenBucket
+
+
+class ShapingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(self.clock, rate=1000, burst=1000)
+        self.assertEqual(bucket.consume(1000), 0)
+
+        # 透支 500 字节, 需要等待半秒
+        self.assertAlmostEqual(bucket.consume(500), 0.5)
+
+        self.clock.advance(1)
+        self.assertEqual(bucket.consume(500), 0)
+
+    def test_pause_and_resume(self):
+        shaping = Shaping(self.clock, connection_rate=1000, global_rate=100000)
+        shaper = shaping.shaper()
+        transport = proto_helpers.StringTransport()
+        received = []
+        data_received = shaper.wrap(transport, received.append)
+
+        data_received(b'x' * 3000)
+        self.assertEqual(received, [b'x' * 3000])
+        self.assertEqual(transport.producerState, 'paused')
+
+        self.clock.advance(2)
+        self.assertEqual(transport.producerState, 'producing')
+
+    def test_user_bucket_shared(self):
+        shaping = Shaping(self.clock, user_rate=1000)
+        a = shaping.shaper('token')
+        b = shaping.shaper('token')
+        self.assertIs(a.buckets[0], b.buckets[0])
+        self.assertEqual(shaping.shaper(None).buckets, [])
+
+    def test_flow_control_pause_kept(self):
+        shaping = Shaping(self.clock, connection_rate=1000)
+        shaper = shaping.shaper()
+        transport = proto_helpers.StringTransport()
+        gate = read_gate(transport)
+        data_received = shaper.wrap(transport, lambda data: None)
+
+        # 对端写缓冲区满, 限速到期时不能恢复读取
+        gate.pauseProducing()
+        data_received(b'x' * 3000)
+        self.clock.advance(3)
+        self.assertEqual(transport.producerState, 'paused')
+
+        gate.resumeProducing()
+        self.assertEqual(transport.producerState, 'producing')
+
+    def test_shaper_pause_kept(self):
+        shaping = Shaping(self.clock, connection_rate=1000)
+        shaper = shaping.shaper()
+        transport = proto_helpers.StringTransport()
+        gate = read_gate(transport)
+        data_received = shaper.wrap(transport, lambda data: None)
+
+        # 限速期间对端的流控恢复, 仍然保持暂停直到限速到期
+        gate.pauseProducing()
+        data_received(b'x' * 3000)
+        gate.resumeProducing()
+        self.assertEqual(transport.producerState, 'paused')
+
+        self.clock.advance(3)
+        self.assertEqual(transport.producerState, 'producing')
@@ -0,0 +1,161 @@
+# python -m twisted.trial tests.test_splice
+import os
+
+from twisted.internet import defer, interfaces, protocol, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.trial import unittest
+from zope.interface import implementer
+
+from networktunnel import splice
+from networktunnel.splice import SpliceRelay, splice_supported
+
+UPLOAD = os.urandom(4 * 1024 * 1024 + 3)
+DOWNLOAD = os.urandom(1024 * 1024 + 7)
+BANNER = b'x' * (256 * 1024)  # 接管之前还在 Twisted 写缓冲区中的数据
+
+
+@implementer(interfaces.IHalfCloseableProtocol)
+class Peer(protocol.Protocol):
+    """ 收集数据, 对端关闭写入时 eof 触发 """
+
+    def __init__(self, reply=None):
+        self.reply = reply
+        self.received = []
+        self.connected_d = defer.Deferred()
+        self.eof = defer.Deferred()
+        self.lost = defer.Deferred()
+
+    def connectionMade(self):
+        self.connected_d.callback(self)
+
+    def dataReceived(self, data):
+        self.received.append(data)
+
+    def readConnectionLost(self):
+        if self.reply is not None:
+            # 收到全部数据之后再回复, 然后关闭
+            self.transport.write(self.reply)
+            self.transport.loseConnection()
+        if not self.eof.called:
+            self.eof.callback(b''.join(self.received))
+
+    def writeConnectionLost(self):
+        pass
+
+    def connectionLost(self, reason):
+        if not self.eof.called:
+            self.eof.callback(b''.join(self.received))
+        self.lost.callback(None)
+
+
+class PeerFactory(protocol.ServerFactory):
+
+    def __init__(self, reply=None):
+        self.peers = []
+        self.reply = reply
+
+    def buildProtocol(self, addr):
+        peer = Peer(self.reply)
+        peer.factory = self
+        self.peers.append(peer)
+        return peer
+
+
+class SpliceRelayTestCase(unittest.TestCase):
+
+    if not splice_supported():
+        skip = 'os.splice is not available'
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        # client -> front | relay | back -> target
+        self.front_factory = PeerFactory()
+        self.target_factory = PeerFactory(reply=DOWNLOAD)
+        front_port = reactor.listenTCP(0, self.front_factory, interface='127.0.0.1')
+        target_port = reactor.listenTCP(0, self.target_factory, interface='127.0.0.1')
+        self.addCleanup(front_port.stopListening)
+        self.addCleanup(target_port.stopListening)
+
+        self.client = yield connectProtocol(
+            TCP4ClientEndpoint(reactor, '127.0.0.1', front_port.getHost().port), Peer())
+        self.back = yield connectProtocol(
+            TCP4ClientEndpoint(reactor, '127.0.0.1', target_port.getHost().port), Peer())
+
+        # 等待两个 server 端的协议建立
+        while not (self.front_factory.peers and self.target_factory.peers):
+            yield self.wait(0.01)
+        self.front = self.front_factory.peers[0]
+        self.target = self.target_factory.peers[0]
+
+    def tearDown(self):
+        for peer in (self.client, self.front, self.back, self.target):
+            if peer.transport.connected:
+                peer.transport.abortConnection()
+        return defer.DeferredList([peer.lost for peer in (self.client, self.front, self.back, self.target)])
+
+    def wait(self, seconds):
+        d = defer.Deferred()
+        reactor.callLater(seconds, d.callback, None)
+        return d
+
+    @defer.inlineCallbacks
+    def test_bulk_half_close(self):
+        closed = defer.Deferred()
+
+        # Twisted 还没有写完的数据必须先于 splice 的数据到达
+        self.front.transport.write(BANNER)
+        relay = SpliceRelay(reactor, self.front.transport, self.back.transport,
+                            on_close=lambda a_to_b, b_to_a: closed.callback((a_to_b, b_to_a)))
+        relay.start()
+
+        # client 发送完后只关闭写入, target 收到 EOF 之后才回复
+        self.client.transport.write(UPLOAD)
+        self.client.transport.loseWriteConnection()
+
+        uploaded = yield self.target.eof
+        self.assertEqual(len(uploaded), len(UPLOAD))
+        self.assertEqual(uploaded, UPLOAD)
+
+        downloaded = yield self.client.eof
+        self.assertEqual(downloaded, BANNER + DOWNLOAD)
+
+        # 字节数只统计 splice 搬运的数据
+        a_to_b, b_to_a = yield closed
+        self.assertEqual((a_to_b, b_to_a), (len(UPLOAD), len(DOWNLOAD)))
+        self.assertEqual((relay.bytes_a_to_b, relay.bytes_b_to_a), (len(UPLOAD), len(DOWNLOAD)))
+        self.assertTrue(relay.closed)
+
+    @defer.inlineCallbacks
+    def test_wait_for_flush(self):
+        self.front.transport.write(BANNER)
+        relay = SpliceRelay(reactor, self.front.transport, self.back.transport)
+        self.assertFalse(relay.flushed(self.front.transport))
+        self.assertTrue(relay.flushed(self.back.transport))
+
+        relay.start()
+        yield self.client_received(len(BANNER))
+        yield self.wait(0.05)
+        self.assertTrue(relay.flushed(self.front.transport))
+        self.assertIsNotNone(relay.directions)
+        relay.close()
+
+    @defer.inlineCallbacks
+    def test_round_limit_with_pending(self):
+        # 每次事件只搬运一次, 读入管道之后次数就用完了
+        self.patch(splice, 'MAX_ROUNDS', 1)
+        relay = SpliceRelay(reactor, self.front.transport, self.back.transport)
+        relay.start()
+
+        # client 只发送一次, 之后没有新的可读事件
+        self.client.transport.write(b'ping')
+        for _ in range(100):
+            if self.target.received:
+                break
+            yield self.wait(0.01)
+        self.assertEqual(b''.join(self.target.received), b'ping')
+        relay.close()
+
+    @defer.inlineCallbacks
+    def client_received(self, size):
+        while sum(map(len, self.client.received)) < size:
+            yield self.wait(0.01)
@@ -0,0 +1,111 @@
+# python -m twisted.trial tests.test_timeouts
+import struct
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from config import ConfigManager
+from networktunnel import constants
+from networktunnel.base import BaseSocksServer
+from networktunnel.remote_server import SocksServerFactory
+from networktunnel.timeouts import TIMEOUT_COMMAND, TIMEOUT_HANDSHAKE, TimeoutWheel
+
+
+class FakeFactory(object):
+
+    def __init__(self, clock):
+        self.num_protocols = 0
+        self.handshake_timeout = 10
+        self.idle_timeout = 30
+        self.timeouts = TimeoutWheel(clock)
+
+
+class Conn(object):
+
+    def __init__(self):
+        self.reasons = []
+
+    def on_timeout(self, reason):
+        self.reasons.append(reason)
+
+
+class TimeoutWheelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = TimeoutWheel(self.clock)
+
+    def test_expire_and_cancel(self):
+        a, b = Conn(), Conn()
+        self.wheel.schedule(a, 3, TIMEOUT_HANDSHAKE)
+        self.wheel.schedule(b, 3, TIMEOUT_HANDSHAKE)
+        self.wheel.cancel(b)
+
+        self.clock.advance(2)
+        self.assertEqual(a.reasons, [])
+
+        self.clock.advance(1)
+        self.assertEqual(a.reasons, [TIMEOUT_HANDSHAKE])
+        self.assertEqual(b.reasons, [])
+
+        # 没有需要检查的连接时停止定时器
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class ProtocolTimeoutTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.proto = BaseSocksServer()
+        self.proto.factory = FakeFactory(self.clock)
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+    def test_handshake_timeout(self):
+        self.clock.advance(10)
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_idle_timeout(self):
+        self.proto.handshake_done()
+        relay = self.proto.track_activity(lambda data: None)
+
+        # 有数据转发时推迟超时
+        for _ in range(4):
+            self.clock.advance(10)
+            relay(b'data')
+        self.assertFalse(self.tr.disconnecting)
+
+        self.clock.advance(31)
+        self.assertTrue(self.tr.disconnecting)
+        self.assertEqual(self.proto.factory.timeouts.expired, {'idle': 1})
+
+
+class CommandTimeoutTestCase(unittest.TestCase):
+    """ 认证之后等待命令使用 command_timeout, 不受握手超时限制 """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = SocksServerFactory(self.clock)
+        self.factory.handshake_timeout = 10
+        self.factory.command_timeout = 120
+        self.addCleanup(self.factory.stopFactory)
+
+        self.proto = self.factory.buildProtocol(('127.0.0.1', 1080))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+    def test_authenticated_idle(self):
+        self.proto.set_state(self.proto.STATE_SENT_METHOD)
+        token = ConfigManager().default.get('remote', 'token').encode()
+        self.proto.auth_token(struct.pack('!BB', constants.SOCKS5_VER, len(token)) + token)
+        self.assertTrue(self.proto.is_state(self.proto.STATE_SENT_AUTHENTICATION_RESULT))
+
+        # 超过握手超时, 还在等待命令
+        self.clock.pump([1] * 60)
+        self.assertFalse(self.tr.disconnecting)
+
+        self.clock.pump([1] * 61)
+        self.assertTrue(self.tr.disconnecting)
+        self.assertEqual(self.factory.timeouts.expired, {TIMEOUT_COMMAND: 1})
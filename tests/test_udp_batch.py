@@ -0,0 +1,86 @@
+# python -m twisted.trial tests.test_udp_batch
+import socket
+
+from types import SimpleNamespace
+
+from twisted.internet import defer, protocol, reactor
+from twisted.trial import unittest
+
+from networktunnel import constants
+from networktunnel.local_client import UDPProxyClient
+from networktunnel.udp_batch import BatchPort, batch_supported, listen_udp
+from tests.test_shadow import make_shadow, udp_frame
+
+
+class BatchEcho(protocol.DatagramProtocol):
+
+    def __init__(self):
+        self.batches = []
+        self.done = defer.Deferred()
+
+    def datagramsReceived(self, datagrams):
+        self.batches.append(len(datagrams))
+        self.transport.write_batch([(data.upper(), addr) for data, addr in datagrams])
+        if sum(self.batches) >= 3 and not self.done.called:
+            self.done.callback(None)
+
+
+class BatchPortTestCase(unittest.TestCase):
+
+    def setUp(self):
+        if not batch_supported():
+            raise unittest.SkipTest('recvmmsg / sendmmsg is not available')
+
+        self.proto = BatchEcho()
+        self.port = listen_udp(reactor, 0, self.proto, interface='127.0.0.1', batch=True)
+        self.addCleanup(self.port.stopListening)
+
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(('127.0.0.1', 0))
+        self.client.settimeout(5)
+        self.addCleanup(self.client.close)
+
+    @defer.inlineCallbacks
+    def test_batch_echo(self):
+        self.assertIsInstance(self.port, BatchPort)
+
+        # 在 reactor 读取之前发送, 一次可读事件取出全部数据报
+        for data in (b'a', b'bb', b'ccc'):
+            self.client.sendto(data, ('127.0.0.1', self.port.getHost().port))
+        yield self.proto.done
+
+        self.assertEqual(self.proto.batches, [3])
+        replies = [self.client.recvfrom(100) for _ in range(3)]
+        self.assertEqual([data for data, _ in replies], [b'A', b'BB', b'CCC'])
+        self.assertEqual(replies[0][1], ('127.0.0.1', self.port.getHost().port))
+
+
+class BatchTransport(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def write_batch(self, datagrams):
+        self.batches.append(datagrams)
+
+
+class BatchRelayTestCase(unittest.TestCase):
+
+    def test_bad_datagram_in_batch(self):
+        shadow = make_shadow('aes-128-gcm')
+        server = SimpleNamespace(factory=SimpleNamespace(shadow=shadow))
+        proxy = UDPProxyClient(server, addr=('127.0.0.1', 40000), atyp=constants.ATYP_IPV4)
+        proxy.set_peer(('127.0.0.1', 1080), constants.ATYP_IPV4)
+        proxy.transport = BatchTransport()
+
+        frames = [udp_frame(data) for data in (b'first', b'second', b'third')]
+        datagrams = [(shadow.encrypt_udp_data(frame), ('127.0.0.1', 1080)) for frame in frames]
+        bad = bytearray(datagrams[1][0])
+        bad[-1] ^= 1  # AEAD 认证失败
+        datagrams[1] = (bytes(bad), datagrams[1][1])
+
+        # 中间的数据报丢弃, 前后的照常转发
+        proxy.datagramsReceived(datagrams)
+        [out] = proxy.transport.batches
+        self.assertEqual(out, [(frames[0], ('127.0.0.1', 40000)), (frames[2], ('127.0.0.1', 40000))])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
@@ -0,0 +1,88 @@
+# python -m twisted.trial tests.test_udp_nat
+import socket
+import struct
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from networktunnel import constants
+from networktunnel.helpers import create_udp_frame
+from networktunnel.timeouts import TimeoutWheel
+from networktunnel.udp_nat import UdpNatTable
+
+
+class FakeResolver(object):
+
+    def __init__(self):
+        self.waiting = {}
+
+    def resolve(self, host):
+        d = self.waiting[host] = defer.Deferred()
+        return d
+
+
+def ipv4_frame(host, port, data):
+    return create_udp_frame(0, constants.ATYP_IPV4, socket.inet_aton(host), port, data)
+
+
+class UdpNatTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.timeouts = TimeoutWheel(self.clock)
+        self.resolver = FakeResolver()
+        self.sent = []
+        self.table = UdpNatTable(self.clock, self.timeouts, send=lambda data, addr: self.sent.append((data, addr)),
+                                 resolver=self.resolver, capacity=2, idle_timeout=10)
+
+    def test_round_trip(self):
+        # 没有发送过的来源丢弃
+        self.assertIsNone(self.table.inbound(b'pong', ('1.2.3.4', 53)))
+
+        self.assertEqual(self.table.outbound(ipv4_frame('1.2.3.4', 53, b'ping')), (b'ping', ('1.2.3.4', 53)))
+        self.assertEqual(self.table.inbound(b'pong', ('1.2.3.4', 53)), ipv4_frame('1.2.3.4', 53, b'pong'))
+        self.assertEqual(self.table.stats()['dropped'], 1)
+
+    def test_domain(self):
+        frame = create_udp_frame(0, constants.ATYP_DOMAINNAME, 'example.com', 53, b'query')
+        self.assertIsNone(self.table.outbound(frame))
+        self.assertIsNone(self.table.outbound(frame))
+
+        self.resolver.waiting['example.com'].callback(['5.6.7.8'])
+        self.assertEqual(self.sent, [(b'query', ('5.6.7.8', 53))] * 2)
+
+        # 解析之后直接查表, 回复头使用目标的 IP
+        self.assertEqual(self.table.outbound(frame), (b'query', ('5.6.7.8', 53)))
+        self.assertEqual(self.table.inbound(b'answer', ('5.6.7.8', 53)), ipv4_frame('5.6.7.8', 53, b'answer'))
+
+    def test_capacity(self):
+        self.table.outbound(ipv4_frame('1.1.1.1', 1, b''))
+        self.table.outbound(ipv4_frame('2.2.2.2', 2, b''))
+        self.table.outbound(ipv4_frame('1.1.1.1', 1, b''))
+        self.table.outbound(ipv4_frame('3.3.3.3', 3, b''))
+
+        # 淘汰最久没有发送的 2.2.2.2
+        self.assertEqual(len(self.table), 2)
+        self.assertIsNone(self.table.inbound(b'', ('2.2.2.2', 2)))
+        self.assertIsNotNone(self.table.inbound(b'', ('1.1.1.1', 1)))
+        self.assertEqual(self.table.stats()['evicted'], 1)
+
+    def test_idle_expire(self):
+        self.table.outbound(ipv4_frame('1.1.1.1', 1, b''))
+        self.table.outbound(ipv4_frame('2.2.2.2', 2, b''))
+
+        self.clock.advance(6)
+        self.table.inbound(b'', ('1.1.1.1', 1))  # 回复也算活动
+        self.clock.pump([1] * 6)
+
+        self.assertIsNotNone(self.table.inbound(b'', ('1.1.1.1', 1)))
+        self.assertIsNone(self.table.inbound(b'', ('2.2.2.2', 2)))
+        self.assertEqual(self.table.stats()['expired'], 1)
+
+        self.table.close()
+        self.assertEqual(len(self.timeouts), 0)
+
+    def test_malformed(self):
+        self.assertIsNone(self.table.outbound(b'\x00\x00'))
+        self.assertIsNone(self.table.outbound(struct.pack('!HBB', 0, 1, constants.ATYP_IPV4) + bytes(6)))  # 分片
+        self.assertEqual(self.table.stats()['dropped'], 2)